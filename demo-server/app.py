@@ -1,7 +1,10 @@
 from flask import Flask, jsonify, request, render_template, url_for, session, redirect, flash, send_from_directory
 from dotenv import load_dotenv
+from sandbox import MemorySandboxStore, RedisSandboxStore, SANDBOX_TTL_SECONDS, apply_overlay
+import os
 import re
 import hashlib
+import secrets
 
 
 # Helper function to hash passwords using MD5
@@ -26,6 +29,37 @@ load_dotenv(".env")
 app = Flask(__name__)
 app.config['SECRET_KEY'] = "supersecretkey"
 
+# With SANDBOXES=1 every browser session gets its own copy of the data to attack, otherwise everyone shares one
+SANDBOXES = os.environ.get('SANDBOXES', '0') == '1'
+SHARED_SANDBOX = 'shared'
+# Tables the sandboxes can change, on top of the baseline above
+TABLES = {'users': USERS, 'grades': GRADES}
+if os.environ.get('REDIS_URL'):
+    # Keep the changes in Redis so every worker agrees on them
+    import redis
+    sandbox_store = RedisSandboxStore(redis.Redis.from_url(os.environ['REDIS_URL']), tuple(TABLES), int(os.environ.get('SANDBOX_TTL_SECONDS', SANDBOX_TTL_SECONDS)))
+else:
+    sandbox_store = MemorySandboxStore()
+
+
+def get_sandbox_id():
+    # Sandbox of the current browser session, created on its first request
+    if not SANDBOXES:
+        return SHARED_SANDBOX
+    if 'sandbox_id' not in session:
+        session['sandbox_id'] = secrets.token_hex(8)
+    return session['sandbox_id']
+
+
+def get_table(name):
+    # The current sandbox's view of a table. Change it with sandbox_store.set_value, not in place.
+    return apply_overlay(TABLES[name], sandbox_store.get_overlay(get_sandbox_id(), name))
+
+
+@app.context_processor
+def inject_sandboxes():
+    return {'sandboxes': SANDBOXES}
+
 
 @app.route('/', methods=['GET'])
 def index():
@@ -40,7 +74,7 @@ def grades():
         return redirect(url_for('login'))
     # Get grades information
     username = session['username']
-    user_grades = GRADES.get(username, {})
+    user_grades = get_table('grades').get(username, {})
     return render_template('grades.html', username=username, grades=user_grades)
 
 
@@ -50,7 +84,8 @@ def login():
         username = request.form['username']
         password = request.form['password']
         hashed_password = hash_password(password)
-        if username in USERS and USERS[username] == hashed_password:
+        users = get_table('users')
+        if username in users and users[username] == hashed_password:
             session['username'] = username
             return redirect(url_for('index'))
         else:
@@ -60,10 +95,41 @@ def login():
 
 @app.route('/logout')
 def logout():
+    # Signing out keeps the session's sandbox
+    sandbox_id = session.get('sandbox_id')
     session.clear()
+    if sandbox_id:
+        session['sandbox_id'] = sandbox_id
     return redirect(url_for('login'))
 
 
+def sandbox_controls_url():
+    # Page showing the snapshot and reset buttons: the home page of each sandbox, or the teacher portal for the shared data
+    return url_for('index') if SANDBOXES else url_for('teacher_portal')
+
+
+@app.route('/sandbox/snapshot', methods=['POST'])
+def sandbox_snapshot():
+    if not SANDBOXES and session.get('username') != 'teacher':
+        flash('You need to be signed in as a teacher to save the shared data', 'danger')
+        return redirect(url_for('index'))
+    sandbox_store.save_snapshot(get_sandbox_id())
+    flash('Snapshot saved', 'success')
+    return redirect(sandbox_controls_url())
+
+
+@app.route('/sandbox/reset', methods=['POST'])
+def sandbox_reset():
+    # Go back to the saved snapshot, or with to=baseline to the original data
+    if not SANDBOXES and session.get('username') != 'teacher':
+        flash('You need to be signed in as a teacher to reset the shared data', 'danger')
+        return redirect(url_for('index'))
+    to_snapshot = request.form.get('to') != 'baseline'
+    sandbox_store.reset(get_sandbox_id(), to_snapshot)
+    flash('Reset to the last snapshot' if to_snapshot else 'Reset to the original data', 'success')
+    return redirect(sandbox_controls_url())
+
+
 @app.route('/list_view', methods=['GET'])
 def list_view():
     # Collect all endpoints
@@ -91,7 +157,7 @@ def robots():
 # ------------------ Teacher routes ------------------ #
 @app.route('/passwords', methods=['GET'])
 def passwords():
-    return render_template('passwords.html', users=USERS)
+    return render_template('passwords.html', users=get_table('users'))
 
 
 @app.route('/teacher_portal', methods=['GET', 'POST'])
@@ -100,8 +166,9 @@ def teacher_portal():
     if 'username' not in session or session['username'] != 'teacher':
         flash('You need to be signed in as a teacher to access this page', 'danger')
         return redirect(url_for('login'))
+    grades = get_table('grades')
     if request.method == 'GET':
-        return render_template('teacher_portal.html', grades=GRADES)
+        return render_template('teacher_portal.html', grades=grades)
     if request.method == 'POST':
         # Get the form data
         student = request.form.get('student')
@@ -111,8 +178,11 @@ def teacher_portal():
         if not re.match(r'^\d{1,3}$', grade):
             flash('Invalid grade', 'danger')
             return redirect(url_for('teacher_portal'))
-        # Update the grade
-        GRADES[student][subject] = int(grade)
+        if student not in grades:
+            flash('Invalid student', 'danger')
+            return redirect(url_for('teacher_portal'))
+        # Update the grade in this sandbox only
+        sandbox_store.set_value(get_sandbox_id(), 'grades', (student, subject), int(grade))
         flash('Grade updated', 'success')
         return redirect(url_for('teacher_portal'))
 
@@ -0,0 +1,143 @@
+"""
+Copy-on-write sandboxes of the demo data, so students attacking the site don't overwrite each other.
+
+The baseline USERS and GRADES are shared by every sandbox and never changed. A sandbox only keeps the
+values changed in it, as an overlay applied on top of the baseline when read, so memory grows with the
+changes students make rather than with the number of students. Each sandbox can save a snapshot of its
+changes and be reset to that snapshot or to the baseline.
+
+With REDIS_URL set, the overlays are kept in Redis so every gunicorn worker sees the same sandboxes,
+and sandboxes left alone for SANDBOX_TTL_SECONDS are deleted. Otherwise they are kept in this process.
+"""
+import copy
+import json
+import threading
+
+SANDBOX_TTL_SECONDS = 24 * 60 * 60 # How long Redis keeps a sandbox after its last change
+
+# Replace hashes with copies of others in one step, so a snapshot or reset is never half done.
+# KEYS are pairs of source and destination hashes, ARGV[1] the seconds both are then kept for.
+COPY_HASHES_SCRIPT = """
+for i = 1, #KEYS, 2 do
+    local fields = redis.call('HGETALL', KEYS[i])
+    redis.call('DEL', KEYS[i + 1])
+    if #fields > 0 then
+        redis.call('HSET', KEYS[i + 1], unpack(fields))
+    end
+    redis.call('EXPIRE', KEYS[i], ARGV[1])
+    redis.call('EXPIRE', KEYS[i + 1], ARGV[1])
+end
+return #KEYS / 2
+"""
+
+
+def apply_overlay(baseline, overlay):
+    """
+    Build a sandbox's view of a table.
+    Parameters:
+    - baseline: The shared table, e.g. GRADES. It is not changed.
+    - overlay: Dictionary mapping the key path of each changed value, e.g. ('jimmy', 'Math'), to the value.
+    Returns:
+    - view: Copy of the baseline with the changed values.
+    """
+    if not overlay:
+        return baseline
+    view = copy.deepcopy(baseline)
+    for path, value in overlay.items():
+        table = view
+        for key in path[:-1]:
+            table = table.setdefault(key, {})
+        table[path[-1]] = value
+    return view
+
+
+class MemorySandboxStore:
+    """
+    Overlays kept in this process, for running a single worker without Redis.
+    """
+    def __init__(self):
+        # Maps each sandbox to its overlay of each table, and to its saved snapshot of them
+        self._overlays = {}
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def get_overlay(self, sandbox_id, table):
+        with self._lock:
+            return dict(self._overlays.get(sandbox_id, {}).get(table, {}))
+
+    def set_value(self, sandbox_id, table, path, value):
+        with self._lock:
+            self._overlays.setdefault(sandbox_id, {}).setdefault(table, {})[tuple(path)] = value
+
+    def save_snapshot(self, sandbox_id):
+        with self._lock:
+            overlays = self._overlays.get(sandbox_id, {})
+            self._snapshots[sandbox_id] = {table: dict(overlay) for table, overlay in overlays.items()}
+
+    def reset(self, sandbox_id, to_snapshot=True):
+        with self._lock:
+            snapshot = self._snapshots.get(sandbox_id) if to_snapshot else None
+            if snapshot:
+                self._overlays[sandbox_id] = {table: dict(overlay) for table, overlay in snapshot.items()}
+            else:
+                self._overlays.pop(sandbox_id, None)
+                if not to_snapshot:
+                    self._snapshots.pop(sandbox_id, None)
+
+
+class RedisSandboxStore:
+    """
+    Overlays kept in Redis, as one hash per sandbox and table mapping each JSON encoded key path to the
+    JSON encoded value, e.g. sandbox:3f2a...:grades {'["jimmy", "Math"]': '100'}.
+    """
+    def __init__(self, redis_client, tables, ttl=SANDBOX_TTL_SECONDS):
+        """
+        Parameters:
+        - redis_client: The Redis client object.
+        - tables: Names of every table that can be changed, e.g. ('users', 'grades').
+        - ttl: Seconds a sandbox is kept after its last change.
+        """
+        self.redis_client = redis_client
+        self.tables = tables
+        self.ttl = ttl
+        self.copy_hashes = redis_client.register_script(COPY_HASHES_SCRIPT)
+
+    def _key(self, sandbox_id, table):
+        return f"sandbox:{sandbox_id}:{table}"
+
+    def _snapshot_key(self, sandbox_id, table):
+        return f"sandbox:{sandbox_id}:snapshot:{table}"
+
+    def get_overlay(self, sandbox_id, table):
+        fields = self.redis_client.hgetall(self._key(sandbox_id, table))
+        return {tuple(json.loads(path)): json.loads(value) for path, value in fields.items()}
+
+    def set_value(self, sandbox_id, table, path, value):
+        key = self._key(sandbox_id, table)
+        pipeline = self.redis_client.pipeline(transaction=True)
+        pipeline.hset(key, json.dumps(list(path)), json.dumps(value))
+        self._queue_expire(pipeline, sandbox_id)
+        pipeline.execute()
+
+    def save_snapshot(self, sandbox_id):
+        keys = []
+        for table in self.tables:
+            keys += [self._key(sandbox_id, table), self._snapshot_key(sandbox_id, table)]
+        self.copy_hashes(keys=keys, args=[self.ttl])
+
+    def reset(self, sandbox_id, to_snapshot=True):
+        if to_snapshot:
+            keys = []
+            for table in self.tables:
+                keys += [self._snapshot_key(sandbox_id, table), self._key(sandbox_id, table)]
+            self.copy_hashes(keys=keys, args=[self.ttl])
+        else:
+            keys = [self._key(sandbox_id, table) for table in self.tables]
+            keys += [self._snapshot_key(sandbox_id, table) for table in self.tables]
+            self.redis_client.delete(*keys)
+
+    def _queue_expire(self, pipeline, sandbox_id):
+        # The whole sandbox expires together, counted from its last change
+        for table in self.tables:
+            pipeline.expire(self._key(sandbox_id, table), self.ttl)
+            pipeline.expire(self._snapshot_key(sandbox_id, table), self.ttl)
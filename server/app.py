@@ -1,34 +1,230 @@
-from flask import Flask, jsonify, request, render_template, url_for, session, redirect, flash, send_from_directory
+from flask import Blueprint, Flask, Response, current_app, jsonify, request, render_template, url_for, session, redirect, flash, send_from_directory
 from dotenv import load_dotenv
 import os
 import datetime
-import hashlib
-import re
 import redis
-import json
-from helper_functions.device import insert_device_database, remove_device_database, update_last_seen, ensure_device_active, check_last_seen, update_password
-from helper_functions.time_helper import get_current_utc_time, convert_string_time_to_datetime
+from helper_functions.device import remove_device_from_indexes
+from helper_functions.commands import describe_commands, COMMANDS
+from helper_functions.wire_format import wants_binary, encode_commands, encode_credentials, BINARY_MIMETYPE, MAX_BINARY_BATCH_SIZE
+from helper_functions.route_helpers import get_poll_options, format_poll_commands, parse_control_device_request, authorize_device_command, parse_bulk_request, error_status_code, authorize_targets, record_results, get_admin_options, prepare_admin_devices, get_hack_event_options, get_int_arg
+from helper_functions.password_pool import get_password_pool
+from helper_functions.expiry_listener import register_device_expired_hook, start_expiry_listener
+from helper_functions.credential_cache import configure_credential_cache, start_device_event_listener
+from helper_functions.storage import create_device_store
+from helper_functions.hack_events import configure_hack_events
+from helper_functions.live_events import LiveEventViewer, configure_live_events, publish_live_event, add_viewer, remove_viewer, stream_live_events
+from helper_functions.event_log import configure_event_log, log_event
+from helper_functions.sharding import ShardRing, configure_sharding, client_for_device, device_command_key
+from helper_functions.metrics import InstrumentedRedis, init_flask_metrics, register_fleet_collector, generate_metrics, METRICS_CONTENT_TYPE, CREDENTIAL_REISSUES
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 
-DEVICE_TIMEOUT_SECONDS = 300 # Time in seconds before a device is considered offline
+MAX_BULK_TARGETS = 1024 # Most devices /control_devices will send a command to at once with an admin token
+# Without one, every target costs a source rate limit token, so a request may only target SOURCE_RATE_LIMIT_BURST devices (20 by default)
+MAX_POLL_WAIT_SECONDS = 30 # Longest time /poll_commands?wait= will hold a request open
+MAX_POLL_BATCH_SIZE = 10 # Most commands /poll_commands?batch= will deliver in one response
+MAX_QUEUED_COMMANDS = 10 # Most commands that can wait for a device at once
+ADMIN_DEVICES_PER_PAGE = 50 # Default number of devices shown on each page of /admin
+ADMIN_MAX_DEVICES_PER_PAGE = 200 # Largest page of devices /admin will fetch at once
+LEADERBOARD_SIZE = 10 # Default number of entries on each /leaderboard
+MAX_LEADERBOARD_SIZE = 100 # Most entries /leaderboard will return on each leaderboard
+HACK_EVENTS_PER_PAGE = 100 # Default number of events /hack_events returns at once
+MAX_HACK_EVENTS_PER_PAGE = 1000 # Most events /hack_events will return at once
 
 load_dotenv(".env")
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.environ.get("SECRET_KEY")
-app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_port=1) # NOTE: Comment out for local testing
-
-# Initialize Redis client
-redis_pool = redis.ConnectionPool(host='localhost', port=6379, db=0)
-redis_client = redis.Redis(connection_pool=redis_pool)
+# Set by create_app and used by the routes. There is one app per process, which owns the Redis pool.
+DEVICE_TIMEOUT_SECONDS = 300 # Time in seconds before a device is considered offline
+ADMIN_TOKEN = None # Lets /control_devices skip device passwords, disabled if unset
+SOURCE_RATE_LIMIT = None
+DEVICE_RATE_LIMIT = None
+redis_pool = None
+redis_client = None # A ShardRing when the devices are sharded over several Redis nodes, None without Redis
+device_store = None
+fleet_collector = None
+# Process the background listeners were started in
+_listeners_pid = None
+
+routes = Blueprint('badge', __name__, cli_group=None)
+
+def _env_flag(environ, name, default):
+    return environ.get(name, default).lower() in ("1", "true", "yes")
+
+def _env_seconds(environ, name, default=None):
+    value = environ.get(name)
+    return float(value) if value else default
+
+def load_config(environ=None):
+    """
+    Read the server settings from the environment.
+    Parameters:
+    - environ: Mapping of the environment variables, os.environ by default.
+    Returns:
+    - config: Dictionary of the settings, used as the Flask config by create_app.
+    """
+    environ = os.environ if environ is None else environ
+    shard_urls = [url.strip() for url in environ.get("REDIS_SHARD_URLS", "").split(",") if url.strip()]
+    failed_guess_sample_rate = float(environ.get("FAILED_GUESS_LOG_SAMPLE_RATE", 0.1))
+    return {
+        'SECRET_KEY': environ.get("SECRET_KEY"),
+        'ADMIN_TOKEN': environ.get("ADMIN_TOKEN"),
+        'DEBUG': _env_flag(environ, "FLASK_DEBUG", ""),
+        # Trust the X-Forwarded-* headers of one reverse proxy, turn off when clients connect directly
+        'PROXY_FIX': _env_flag(environ, "PROXY_FIX", "true"),
+        'DEVICE_TIMEOUT_SECONDS': int(environ.get("DEVICE_TIMEOUT_SECONDS", 300)),
+        # Where the devices are stored: redis, or memory for a single process server without Redis
+        'STORAGE_BACKEND': environ.get("STORAGE_BACKEND", "redis"),
+        # Redis connection pool of each worker process. The pool needs a connection for every request
+        # thread, plus one for each background listener.
+        'REDIS_URL': environ.get("REDIS_URL", "redis://localhost:6379/0"),
+        'REDIS_MAX_CONNECTIONS': int(environ.get("REDIS_MAX_CONNECTIONS", 50)),
+        # Unset to wait forever. Long polls block in Redis, so it must be longer than MAX_POLL_WAIT_SECONDS.
+        'REDIS_SOCKET_TIMEOUT': _env_seconds(environ, "REDIS_SOCKET_TIMEOUT"),
+        'REDIS_SOCKET_CONNECT_TIMEOUT': _env_seconds(environ, "REDIS_SOCKET_CONNECT_TIMEOUT", 5),
+        'REDIS_HEALTH_CHECK_INTERVAL': int(environ.get("REDIS_HEALTH_CHECK_INTERVAL", 30)),
+        # Redis nodes the devices are sharded over, with REDIS_URL still holding everything else. Devices are
+        # split into DEVICE_SHARDS hash-tagged shards, which every worker must agree on. Setting DEVICE_SHARDS
+        # without any shard URLs keeps one node but uses the sharded key layout, e.g. for a Redis Cluster proxy.
+        'REDIS_SHARD_URLS': shard_urls,
+        'DEVICE_SHARDS': int(environ.get("DEVICE_SHARDS", 64 if shard_urls else 0)),
+        # Token buckets pacing password guesses, as (burst, tokens refilled per second) for each source
+        # IP address and for each target device. A rate of 0 turns the limit off.
+        'SOURCE_RATE_LIMIT': (float(environ.get("SOURCE_RATE_LIMIT_BURST", 20)), float(environ.get("SOURCE_RATE_LIMIT_PER_SECOND", 5))),
+        'DEVICE_RATE_LIMIT': (float(environ.get("DEVICE_RATE_LIMIT_BURST", 20)), float(environ.get("DEVICE_RATE_LIMIT_PER_SECOND", 5))),
+        # Devices whose password hash each worker keeps in memory, or 0 to always read it from Redis
+        'CREDENTIAL_CACHE_SIZE': int(environ.get("CREDENTIAL_CACHE_SIZE", 4096)),
+        'CREDENTIAL_CACHE_TTL_SECONDS': float(environ.get("CREDENTIAL_CACHE_TTL_SECONDS", 5)),
+        # Event log written as JSON lines to standard output. Password fields are redacted, hashed or left
+        # as they are (redact, hash or none), and only a fraction of the failed and rate limited guesses are logged.
+        'LOG_REDACTION': environ.get("LOG_REDACTION", "redact"),
+        'EVENT_LOG_SAMPLE_RATES': {'failed_guess': failed_guess_sample_rate, 'rate_limited': failed_guess_sample_rate},
+        # Optionally listen for expired devices to run cleanup hooks
+        'DEVICE_EXPIRY_LISTENER': _env_flag(environ, "DEVICE_EXPIRY_LISTENER", ""),
+        'DEVICE_EXPIRY_CONFIGURE_REDIS': _env_flag(environ, "DEVICE_EXPIRY_CONFIGURE_REDIS", "true"),
+        # Live admin dashboards streamed from /admin/events. Each one holds a request thread of the Flask
+        # app, so only this many are streamed by each worker and a stream is closed (and reopened by the
+        # browser) after LIVE_EVENTS_MAX_SECONDS. The asyncio serving mode has no limit on the viewers.
+        'LIVE_EVENTS_MAX_VIEWERS': int(environ.get("LIVE_EVENTS_MAX_VIEWERS", 8)),
+        'LIVE_EVENTS_MAX_SECONDS': float(environ.get("LIVE_EVENTS_MAX_SECONDS", 600)),
+        # Roughly how many of the latest delivered commands /hack_events can replay
+        'HACK_EVENTS_MAX_LENGTH': int(environ.get("HACK_EVENTS_MAX_LENGTH", 10000)),
+    }
 
+def get_redis_pool_options(config):
+    """
+    Get the connection pool settings shared by the Flask and asyncio servers.
+    Parameters:
+    - config: The server settings returned by load_config.
+    Returns:
+    - options: Keyword arguments for ConnectionPool.from_url, with the Redis URL as url.
+    """
+    socket_timeout = config['REDIS_SOCKET_TIMEOUT']
+    if socket_timeout is not None and socket_timeout <= MAX_POLL_WAIT_SECONDS:
+        raise ValueError(f"REDIS_SOCKET_TIMEOUT must be longer than the {MAX_POLL_WAIT_SECONDS} second long poll")
+    return {
+        'url': config['REDIS_URL'],
+        'max_connections': config['REDIS_MAX_CONNECTIONS'],
+        'socket_timeout': socket_timeout,
+        'socket_connect_timeout': config['REDIS_SOCKET_CONNECT_TIMEOUT'],
+        'health_check_interval': config['REDIS_HEALTH_CHECK_INTERVAL'],
+    }
 
-@app.route('/', methods=['GET'])
+def create_redis_clients(config, pool_class=redis.ConnectionPool, client_class=InstrumentedRedis):
+    """
+    Create the Redis connection pools and client of the server.
+    Parameters:
+    - config: The server settings returned by load_config.
+    - pool_class: The connection pool class, redis.asyncio.ConnectionPool for the asyncio server.
+    - client_class: The Redis client class.
+    Returns:
+    - redis_pools: List of the connection pools, starting with the one of REDIS_URL.
+    - redis_client: The Redis client object, or a ShardRing if REDIS_SHARD_URLS is set.
+    """
+    options = get_redis_pool_options(config)
+    redis_pools = [pool_class.from_url(**options)]
+    primary_client = client_class(connection_pool=redis_pools[0])
+    if not config['REDIS_SHARD_URLS']:
+        return redis_pools, primary_client
+    nodes = {}
+    for url in config['REDIS_SHARD_URLS']:
+        if url == options['url']:
+            # The primary node can hold shards too
+            nodes[url] = primary_client
+            continue
+        redis_pools.append(pool_class.from_url(**{**options, 'url': url}))
+        nodes[url] = client_class(connection_pool=redis_pools[-1])
+    return redis_pools, ShardRing(primary_client, nodes)
+
+def remove_expired_device_command(device_ip, redis_client):
+    # Drop any command still waiting for a device that has expired
+    client_for_device(device_ip, redis_client).delete(device_command_key(device_ip))
+
+def create_app(config=None):
+    """
+    Create the Flask app and its device store.
+    Under a pre-fork server, call it in each worker rather than before forking, so every worker opens
+    its own Redis connections and runs its own listener threads. gunicorn.conf.py does this.
+    Parameters:
+    - config: Dictionary of settings overriding the ones read from the environment by load_config.
+    Returns:
+    - app: The Flask app.
+    """
+    global DEVICE_TIMEOUT_SECONDS, ADMIN_TOKEN, SOURCE_RATE_LIMIT, DEVICE_RATE_LIMIT, redis_pool, redis_client, device_store, fleet_collector, _listeners_pid
+    app = Flask(__name__)
+    app.config.update(load_config())
+    app.config.update(config or {})
+    if app.config['PROXY_FIX']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_port=1)
+    DEVICE_TIMEOUT_SECONDS = app.config['DEVICE_TIMEOUT_SECONDS']
+    ADMIN_TOKEN = app.config['ADMIN_TOKEN']
+    SOURCE_RATE_LIMIT = app.config['SOURCE_RATE_LIMIT']
+    DEVICE_RATE_LIMIT = app.config['DEVICE_RATE_LIMIT']
+    configure_event_log(redaction=app.config['LOG_REDACTION'], sample_rates=app.config['EVENT_LOG_SAMPLE_RATES'])
+    configure_sharding(app.config['DEVICE_SHARDS'])
+    configure_hack_events(app.config['HACK_EVENTS_MAX_LENGTH'])
+
+    # Initialize Redis client, unless the devices are kept in memory
+    use_redis = app.config['STORAGE_BACKEND'] == 'redis'
+    redis_pool = redis_client = None
+    if use_redis:
+        redis_pools, redis_client = create_redis_clients(app.config)
+        redis_pool = redis_pools[0]
+    device_store = create_device_store(app.config['STORAGE_BACKEND'], DEVICE_TIMEOUT_SECONDS, redis_client)
+
+    # Stream device events to the live admin dashboards, from one shared Redis subscription in each process
+    if use_redis:
+        configure_live_events(redis_client, app.config['DEVICE_EXPIRY_LISTENER'])
+    else:
+        configure_live_events()
+        device_store.event_handler = publish_live_event
+
+    # Record request and Redis metrics, and expose the fleet gauges on /metrics
+    init_flask_metrics(app)
+    fleet_collector = register_fleet_collector(device_store)
+    app.register_blueprint(routes)
+
+    # Start the listener threads once in each process, since a second app would only duplicate them
+    if use_redis and _listeners_pid != os.getpid():
+        _listeners_pid = os.getpid()
+        # Cache device password hashes, dropping them when another worker changes a device
+        configure_credential_cache(app.config['CREDENTIAL_CACHE_SIZE'], app.config['CREDENTIAL_CACHE_TTL_SECONDS'])
+        if app.config['CREDENTIAL_CACHE_SIZE']:
+            start_device_event_listener(redis_client)
+        if app.config['DEVICE_EXPIRY_LISTENER']:
+            register_device_expired_hook(remove_expired_device_command)
+            register_device_expired_hook(remove_device_from_indexes)
+            start_expiry_listener(redis_client, app.config['DEVICE_EXPIRY_CONFIGURE_REDIS'])
+
+    # Load the password pool before the first device asks for credentials
+    get_password_pool()
+    return app
+
+
+@routes.route('/', methods=['GET'])
 def index():
     return render_template('index.html')
 
-@app.route('/get_commands', methods=['GET'])
+@routes.route('/get_commands', methods=['GET'])
 def get_commands():
     """
     Get the commands that the device can execute.
@@ -56,249 +252,189 @@ def get_commands():
             }
         ],
         'description': 'These are the commands that the device can execute. Execute commands by sending a POST request to /control_device with the appropriate parameters. The device IP address and password are required to authenticate the device. The control_type parameter specifies the type of command to execute. The parameters for each command are specified in the commands list.',
-        'control_types': [
-            {
-                'command': 'change_led_color',
-                'description': 'Change the color of the LED on the device',
-                'parameters': [
-                    {
-                        'name': 'color',
-                        'type': 'str',
-                        'description': 'Hex color value (e.g. #FF0000 for red)'
-                    },
-                ]
-            },
-            {
-                'command': 'change_password',
-                'description': 'Change the password of the device',
-                'parameters': [
-                    {
-                        'name': 'new_password',
-                        'type': 'str',
-                        'description': 'New password for the device'
-                    }
-                ]
-            },
-            {
-                'command': 'display_password',
-                'description': 'Display the password of the device on the screen',
-                'parameters': 'None'
-            },
-            {
-                'command': 'hide_password',
-                'description': 'Hide thepassword of the device from the screen',
-                'parameters': 'None'
-            },
-            {
-                'command': 'rickroll',
-                'description': 'Plays the Rick Astley - Never Gonna Give You Up song on the device',
-                'parameters': 'None'
-            }
-        ],
+        'control_types': describe_commands(),
         'example_parameters': {
             'control_type': 'change_led_color',
             'ip_address': '192.168.1.1',
             'password': 'password123',
             'color': '#FF0000'
         },
-        'example_url_request': '/control_device?control_type=change_led_color&ip_address=192.168.1.1&password=password123&color=%233cec51#3cec51'
+        'example_url_request': '/control_device?control_type=change_led_color&ip_address=192.168.1.1&password=password123&color=%233cec51#3cec51',
+        'bulk_endpoint': {
+            'endpoint': '/control_devices',
+            'methods': ['POST'],
+            'description': 'Send the same command to many devices with one JSON request. Give the control_type and its parameters, plus either targets (a list of objects with ip_address and password) or cidr (an IP range such as 192.168.1.0/24) with passwords (mapping each IP address to its password) or a single password. Returns the result for each target.',
+            'example_body': {
+                'control_type': 'change_led_color',
+                'color': '#FF0000',
+                'targets': [
+                    {'ip_address': '192.168.1.1', 'password': 'password123'},
+                    {'ip_address': '192.168.1.2', 'password': 'letmein'}
+                ]
+            }
+        }
     }
     return jsonify(commands)
 
-@app.route('/control_device', methods=['GET', 'POST'])
+@routes.route('/control_device', methods=['GET', 'POST'])
 def control_device():
     # Normal GET request, just render the page
     if request.method == 'GET' and not request.args:
         return render_template('control_device.html')
-    # Get the form data from either GET
-    if request.method == 'GET' and request.args:
-        device_ip = request.args.get('ip_address')
-        password = request.args.get('password')
-        control_type = request.args.get('control_type')
-    # Get the form data from POST
-    elif request.method == 'POST':
-        # Get the form data
-        device_ip = request.form.get('ip_address')
-        password = request.form.get('password')
-        control_type = request.form.get('control_type')
-    # Invalid request method
-    else:
-        return jsonify({'error': 'Invalid request method'}), 400
-    # Return if any of the parameters are missing
-    if not device_ip or not password or not control_type:
-        return jsonify({'error': 'Missing parameters'}), 400
-    
-    print(f"Device IP: {device_ip}, Password: {password}, Control Type: {control_type}")
-    # Ensure password matches hash in database
-    redis_key = f"device:{device_ip}"
-    device_data = redis_client.get(redis_key)
-    if not device_data:
-        return jsonify({'error': 'Device not found'}), 400
-    
-    device_data = json.loads(device_data)
-    hashed_password = device_data.get('password')
-    if not hashed_password:
-        return jsonify({'error': 'Device not found'}), 400
+    # Get the form data from either GET or POST
+    params = request.args if request.method == 'GET' else request.form
+    status, message, control_request = parse_control_device_request(params, request.remote_addr, SOURCE_RATE_LIMIT, DEVICE_RATE_LIMIT)
+    if not status:
+        return jsonify({'error': message}), 400
+    device_ip, control_type = control_request['device_ip'], control_request['control_type']
+
+    # Pace password guesses before looking up the device
+    status, retry_after = device_store.check_rate_limit(control_request['buckets'])
+    if not status:
+        log_event('rate_limited', source_ip=request.remote_addr, device_ip=device_ip, control_type=control_type)
+        return jsonify({'error': 'Too many requests'}), 429, {'Retry-After': str(retry_after)}
+
+    # Ensure password matches hash in database, answering repeated guesses from the credential cache,
+    # then check control type and build the command
+    hashed_password = device_store.get_password_hash(device_ip)
+    status, message, command_data = authorize_device_command(control_request, hashed_password, params, request.remote_addr)
+    if not status:
+        return jsonify({'error': message}), 400
     
-    # Compare the password with the hash in the database
-    hashed_input_password = hashlib.md5(password.encode()).hexdigest()
-    if hashed_input_password != hashed_password:
-        return jsonify({'error': 'Invalid password'}), 400
-
-    # Ensure ip address is in IP format with regex
-    ip_regex = re.compile(r'^((25[0-5]|(2[0-4]|1\d|[1-9]|)\d)\.?\b){4}$')
-    if not ip_regex.match(device_ip):
-        print("Invalid IP address format")
-        return jsonify({'error': 'Invalid IP address format'}), 400  
-
-    # Check control type and execute the command
-    if control_type == 'change_led_color':
-        # Get the color parameter
-        if request.method == 'GET':
-            color_hex = request.args.get('color')
-        elif request.method == 'POST':
-            color_hex = request.form.get('color')
-        if not color_hex:
-            return jsonify({'error': 'Missing color parameter'}), 400
-        
-        # Convert the color value to R, G, B format
-        r = int(color_hex[1:3], 16)
-        g = int(color_hex[3:5], 16)
-        b = int(color_hex[5:7], 16)
-
-        # Ensure RGB values are within the range of 0 to 255
-        r = max(0, min(r, 255))
-        g = max(0, min(g, 255))
-        b = max(0, min(b, 255))
-
-        # Save the command in Redis for the given device
-        command_data = {
-            'command': 'change_led_color',
-            'params': {'r': r, 'g': g, 'b': b}
-        }
-    elif control_type == 'change_password':
-        # Get the new password parameter
-        if request.method == 'GET':
-            new_password = request.args.get('new_password')
-        elif request.method == 'POST':
-            new_password = request.form.get('new_password')
-        if not new_password:
-            return jsonify({'error': 'Missing new password parameter'}), 400
-        
-        # Hash the new password
-        status, message, hashed_new_password = update_password(device_ip, new_password, redis_client)
+    # Only the latest color change matters, so it replaces any color change still waiting.
+    # The hash is checked again by the store as the command is queued, in case the cached one is stale.
+    status, message = device_store.queue_device_command(device_ip, command_data, MAX_QUEUED_COMMANDS, coalesce=COMMANDS[control_type]['coalesce'], password_hash=hashed_password)
+    if not status:
+        if error_status_code(message) == 400:
+            device_store.invalidate_password_hash(device_ip)
+        return jsonify({'error': message}), error_status_code(message)
+
+    # Only change the password once the command is queued, so the device always learns the new password
+    if control_type == 'change_password':
+        status, message, hashed_new_password = device_store.update_password(device_ip, command_data['params']['new_password'])
         if not status:
             return jsonify({'error': message}), 400
-        
-        # Save the command in Redis for the given device
-        command_data = {
-            'command': 'change_password',
-            'params': {'new_password': new_password}
-        }
-    elif control_type == 'display_password':
-        # Save the command in Redis for the given device
-        command_data = {
-            'command': 'display_password',
-            'params': {}
-        }
-    elif control_type == 'hide_password':
-        # Save the command in Redis for the given device
-        command_data = {
-            'command': 'hide_password',
-            'params': {}
-        }
-    elif control_type == 'rickroll':
-        # Save the command in Redis for the given device
-        command_data = {
-            'command': 'rickroll',
-            'params': {}
-        }
-    else:
-        return jsonify({'error': 'Invalid control type'}), 400
-    
-    redis_client.set(f"device_command:{device_ip}", json.dumps(command_data))
 
+    log_event('device_command', source_ip=request.remote_addr, device_ip=device_ip, control_type=control_type)
     return jsonify({'status': 'success'}), 200
 
-@app.route('/get_credentials', methods=['GET'])
+@routes.route('/control_devices', methods=['POST'])
+def control_devices():
+    """
+    Send the same command to many devices at once.
+    Expects a JSON body with control_type and the command parameters, plus the targets as either:
+    - targets: List of objects with the ip_address and password of each device.
+    - cidr: Range of IP addresses (e.g. 192.168.1.0/24), with passwords mapping each IP address
+      to its password, or a single password shared by every device.
+    An admin_token matching the ADMIN_TOKEN setting may be sent instead of the device passwords.
+    Returns:
+        JSON: JSON object with the result of the command for each target.
+    """
+    status, message, bulk_request = parse_bulk_request(request.get_json(silent=True), request.remote_addr, MAX_BULK_TARGETS, ADMIN_TOKEN, SOURCE_RATE_LIMIT, DEVICE_RATE_LIMIT)
+    if not status:
+        return jsonify({'error': message}), error_status_code(message)
+    control_type, command_data, is_admin, results = bulk_request['control_type'], bulk_request['command_data'], bulk_request['is_admin'], bulk_request['results']
+
+    # Pace password guesses before looking up the devices
+    status, retry_after = device_store.check_rate_limit(bulk_request['buckets'])
+    if not status:
+        return jsonify({'error': 'Too many requests'}), 429, {'Retry-After': str(retry_after)}
+
+    # Check every password against the hashes in the database, fetched in one round trip
+    password_hashes = device_store.get_device_password_hashes(bulk_request['device_ips'])
+    authorized_ips = authorize_targets(bulk_request['passwords'], password_hashes, is_admin, results)
+
+    # Queue the command for every authorized device in one transaction
+    queued_ips = []
+    if authorized_ips:
+        # Devices whose password changed since it was checked are skipped, unless sent by an admin
+        queue_results = device_store.queue_device_commands(authorized_ips, command_data, MAX_QUEUED_COMMANDS, coalesce=COMMANDS[control_type]['coalesce'], password_hashes=None if is_admin else password_hashes)
+        queued_ips = record_results(results, queue_results)
+
+    # Only change the passwords once the commands are queued, so the devices always learn the new password
+    if control_type == 'change_password' and queued_ips:
+        password_results = device_store.update_device_passwords(queued_ips, command_data['params']['new_password'])
+        record_results(results, password_results, success=False)
+
+    log_event('bulk_command', source_ip=request.remote_addr, control_type=control_type, targets=len(bulk_request['passwords']), queued=len(queued_ips), admin=is_admin)
+
+    return jsonify({'results': results}), 200
+
+@routes.route('/get_credentials', methods=['GET'])
 def get_credentials():
     # Check if the IP address is in the DB
     device_ip = request.remote_addr
-    redis_key = f"device:{device_ip}"
- 
-    device_data = redis_client.get(redis_key)
+    binary = wants_binary(request.args.get('format'), request.headers.get('Accept'))
+    device_data = device_store.get_device_data(device_ip)
     
+    if device_data:
+        # Update the last seen time
+        status, message = device_store.update_last_seen(device_ip)
+        if not status:
+            if message != "Device not found":
+                return jsonify({'error': message}), 400
+            # Device expired since it was read, e.g. a legacy record already past its timeout, which is
+            # deleted as it is migrated, so it gets new credentials like any expired device
+            device_data = None
+
     if not device_data:
-        # Insert device into Redis
-        return insert_device_database(device_ip, redis_client)
-    
-    device_data = json.loads(device_data)
-    last_seen = device_data.get('last_seen')
-    if not last_seen:
-        return insert_device_database(device_ip, redis_client)
-    
-    time_now = get_current_utc_time()
-    last_seen = convert_string_time_to_datetime(str(last_seen))
-    
-    if (time_now - last_seen).total_seconds() > DEVICE_TIMEOUT_SECONDS:
-        # Remove device from Redis
-        status, message = remove_device_database(device_ip, redis_client)
+        # Device is new or has expired, so insert it into the store
+        status, message, password = device_store.insert_device(device_ip)
         if not status:
-            return jsonify({'error': message}), 400
-        # Insert new device into Redis
-        return insert_device_database(device_ip, redis_client)
+            return jsonify({'error': message}), 500
+        return credentials_response(device_ip, password, binary)
     
-    # Update the last seen time
-    update_last_seen(device_ip, redis_client)
-
-    # Get the password from the database
-    device_data = redis_client.get(redis_key)
-    device_data = json.loads(device_data)
+    # The password was already read with the rest of the device record
     password = device_data.get('raw_password')
     if not password:
         return jsonify({'error': 'Device not found'}), 400
-    return jsonify({'ip_address': device_ip, 'password': password}), 200
+    return credentials_response(device_ip, password, binary)
+
+def credentials_response(device_ip, password, binary):
+    """
+    Build the response sending a device its credentials.
+    Parameters:
+    - device_ip: The IP address of the device.
+    - password: The password of the device.
+    - binary: True to use the compact binary format, False for JSON.
+    Returns:
+        Response: The credentials in the requested format.
+    """
+    if binary:
+        return Response(encode_credentials(device_ip, password), mimetype=BINARY_MIMETYPE)
+    return jsonify({'ip_address': device_ip, 'password': password})
 
-@app.route('/poll_commands', methods=['GET'])
+@routes.route('/poll_commands', methods=['GET'])
 def poll_commands():
     # Get IP address of the device
     device_ip = request.remote_addr
-    # Ensure that device is in the DB and update last seen time
-    status, message, dict_response = ensure_device_active(device_ip, DEVICE_TIMEOUT_SECONDS, redis_client)
+    binary = wants_binary(request.args.get('format'), request.headers.get('Accept'))
+    # Only pop as many commands as the binary format can always deliver, since popped commands can't go back
+    wait_seconds, batch_size, max_commands = get_poll_options(request.args, MAX_POLL_WAIT_SECONDS, min(MAX_POLL_BATCH_SIZE, MAX_BINARY_BATCH_SIZE) if binary else MAX_POLL_BATCH_SIZE)
+    # Check the device is active, update last seen time and pop its commands in one round trip
+    status, message, queued_commands = device_store.poll_device(device_ip, max_commands)
     if not status:
-        return jsonify({'error': message}), 400
-    if dict_response:
-        return dict_response
-    
-    # Get the command from the DB
-    command_data_json = redis_client.get(f"device_command:{device_ip}")
-    # Return None if no command is found
-    if not command_data_json:
-        return jsonify({'command': None})
-    
-    command_data = json.loads(command_data_json)
-    commands = {'command': None} # Set default command to None
-    
-    if command_data["command"] == 'change_led_color':
-        commands = {'command': command_data["command"], 'r': command_data["params"]["r"], 'g': command_data["params"]["g"], 'b': command_data["params"]["b"]}
-    elif command_data["command"] == 'change_password':
-        commands = {'command': command_data["command"], 'new_password': command_data["params"]["new_password"]}
-    elif command_data["command"] == 'rickroll':
-        commands = {'command': command_data["command"]}
-    elif command_data["command"] == 'display_password':
-        commands = {'command': command_data["command"]}
-    elif command_data["command"] == 'hide_password':
-        commands = {'command': command_data["command"]}
-    else:
-        return jsonify({'error': 'Invalid command'}), 400
-    
-    # Update last hacked time
-    update_last_seen(device_ip, redis_client, last_hacked=True)
+        if message != "Device not found":
+            return jsonify({'error': message}), 400
+        # Device has expired, so insert it as a new device
+        status, message, password = device_store.insert_device(device_ip)
+        if not status:
+            return jsonify({'error': message}), 500
+        CREDENTIAL_REISSUES.labels('/poll_commands').inc()
+        return credentials_response(device_ip, password, binary)
 
-    # Delete the command from the DB
-    redis_client.delete(f"device_command:{device_ip}")
+    # Wait for a command to be queued if the device asked for a long poll
+    if not queued_commands and wait_seconds and device_store.wait_for_device_command(device_ip, wait_seconds):
+        status, message, queued_commands = device_store.poll_device(device_ip, max_commands)
+        if not status:
+            return jsonify({'error': message}), 400
 
-    return jsonify(commands)
+    if binary:
+        # Compact binary format always carries a list of commands
+        return Response(encode_commands(queued_commands), mimetype=BINARY_MIMETYPE)
+
+    body, status_code = format_poll_commands(queued_commands, batch_size)
+    return jsonify(body), status_code
     
 
 # @app.route('/confirm_command', methods=['GET'])
@@ -314,11 +450,11 @@ def poll_commands():
 
 #     return jsonify({'status': 'success'})
 
-@app.route('/list_view', methods=['GET'])
+@routes.route('/list_view', methods=['GET'])
 def list_view():
     # Collect all endpoints
     endpoints = []
-    for rule in app.url_map.iter_rules():
+    for rule in current_app.url_map.iter_rules():
         if rule.endpoint != 'static':  # Exclude static files
             endpoints.append({
                 'endpoint': rule.endpoint,
@@ -386,48 +522,95 @@ def list_view():
 #     # Render page that shows the info they want.
 #     return render_template('admin.html', device_ip=device_ip, password=password)
 
-@app.route('/admin', methods=['GET'])
+@routes.route('/admin', methods=['GET'])
 def admin():
-    # Get all device keys from Redis
-    device_keys = redis_client.keys('device:*')
-    if not device_keys:
+    # Get the page and sort order from the query string
+    page, per_page, sort_by = get_admin_options(request.args, ADMIN_DEVICES_PER_PAGE, ADMIN_MAX_DEVICES_PER_PAGE)
+
+    # Get one page of active devices from the device index
+    devices, total = device_store.list_devices(page, per_page, sort_by)
+    if not devices:
         flash("No devices found")
-        return render_template('admin.html', devices={})
-    
-    devices = []
-    for key in device_keys:
-        device_data = redis_client.get(key)
-        if device_data:
-            device_data = json.loads(device_data)
-            key = str(key)
-            ip_address = key.split(':')
-            if not ip_address:
-                continue
-            ip_address = ip_address[1].replace("'", "")
-            # Remove inactive devices
-            status, message = check_last_seen(ip_address, DEVICE_TIMEOUT_SECONDS, redis_client)
-            if not status:
-                # Remove device from Redis
-                status, message = remove_device_database(ip_address, redis_client)
-                continue
-            # Prepare device data
-            device_info = {
-                'ip_address': ip_address,
-                'password_hash': device_data.get('password'),
-                'last_hacked_time': device_data.get('last_hacked_time', 'N/A')
-            }
-            devices.append(device_info)
-    
+
+    # Prepare device data
+    total_pages = prepare_admin_devices(devices, total, per_page)
+
     # Render page that shows the info they want.
-    return render_template('admin.html', devices=devices)
+    return render_template('admin.html', devices=devices, page=page, per_page=per_page, sort_by=sort_by, total_pages=total_pages)
+
+@routes.route('/leaderboard', methods=['GET'])
+def leaderboard():
+    """
+    Get the most hacked devices and the most successful hackers, counted over every delivered command.
+    Returns:
+        JSON: JSON object with hacked_devices and hackers, each a list of objects with the ip_address
+        and its number of hacks, most hacks first.
+    """
+    limit = min(max(get_int_arg(request.args, 'limit', LEADERBOARD_SIZE), 1), MAX_LEADERBOARD_SIZE)
+    return jsonify(device_store.get_leaderboards(limit))
 
-@app.route('/about', methods=['GET'])
+@routes.route('/hack_events', methods=['GET'])
+def hack_events():
+    """
+    Replay the delivered commands after a cursor, oldest first. Pass the returned cursor back to get
+    the next events, or 0 (the default) to start from the oldest event still kept.
+    Returns:
+        JSON: JSON object with the events, each with its id, ip_address, command, source_ip and time,
+        and the cursor to continue from.
+    """
+    cursor, limit = get_hack_event_options(request.args, HACK_EVENTS_PER_PAGE, MAX_HACK_EVENTS_PER_PAGE)
+    if cursor is None:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    events, cursor = device_store.read_hack_events(cursor, limit)
+    return jsonify({'events': events, 'cursor': cursor})
+
+@routes.route('/admin/events', methods=['GET'])
+def admin_events():
+    """
+    Stream the device events to a live admin dashboard.
+    Returns:
+        Response: Server-sent events with a JSON object for each device that joined, expired, was removed,
+        was hacked or had its password changed.
+    """
+    viewer = LiveEventViewer()
+    if not add_viewer(viewer, current_app.config['LIVE_EVENTS_MAX_VIEWERS']):
+        return jsonify({'error': 'Too many live dashboards, reload the page instead'}), 503, {'Retry-After': '30'}
+    response = Response(stream_live_events(viewer, current_app.config['LIVE_EVENTS_MAX_SECONDS']), mimetype='text/event-stream')
+    # Stop proxies from buffering or caching the stream
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    # A stream closed before it started never reaches its own cleanup
+    response.call_on_close(lambda: remove_viewer(viewer))
+    return response
+
+@routes.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Get the server metrics.
+    Returns:
+        Response: Request, Redis and fleet metrics in the Prometheus text format.
+    """
+    return Response(generate_metrics(), mimetype=METRICS_CONTENT_TYPE)
+
+@routes.route('/about', methods=['GET'])
 def about():
     return render_template('about.html')
 
-@app.route('/robots.txt', methods=['GET'])
+@routes.route('/robots.txt', methods=['GET'])
 def robots():
-    return send_from_directory(app.static_folder, "robots.txt")
+    return send_from_directory(current_app.static_folder, "robots.txt")
+
+@routes.cli.command('migrate-devices')
+def migrate_devices():
+    """
+    One-shot migration of devices stored as JSON strings to the Redis hash layout,
+    giving every device an expiry.
+    """
+    migrated = device_store.migrate_devices()
+    print(f"Migrated {migrated} devices")
+
+app = create_app()
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Development server only, run gunicorn with gunicorn.conf.py in production
+    app.run(host='0.0.0.0', port=5000, debug=app.config['DEBUG'])
@@ -0,0 +1,242 @@
+"""
+Asyncio serving mode for the badge control server.
+
+Run it on an ASGI server, e.g. from the server directory:
+    uvicorn asgi:app --host 0.0.0.0 --port 5000 --proxy-headers --forwarded-allow-ips '*'
+or on every core with `BADGE_SERVER_MODE=asgi gunicorn -c gunicorn.conf.py`.
+
+The badge and control endpoints are served natively through an AsyncRedisDeviceStore on redis.asyncio, so a
+waiting long poll costs a coroutine instead of a worker thread. They validate requests with the same
+helpers as the Flask routes, and need STORAGE_BACKEND=redis so both share the same devices. Every other
+route falls through to the Flask app, which still runs on its own with `python app.py` for local development.
+"""
+import contextlib
+import redis.asyncio
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from flask import flash, render_template
+from app import app as flask_app, create_redis_clients, SOURCE_RATE_LIMIT, DEVICE_RATE_LIMIT, DEVICE_TIMEOUT_SECONDS, MAX_BULK_TARGETS, MAX_POLL_WAIT_SECONDS, MAX_POLL_BATCH_SIZE, MAX_QUEUED_COMMANDS, ADMIN_DEVICES_PER_PAGE, ADMIN_MAX_DEVICES_PER_PAGE, ADMIN_TOKEN
+from helper_functions.storage_async import check_async_backend, create_async_device_store
+from helper_functions.commands import COMMANDS
+from helper_functions.wire_format import wants_binary, encode_commands, encode_credentials, BINARY_MIMETYPE, MAX_BINARY_BATCH_SIZE
+from helper_functions.event_log import log_event
+from helper_functions.live_events import AsyncLiveEventViewer, add_viewer, stream_live_events_async
+from helper_functions.metrics import InstrumentedAsyncRedis, instrument_async_endpoint, CREDENTIAL_REISSUES
+from helper_functions.route_helpers import get_poll_options, format_poll_commands, parse_control_device_request, authorize_device_command, parse_bulk_request, error_status_code, authorize_targets, record_results, get_admin_options, prepare_admin_devices
+
+FLASK_WSGI_THREADS = 10 # Worker threads for the routes that fall through to the Flask app
+
+# Initialize the asyncio device store, on a Redis client with the same settings as the Flask app's.
+# Refuse any other backend before connecting, since its devices could not be shared with the Flask app.
+check_async_backend(flask_app.config['STORAGE_BACKEND'])
+redis_pools, redis_client = create_redis_clients(flask_app.config, redis.asyncio.ConnectionPool, InstrumentedAsyncRedis)
+device_store = create_async_device_store(flask_app.config['STORAGE_BACKEND'], DEVICE_TIMEOUT_SECONDS, redis_client)
+
+def render_flask_template(request, template_name, messages=(), **context):
+    """
+    Render one of the Flask app's templates, so url_for, flash and the static files work as they do in Flask.
+    Parameters:
+    - request: The Starlette request object.
+    - template_name: The name of the template.
+    - messages: Messages to flash on the page.
+    - context: The variables passed to the template.
+    Returns:
+        HTMLResponse: The rendered page.
+    """
+    with flask_app.test_request_context(request.url.path, query_string=request.url.query, headers=request.headers.items()):
+        for message in messages:
+            flash(message)
+        return HTMLResponse(render_template(template_name, **context))
+
+def credentials_response(device_ip, password, binary):
+    """
+    Build the response sending a device its credentials.
+    Parameters:
+    - device_ip: The IP address of the device.
+    - password: The password of the device.
+    - binary: True to use the compact binary format, False for JSON.
+    Returns:
+        Response: The credentials in the requested format.
+    """
+    if binary:
+        return Response(encode_credentials(device_ip, password), media_type=BINARY_MIMETYPE)
+    return JSONResponse({'ip_address': device_ip, 'password': password})
+
+async def get_credentials(request):
+    device_ip = request.client.host
+    binary = wants_binary(request.query_params.get('format'), request.headers.get('accept'))
+    device_data = await device_store.get_device_data(device_ip)
+
+    if device_data:
+        # Update the last seen time
+        status, message = await device_store.update_last_seen(device_ip)
+        if not status:
+            if message != "Device not found":
+                return JSONResponse({'error': message}, 400)
+            # Device expired since it was read, e.g. a legacy record already past its timeout, which is
+            # deleted as it is migrated, so it gets new credentials like any expired device
+            device_data = None
+
+    if not device_data:
+        # Device is new or has expired, so insert it into the store
+        status, message, password = await device_store.insert_device(device_ip)
+        if not status:
+            return JSONResponse({'error': message}, 500)
+        return credentials_response(device_ip, password, binary)
+
+    # The password was already read with the rest of the device record
+    password = device_data.get('raw_password')
+    if not password:
+        return JSONResponse({'error': 'Device not found'}, 400)
+    return credentials_response(device_ip, password, binary)
+
+async def poll_commands(request):
+    device_ip = request.client.host
+    binary = wants_binary(request.query_params.get('format'), request.headers.get('accept'))
+    # Only pop as many commands as the binary format can always deliver, since popped commands can't go back
+    wait_seconds, batch_size, max_commands = get_poll_options(request.query_params, MAX_POLL_WAIT_SECONDS, min(MAX_POLL_BATCH_SIZE, MAX_BINARY_BATCH_SIZE) if binary else MAX_POLL_BATCH_SIZE)
+    # Watch for new commands before polling, so one queued in between still wakes the long poll
+    with device_store.watch_device_commands(device_ip) as wakeup:
+        # Check the device is active, update last seen time and pop its commands in one round trip
+        status, message, queued_commands = await device_store.poll_device(device_ip, max_commands)
+        if not status:
+            if message != "Device not found":
+                return JSONResponse({'error': message}, 400)
+            # Device has expired, so insert it as a new device
+            status, message, password = await device_store.insert_device(device_ip)
+            if not status:
+                return JSONResponse({'error': message}, 500)
+            CREDENTIAL_REISSUES.labels('/poll_commands').inc()
+            return credentials_response(device_ip, password, binary)
+
+        # Wait for a command to be queued if the device asked for a long poll
+        if not queued_commands and wait_seconds and await device_store.wait_for_device_command(device_ip, wakeup, wait_seconds):
+            status, message, queued_commands = await device_store.poll_device(device_ip, max_commands)
+            if not status:
+                return JSONResponse({'error': message}, 400)
+
+    if binary:
+        # Compact binary format always carries a list of commands
+        return Response(encode_commands(queued_commands), media_type=BINARY_MIMETYPE)
+    body, status_code = format_poll_commands(queued_commands, batch_size)
+    return JSONResponse(body, status_code)
+
+async def control_device(request):
+    # Normal GET request, just render the page
+    if request.method == 'GET' and not request.query_params:
+        return render_flask_template(request, 'control_device.html')
+    params = request.query_params if request.method == 'GET' else await request.form()
+    status, message, control_request = parse_control_device_request(params, request.client.host, SOURCE_RATE_LIMIT, DEVICE_RATE_LIMIT)
+    if not status:
+        return JSONResponse({'error': message}, 400)
+    device_ip, control_type = control_request['device_ip'], control_request['control_type']
+
+    # Pace password guesses before looking up the device
+    status, retry_after = await device_store.check_rate_limit(control_request['buckets'])
+    if not status:
+        log_event('rate_limited', source_ip=request.client.host, device_ip=device_ip, control_type=control_type)
+        return JSONResponse({'error': 'Too many requests'}, 429, {'Retry-After': str(retry_after)})
+
+    # Ensure password matches hash in database, answering repeated guesses from the credential cache,
+    # then check control type and build the command
+    hashed_password = await device_store.get_password_hash(device_ip)
+    status, message, command_data = authorize_device_command(control_request, hashed_password, params, request.client.host)
+    if not status:
+        return JSONResponse({'error': message}, 400)
+
+    # The hash is checked again by the store as the command is queued, in case the cached one is stale
+    status, message = await device_store.queue_device_command(device_ip, command_data, MAX_QUEUED_COMMANDS, coalesce=COMMANDS[control_type]['coalesce'], password_hash=hashed_password)
+    if not status:
+        if error_status_code(message) == 400:
+            device_store.invalidate_password_hash(device_ip)
+        return JSONResponse({'error': message}, error_status_code(message))
+
+    # Only change the password once the command is queued, so the device always learns the new password
+    if control_type == 'change_password':
+        status, message, hashed_new_password = await device_store.update_password(device_ip, command_data['params']['new_password'])
+        if not status:
+            return JSONResponse({'error': message}, 400)
+
+    log_event('device_command', source_ip=request.client.host, device_ip=device_ip, control_type=control_type)
+    return JSONResponse({'status': 'success'})
+
+async def control_devices(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    status, message, bulk_request = parse_bulk_request(data, request.client.host, MAX_BULK_TARGETS, ADMIN_TOKEN, SOURCE_RATE_LIMIT, DEVICE_RATE_LIMIT)
+    if not status:
+        return JSONResponse({'error': message}, error_status_code(message))
+    control_type, command_data, is_admin, results = bulk_request['control_type'], bulk_request['command_data'], bulk_request['is_admin'], bulk_request['results']
+
+    # Pace password guesses before looking up the devices
+    status, retry_after = await device_store.check_rate_limit(bulk_request['buckets'])
+    if not status:
+        return JSONResponse({'error': 'Too many requests'}, 429, {'Retry-After': str(retry_after)})
+
+    # Check every password against the hashes in the database, fetched in one round trip
+    password_hashes = await device_store.get_device_password_hashes(bulk_request['device_ips'])
+    authorized_ips = authorize_targets(bulk_request['passwords'], password_hashes, is_admin, results)
+
+    # Queue the command for every authorized device in one transaction
+    queued_ips = []
+    if authorized_ips:
+        # Devices whose password changed since it was checked are skipped, unless sent by an admin
+        queue_results = await device_store.queue_device_commands(authorized_ips, command_data, MAX_QUEUED_COMMANDS, coalesce=COMMANDS[control_type]['coalesce'], password_hashes=None if is_admin else password_hashes)
+        queued_ips = record_results(results, queue_results)
+
+    # Only change the passwords once the commands are queued, so the devices always learn the new password
+    if control_type == 'change_password' and queued_ips:
+        password_results = await device_store.update_device_passwords(queued_ips, command_data['params']['new_password'])
+        record_results(results, password_results, success=False)
+
+    log_event('bulk_command', source_ip=request.client.host, control_type=control_type, targets=len(bulk_request['passwords']), queued=len(queued_ips), admin=is_admin)
+
+    return JSONResponse({'results': results})
+
+async def admin(request):
+    # Get the page and sort order from the query string
+    page, per_page, sort_by = get_admin_options(request.query_params, ADMIN_DEVICES_PER_PAGE, ADMIN_MAX_DEVICES_PER_PAGE)
+
+    # Get one page of active devices from the device index
+    devices, total = await device_store.list_devices(page, per_page, sort_by)
+    total_pages = prepare_admin_devices(devices, total, per_page)
+
+    messages = [] if devices else ["No devices found"]
+    return render_flask_template(request, 'admin.html', messages, devices=devices, page=page, per_page=per_page, sort_by=sort_by, total_pages=total_pages)
+
+async def admin_events(request):
+    # Waiting streams cost a coroutine rather than a thread, so there is no limit on the viewers
+    viewer = AsyncLiveEventViewer()
+    add_viewer(viewer)
+    stream = stream_live_events_async(viewer, flask_app.config['LIVE_EVENTS_MAX_SECONDS'])
+    return StreamingResponse(stream, media_type='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    device_store.start()
+    yield
+    await device_store.stop()
+    for redis_pool in redis_pools:
+        await redis_pool.disconnect()
+
+app = Starlette(
+    routes=[
+        Route('/get_credentials', instrument_async_endpoint(get_credentials), methods=['GET']),
+        Route('/poll_commands', instrument_async_endpoint(poll_commands), methods=['GET']),
+        Route('/control_device', instrument_async_endpoint(control_device), methods=['GET', 'POST']),
+        Route('/control_devices', instrument_async_endpoint(control_devices), methods=['POST']),
+        Route('/admin', instrument_async_endpoint(admin), methods=['GET']),
+        Route('/admin/events', instrument_async_endpoint(admin_events), methods=['GET']),
+        # Everything else is served by the Flask app, including /metrics
+        Mount('/', app=WSGIMiddleware(flask_app, workers=FLASK_WSGI_THREADS))
+    ],
+    lifespan=lifespan
+)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=5000)
@@ -0,0 +1,625 @@
+"""
+Benchmarks for the Redis hot paths of the badge control server.
+
+Drives every route in app.py, every helper in helper_functions/device.py and the hot paths of the
+in-memory device store, and reports for each operation its latency percentiles and the Redis commands,
+round trips and bytes it sends. Results
+are compared with a saved baseline, and the run fails if an operation now sends more Redis commands
+or its p99 latency grew beyond the tolerance.
+
+Usage, from the server directory:
+    python benchmarks/run_benchmarks.py                     # in-process fakeredis stand-in
+    python benchmarks/run_benchmarks.py --redis-url redis://localhost:6379/15
+    python benchmarks/run_benchmarks.py --save-baseline     # record the current results as the baseline
+    python benchmarks/run_benchmarks.py --only poll         # only run benchmarks whose name contains "poll"
+
+The stand-in needs `pip install fakeredis`. With --redis-url, use a database holding nothing else,
+because it is flushed between benchmarks. Command counts are the same on every machine, but latency
+is not, so save a baseline on the machine you compare on. Latency is only compared when the backend
+matches the one the baseline was saved with.
+"""
+import argparse
+import contextlib
+import gc
+import json
+import math
+import os
+import sys
+import time
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+os.chdir(SERVER_DIR)
+# Keep the app from listening for device events on the real Redis, the benchmarks start their own listener
+os.environ['CREDENTIAL_CACHE_SIZE'] = '0'
+
+import redis
+import app as app_module
+from helper_functions import device
+from helper_functions import credential_cache
+from helper_functions import event_log
+from helper_functions.storage import RedisDeviceStore, MemoryDeviceStore
+from helper_functions.commands import build_command
+
+BASELINE_FILE = os.path.join(SERVER_DIR, 'benchmarks', 'baseline.json')
+DEVICE_TIMEOUT_SECONDS = app_module.DEVICE_TIMEOUT_SECONDS
+BULK_TARGETS = 50 # Devices targeted by the bulk benchmarks
+ADMIN_TOKEN = 'benchmark-admin-token'
+SECRET_KEY = 'benchmark-secret-key' # Lets the routes flash messages
+RATE_LIMIT = (10 ** 9, 10 ** 9) # Checked on every guess, but never reached
+RATE_LIMITED_IP = '192.0.2.1'
+CREDENTIAL_CACHE_SIZE = 4096
+
+class RedisStats:
+    """
+    Redis traffic sent by every connection since the last reset.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.commands = 0
+        self.round_trips = 0
+        self.bytes_sent = 0
+
+REDIS_STATS = RedisStats()
+
+class CountingConnectionMixin:
+    """
+    Counts the commands, round trips and bytes a Redis connection sends.
+    """
+    def send_command(self, *args, **kwargs):
+        REDIS_STATS.commands += 1
+        return super().send_command(*args, **kwargs)
+
+    def pack_commands(self, commands):
+        commands = list(commands)
+        REDIS_STATS.commands += len(commands)
+        return super().pack_commands(commands)
+
+    def send_packed_command(self, command, check_health=True):
+        REDIS_STATS.round_trips += 1
+        chunks = [command] if isinstance(command, (bytes, str, memoryview)) else command
+        REDIS_STATS.bytes_sent += sum(len(chunk) for chunk in chunks)
+        return super().send_packed_command(command, check_health)
+
+def create_redis_client(redis_url):
+    """
+    Create a Redis client whose connections count the traffic they send.
+    Parameters:
+    - redis_url: URL of the Redis database to use, or None for the in-process fakeredis stand-in.
+    Returns:
+    - redis_client: The Redis client object.
+    - backend: Name of the backend, stored with the baseline.
+    """
+    if redis_url:
+        connection_class = type('CountingConnection', (CountingConnectionMixin, redis.Connection), {})
+        pool = redis.ConnectionPool.from_url(redis_url, connection_class=connection_class)
+        return redis.Redis(connection_pool=pool), 'redis'
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("The fakeredis stand-in is not installed: pip install fakeredis, or pass --redis-url")
+    connection_class = type('CountingConnection', (CountingConnectionMixin, fakeredis.FakeRedisConnection), {})
+    return fakeredis.FakeRedis(server=fakeredis.FakeServer(), connection_class=connection_class), 'fakeredis'
+
+class BenchmarkContext:
+    """
+    State shared by the benchmarks: the Redis client, a Flask test client using it and an in-memory device store.
+    """
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.client = app_module.app.test_client()
+        self.memory_store = MemoryDeviceStore(DEVICE_TIMEOUT_SECONDS)
+
+    def device_ip(self, i):
+        # A different device for every iteration
+        return f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}"
+
+    def get(self, path, device_ip='127.0.0.1', expected_status=200, **kwargs):
+        return self._check_status(self.client.get(path, environ_base={'REMOTE_ADDR': device_ip}, **kwargs), path, expected_status)
+
+    def post(self, path, device_ip='127.0.0.1', expected_status=200, **kwargs):
+        return self._check_status(self.client.post(path, environ_base={'REMOTE_ADDR': device_ip}, **kwargs), path, expected_status)
+
+    def _check_status(self, response, path, expected_status):
+        # A benchmark timing an error page instead of the route would still look fine, so fail it
+        if response.status_code != expected_status:
+            raise AssertionError(f"{path} returned {response.status_code}, expected {expected_status}")
+        return response
+
+    def insert_device(self, device_ip):
+        status, message, raw_password = device.insert_device(device_ip, DEVICE_TIMEOUT_SECONDS, self.redis_client)
+        # The listener drops the device from the credential cache in the background, so drop it
+        # here too rather than let the next iteration depend on thread timing
+        credential_cache.invalidate_password_hash(device_ip)
+        return raw_password
+
+    def insert_devices(self, count):
+        return {self.device_ip(i): self.insert_device(self.device_ip(i)) for i in range(count)}
+
+    def queue_command(self, device_ip, control_type='rickroll', **params):
+        status, message, command_data = build_command(control_type, params)
+        device.queue_device_command(device_ip, command_data, DEVICE_TIMEOUT_SECONDS, self.redis_client, app_module.MAX_QUEUED_COMMANDS)
+        return command_data
+
+    def insert_legacy_device(self, device_ip):
+        device_data = {'password': 'e10adc3949ba59abbe56e057f20f883e', 'raw_password': '123456', 'last_seen': '2024-01-01 00:00:00'}
+        self.redis_client.set(f"device:{device_ip}", json.dumps(device_data))
+
+# Registered benchmarks as (name, setup, run). The setup runs before every iteration and is neither
+# timed nor counted. It gets the context and iteration number, and returns the state passed to run.
+BENCHMARKS = []
+
+def benchmark(name, setup=None):
+    """
+    Register a benchmark.
+    Parameters:
+    - name: The name of the benchmark, used as its key in the baseline.
+    - setup: Optional function preparing each iteration.
+    Returns:
+    - register: Decorator registering the function to time.
+    """
+    def register(run):
+        BENCHMARKS.append((name, setup, run))
+        return run
+    return register
+
+def setup_device(context, i):
+    device_ip = context.device_ip(i)
+    return device_ip, context.insert_device(device_ip)
+
+def setup_device_with_command(context, i):
+    device_ip, password = setup_device(context, i)
+    context.queue_command(device_ip)
+    return device_ip, password
+
+def setup_device_with_commands(context, i):
+    device_ip, password = setup_device(context, i)
+    context.queue_command(device_ip, 'change_led_color', color='#FF0000')
+    context.queue_command(device_ip, 'display_password')
+    context.queue_command(device_ip, 'rickroll')
+    return device_ip, password
+
+def setup_fleet(context, i):
+    # Same fleet for every iteration, since the fleet gauges read every active device
+    context.redis_client.flushdb()
+    devices = context.insert_devices(10)
+    context.queue_command(next(iter(devices)))
+    return devices
+
+def setup_bulk_devices(context, i):
+    return context.insert_devices(BULK_TARGETS)
+
+def setup_rate_limited(context, i):
+    # Empty the source bucket and date it in the future, so it never refills during the call
+    device_ip, password = setup_device(context, i)
+    context.redis_client.hset(f"rate_limit:source:{RATE_LIMITED_IP}", mapping={'tokens': 0, 'updated': 10 ** 15})
+    return device_ip, password
+
+def setup_cached_device(context, i):
+    # Same device for every iteration, with its password hash already in the credential cache
+    device_ip = context.device_ip(0)
+    if i == 0 or not credential_cache.get_cached_password_hash(device_ip)[0]:
+        context.insert_device(device_ip)
+        credential_cache.lookup_password_hash(device_ip, context.redis_client)
+    return device_ip
+
+def setup_memory_device(context, i):
+    device_ip = context.device_ip(i)
+    status, message, raw_password = context.memory_store.insert_device(device_ip)
+    return device_ip, raw_password
+
+def setup_memory_device_with_commands(context, i):
+    device_ip, password = setup_memory_device(context, i)
+    for control_type, params in (('change_led_color', {'color': '#FF0000'}), ('display_password', {}), ('rickroll', {})):
+        status, message, command_data = build_command(control_type, params)
+        context.memory_store.queue_device_command(device_ip, command_data)
+    return device_ip, password
+
+def setup_legacy_device(context, i):
+    device_ip = context.device_ip(i)
+    context.insert_legacy_device(device_ip)
+    return device_ip
+
+def setup_legacy_database(context, i):
+    context.redis_client.flushdb()
+    for j in range(10):
+        context.insert_legacy_device(context.device_ip(j))
+
+# Routes in app.py
+
+@benchmark('route index')
+def bench_index(context, i, state):
+    context.get('/')
+
+@benchmark('route get_commands')
+def bench_get_commands(context, i, state):
+    context.get('/get_commands')
+
+@benchmark('route list_view')
+def bench_list_view(context, i, state):
+    context.get('/list_view')
+
+@benchmark('route about')
+def bench_about(context, i, state):
+    context.get('/about')
+
+@benchmark('route robots')
+def bench_robots(context, i, state):
+    context.get('/robots.txt')
+
+@benchmark('route control_device page')
+def bench_control_device_page(context, i, state):
+    context.get('/control_device')
+
+@benchmark('route get_credentials new device')
+def bench_get_credentials_new(context, i, state):
+    context.get('/get_credentials', context.device_ip(i))
+
+@benchmark('route get_credentials known device', setup_device)
+def bench_get_credentials_known(context, i, state):
+    context.get('/get_credentials', state[0])
+
+@benchmark('route get_credentials binary', setup_device)
+def bench_get_credentials_binary(context, i, state):
+    context.get('/get_credentials?format=bin', state[0])
+
+@benchmark('route poll_commands expired device')
+def bench_poll_expired(context, i, state):
+    context.get('/poll_commands', context.device_ip(i))
+
+@benchmark('route poll_commands no command', setup_device)
+def bench_poll_empty(context, i, state):
+    context.get('/poll_commands', state[0])
+
+@benchmark('route poll_commands one command', setup_device_with_command)
+def bench_poll_command(context, i, state):
+    context.get('/poll_commands', state[0])
+
+@benchmark('route poll_commands batch', setup_device_with_commands)
+def bench_poll_batch(context, i, state):
+    context.get('/poll_commands?batch=5', state[0])
+
+@benchmark('route poll_commands binary batch', setup_device_with_commands)
+def bench_poll_binary(context, i, state):
+    context.get('/poll_commands?format=bin&batch=5', state[0])
+
+@benchmark('route poll_commands long poll woken', setup_device_with_command)
+def bench_poll_long(context, i, state):
+    context.get('/poll_commands?wait=5', state[0])
+
+@benchmark('route control_device change_led_color', setup_device)
+def bench_control_device_color(context, i, state):
+    device_ip, password = state
+    context.post('/control_device', data={'ip_address': device_ip, 'password': password, 'control_type': 'change_led_color', 'color': '#00FF00'})
+
+@benchmark('route control_device change_password', setup_device)
+def bench_control_device_password(context, i, state):
+    device_ip, password = state
+    context.post('/control_device', data={'ip_address': device_ip, 'password': password, 'control_type': 'change_password', 'new_password': 'hunter2'})
+
+@benchmark('route control_device invalid password', setup_device)
+def bench_control_device_invalid(context, i, state):
+    context.post('/control_device', data={'ip_address': state[0], 'password': 'wrong', 'control_type': 'rickroll'}, expected_status=400)
+
+@benchmark('route control_device cached invalid password', setup_cached_device)
+def bench_control_device_cached_invalid(context, i, state):
+    context.post('/control_device', data={'ip_address': state, 'password': 'wrong', 'control_type': 'rickroll'}, expected_status=400)
+
+@benchmark('route control_device rate limited', setup_rate_limited)
+def bench_control_device_rate_limited(context, i, state):
+    device_ip, password = state
+    context.post('/control_device', RATE_LIMITED_IP, data={'ip_address': device_ip, 'password': password, 'control_type': 'rickroll'}, expected_status=429)
+
+@benchmark('route control_devices targets', setup_bulk_devices)
+def bench_control_devices_targets(context, i, state):
+    targets = [{'ip_address': device_ip, 'password': password} for device_ip, password in state.items()]
+    context.post('/control_devices', json={'control_type': 'change_led_color', 'color': '#0000FF', 'targets': targets})
+
+@benchmark('route control_devices cidr admin', setup_bulk_devices)
+def bench_control_devices_cidr(context, i, state):
+    context.post('/control_devices', json={'control_type': 'change_password', 'new_password': 'hunter2', 'cidr': '10.0.0.0/26', 'admin_token': ADMIN_TOKEN})
+
+@benchmark('route metrics', setup_fleet)
+def bench_metrics(context, i, state):
+    context.get('/metrics')
+
+@benchmark('route admin', setup_device)
+def bench_admin(context, i, state):
+    context.get('/admin')
+
+@benchmark('route admin sorted by last hacked', setup_device_with_command)
+def bench_admin_hacked(context, i, state):
+    context.get('/admin?sort=last_hacked_time&per_page=20')
+
+# Helpers in helper_functions/device.py
+
+@benchmark('device insert_device')
+def bench_insert_device(context, i, state):
+    device.insert_device(context.device_ip(i), DEVICE_TIMEOUT_SECONDS, context.redis_client)
+
+@benchmark('device insert_device_database')
+def bench_insert_device_database(context, i, state):
+    with app_module.app.app_context():
+        device.insert_device_database(context.device_ip(i), DEVICE_TIMEOUT_SECONDS, context.redis_client)
+
+@benchmark('device remove_device_database', setup_device)
+def bench_remove_device(context, i, state):
+    device.remove_device_database(state[0], context.redis_client)
+
+@benchmark('device remove_device_from_indexes', setup_device)
+def bench_remove_from_indexes(context, i, state):
+    device.remove_device_from_indexes(state[0], context.redis_client)
+
+@benchmark('device prune_device_indexes', setup_device)
+def bench_prune_indexes(context, i, state):
+    device.prune_device_indexes(DEVICE_TIMEOUT_SECONDS, context.redis_client)
+
+@benchmark('device list_devices', setup_device)
+def bench_list_devices(context, i, state):
+    device.list_devices(DEVICE_TIMEOUT_SECONDS, context.redis_client)
+
+@benchmark('device get_device_password_hashes', setup_bulk_devices)
+def bench_password_hashes(context, i, state):
+    device.get_device_password_hashes(list(state), context.redis_client)
+
+@benchmark('device get_device_data', setup_device)
+def bench_get_device_data(context, i, state):
+    device.get_device_data(state[0], context.redis_client)
+
+@benchmark('device get_device_data legacy', setup_legacy_device)
+def bench_get_device_data_legacy(context, i, state):
+    device.get_device_data(state, context.redis_client)
+
+@benchmark('device migrate_device_record', setup_legacy_device)
+def bench_migrate_record(context, i, state):
+    device.migrate_device_record(state, DEVICE_TIMEOUT_SECONDS, context.redis_client)
+
+@benchmark('device migrate_device_database', setup_legacy_database)
+def bench_migrate_database(context, i, state):
+    device.migrate_device_database(DEVICE_TIMEOUT_SECONDS, context.redis_client)
+
+@benchmark('device update_device_fields', setup_device)
+def bench_update_fields(context, i, state):
+    device.update_device_fields(state[0], {'last_seen': 1700000000}, context.redis_client, DEVICE_TIMEOUT_SECONDS)
+
+@benchmark('device update_last_seen', setup_device)
+def bench_update_last_seen(context, i, state):
+    device.update_last_seen(state[0], DEVICE_TIMEOUT_SECONDS, context.redis_client)
+
+@benchmark('device update_last_seen legacy', setup_legacy_device)
+def bench_update_last_seen_legacy(context, i, state):
+    device.update_last_seen(state, DEVICE_TIMEOUT_SECONDS, context.redis_client)
+
+@benchmark('device generate_md5_password')
+def bench_generate_password(context, i, state):
+    device.generate_md5_password()
+
+@benchmark('device check_last_seen', setup_device)
+def bench_check_last_seen(context, i, state):
+    device.check_last_seen(state[0], DEVICE_TIMEOUT_SECONDS, context.redis_client)
+
+@benchmark('device ensure_device_active', setup_device)
+def bench_ensure_active(context, i, state):
+    device.ensure_device_active(state[0], DEVICE_TIMEOUT_SECONDS, context.redis_client)
+
+@benchmark('device poll_device', setup_device_with_commands)
+def bench_poll_device(context, i, state):
+    device.poll_device(state[0], DEVICE_TIMEOUT_SECONDS, context.redis_client, 5)
+
+@benchmark('device queue_device_command', setup_device)
+def bench_queue_command(context, i, state):
+    context.queue_command(state[0], 'change_led_color', color='#FF00FF')
+
+@benchmark('device queue_device_commands', setup_bulk_devices)
+def bench_queue_commands(context, i, state):
+    status, message, command_data = build_command('change_led_color', {'color': '#FFFF00'})
+    device.queue_device_commands(list(state), command_data, DEVICE_TIMEOUT_SECONDS, context.redis_client, app_module.MAX_QUEUED_COMMANDS, coalesce=True)
+
+@benchmark('device wait_for_device_command', setup_device_with_command)
+def bench_wait_for_command(context, i, state):
+    device.wait_for_device_command(state[0], 1, context.redis_client)
+
+@benchmark('device update_password', setup_device)
+def bench_update_password(context, i, state):
+    device.update_password(state[0], 'hunter2', context.redis_client)
+
+@benchmark('device update_device_passwords', setup_bulk_devices)
+def bench_update_passwords(context, i, state):
+    device.update_device_passwords(list(state), 'hunter2', context.redis_client)
+
+# In-memory device store in helper_functions/storage.py, which sends no Redis commands at all
+
+@benchmark('store memory insert_device')
+def bench_memory_insert_device(context, i, state):
+    context.memory_store.insert_device(context.device_ip(i))
+
+@benchmark('store memory get_password_hash', setup_memory_device)
+def bench_memory_password_hash(context, i, state):
+    context.memory_store.get_password_hash(state[0])
+
+@benchmark('store memory poll_device', setup_memory_device_with_commands)
+def bench_memory_poll_device(context, i, state):
+    context.memory_store.poll_device(state[0], 5)
+
+@benchmark('store memory queue_device_command', setup_memory_device)
+def bench_memory_queue_command(context, i, state):
+    status, message, command_data = build_command('change_led_color', {'color': '#FF00FF'})
+    context.memory_store.queue_device_command(state[0], command_data, app_module.MAX_QUEUED_COMMANDS, coalesce=True)
+
+@benchmark('store memory list_devices', setup_memory_device)
+def bench_memory_list_devices(context, i, state):
+    context.memory_store.list_devices()
+
+def percentile(sorted_values, percent):
+    # Nearest rank percentile of an already sorted list
+    rank = max(math.ceil(percent / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+def run_benchmark(context, setup, run, iterations, warmup):
+    """
+    Time one benchmark and count the Redis traffic of each call.
+    Parameters:
+    - context: The benchmark context.
+    - setup: Optional function preparing each iteration.
+    - run: The function to time.
+    - iterations: The number of timed calls.
+    - warmup: The number of untimed calls made first, e.g. to open connections and load scripts.
+    Returns:
+    - result: Dictionary with the latency percentiles in milliseconds and the Redis traffic of each call.
+    """
+    context.redis_client.flushdb()
+    context.memory_store = MemoryDeviceStore(DEVICE_TIMEOUT_SECONDS)
+    # Keep garbage collection pauses out of the timings
+    gc.collect()
+    gc.disable()
+    try:
+        return _run_benchmark(context, setup, run, iterations, warmup)
+    finally:
+        gc.enable()
+
+def _run_benchmark(context, setup, run, iterations, warmup):
+    latencies = []
+    commands = []
+    round_trips = []
+    bytes_sent = []
+    for i in range(warmup + iterations):
+        state = setup(context, i) if setup else None
+        REDIS_STATS.reset()
+        start = time.perf_counter()
+        run(context, i, state)
+        elapsed = time.perf_counter() - start
+        if i < warmup:
+            continue
+        latencies.append(elapsed * 1000)
+        commands.append(REDIS_STATS.commands)
+        round_trips.append(REDIS_STATS.round_trips)
+        bytes_sent.append(REDIS_STATS.bytes_sent)
+    latencies.sort()
+    return {
+        'p50_ms': round(percentile(latencies, 50), 4),
+        'p90_ms': round(percentile(latencies, 90), 4),
+        'p99_ms': round(percentile(latencies, 99), 4),
+        # A code path is judged by its worst call, so an extra command on any branch shows up
+        'commands': max(commands),
+        'round_trips': max(round_trips),
+        'bytes_sent': round(sum(bytes_sent) / len(bytes_sent))
+    }
+
+def compare_with_baseline(results, baseline, compare_latency, latency_tolerance, latency_slack_ms, command_tolerance):
+    """
+    Find the benchmarks that regressed since the baseline was saved.
+    Parameters:
+    - results: Dictionary mapping each benchmark name to its result.
+    - baseline: The saved baseline.
+    - compare_latency: True to check the p99 latency as well as the Redis commands.
+    - latency_tolerance: Fraction the p99 latency may grow by, e.g. 0.5 for 50%.
+    - latency_slack_ms: Growth in p99 latency always allowed, so tiny timings don't fail on noise.
+    - command_tolerance: Number of extra Redis commands allowed.
+    Returns:
+    - regressions: List of (name, message) tuples describing each regression.
+    """
+    regressions = []
+    for name, result in results.items():
+        expected = baseline['results'].get(name)
+        if not expected:
+            continue
+        if result['commands'] > expected['commands'] + command_tolerance:
+            regressions.append((name, f"{result['commands']} Redis commands, baseline {expected['commands']}"))
+        allowed_p99 = max(expected['p99_ms'] * (1 + latency_tolerance), expected['p99_ms'] + latency_slack_ms)
+        if compare_latency and result['p99_ms'] > allowed_p99:
+            regressions.append((name, f"p99 {result['p99_ms']:.3f} ms, baseline {expected['p99_ms']:.3f} ms"))
+    return regressions
+
+def print_results(results, baseline):
+    header = f"{'benchmark':<42} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'cmds':>6} {'trips':>6} {'bytes':>8}"
+    print(header)
+    print('-' * len(header))
+    for name, result in results.items():
+        expected = baseline['results'].get(name) if baseline else None
+        change = ''
+        if expected and result['commands'] != expected['commands']:
+            change = f"  (commands {expected['commands']} -> {result['commands']})"
+        print(f"{name:<42} {result['p50_ms']:>9.3f} {result['p90_ms']:>9.3f} {result['p99_ms']:>9.3f} "
+              f"{result['commands']:>6} {result['round_trips']:>6} {result['bytes_sent']:>8}{change}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Redis hot paths of the badge control server.")
+    parser.add_argument('--redis-url', help="Redis database to run against (flushed between benchmarks). Defaults to an in-process fakeredis stand-in.")
+    parser.add_argument('--iterations', type=int, default=200, help="Timed calls for each benchmark.")
+    parser.add_argument('--warmup', type=int, default=5, help="Untimed calls made before each benchmark.")
+    parser.add_argument('--only', help="Only run benchmarks whose name contains this text.")
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="Baseline file to compare with or save to.")
+    parser.add_argument('--save-baseline', action='store_true', help="Save the results as the new baseline instead of comparing.")
+    parser.add_argument('--latency-tolerance', type=float, default=0.5, help="Fraction the p99 latency may grow by before failing.")
+    parser.add_argument('--latency-slack-ms', type=float, default=1.0, help="Growth in p99 latency in milliseconds that never fails.")
+    parser.add_argument('--retries', type=int, default=2, help="Times to rerun a benchmark whose latency regressed, keeping its best p99, before failing.")
+    parser.add_argument('--command-tolerance', type=int, default=0, help="Extra Redis commands allowed before failing.")
+    args = parser.parse_args()
+
+    redis_client, backend = create_redis_client(args.redis_url)
+    # Point the app at the counting client, let the bulk benchmarks use an admin token and keep
+    # the rate limits out of the way of the other benchmarks
+    app_module.redis_client = redis_client
+    app_module.device_store = app_module.fleet_collector.device_store = RedisDeviceStore(redis_client, DEVICE_TIMEOUT_SECONDS)
+    app_module.ADMIN_TOKEN = ADMIN_TOKEN
+    app_module.app.config['SECRET_KEY'] = SECRET_KEY
+    app_module.SOURCE_RATE_LIMIT = app_module.DEVICE_RATE_LIMIT = RATE_LIMIT
+    # Cache credentials as the app does by default, invalidated by events from the counting client
+    credential_cache.configure_credential_cache(CREDENTIAL_CACHE_SIZE, 60)
+    credential_cache.start_device_event_listener(redis_client)
+    deadline = time.monotonic() + 5
+    while not credential_cache._listener_connected and time.monotonic() < deadline:
+        time.sleep(0.01)
+    context = BenchmarkContext(redis_client)
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+
+    benchmarks = {name: (setup, run) for name, setup, run in BENCHMARKS if not args.only or args.only in name}
+    results = {}
+    # Keep anything the routes print or log out of the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        event_log.configure_event_log(devnull, app_module.app.config['LOG_REDACTION'], app_module.app.config['EVENT_LOG_SAMPLE_RATES'])
+        for name, (setup, run) in benchmarks.items():
+            results[name] = run_benchmark(context, setup, run, args.iterations, args.warmup)
+
+        # Latency is noisy on a busy machine, so rerun any benchmark that looks slower before failing
+        compare_latency = bool(baseline) and not args.save_baseline and baseline.get('backend') == backend
+        for attempt in range(args.retries if compare_latency else 0):
+            slow_names = {name for name, message in compare_with_baseline(results, baseline, True, args.latency_tolerance, args.latency_slack_ms, 10 ** 6)}
+            for name in slow_names:
+                rerun = run_benchmark(context, *benchmarks[name], args.iterations, args.warmup)
+                if rerun['p99_ms'] < results[name]['p99_ms']:
+                    results[name] = rerun
+    redis_client.flushdb()
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        saved = baseline['results'] if baseline and args.only else {}
+        saved.update(results)
+        with open(args.baseline, 'w') as file:
+            json.dump({'backend': backend, 'iterations': args.iterations, 'results': saved}, file, indent=2)
+            file.write('\n')
+        print(f"\nSaved baseline to {args.baseline}")
+        return 0
+
+    if not baseline:
+        print("\nNo baseline to compare with, save one with --save-baseline")
+        return 0
+    if not compare_latency:
+        print(f"\nBaseline was saved with {baseline.get('backend')}, so only Redis commands are compared")
+    regressions = compare_with_baseline(results, baseline, compare_latency, args.latency_tolerance, args.latency_slack_ms, args.command_tolerance)
+    if regressions:
+        print("\nRegressions:")
+        for name, message in regressions:
+            print(f"- {name}: {message}")
+        return 1
+    print("\nNo regressions")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
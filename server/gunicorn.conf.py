@@ -0,0 +1,64 @@
+"""
+gunicorn settings for running the badge control server on every core.
+
+Run it from the server directory:
+    gunicorn -c gunicorn.conf.py                # Flask app on threaded workers
+    BADGE_SERVER_MODE=asgi gunicorn -c gunicorn.conf.py   # asyncio serving mode on uvicorn workers
+
+Every setting can be overridden from the environment: WEB_CONCURRENCY (worker processes),
+GUNICORN_THREADS (request threads per worker), BIND, and the app settings read by app.load_config,
+such as REDIS_URL and DEVICE_TIMEOUT_SECONDS.
+
+The app is not preloaded, so each worker imports it after the fork and opens its own Redis pool and
+listener threads. Prometheus metrics are shared between the workers through PROMETHEUS_MULTIPROC_DIR.
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+# Matches app.MAX_POLL_WAIT_SECONDS. The app itself must not be imported here, or the workers would
+# inherit its Redis pool and listener threads from the master.
+MAX_POLL_WAIT_SECONDS = 30
+
+ASGI_MODE = os.environ.get("BADGE_SERVER_MODE", "wsgi").lower() == "asgi"
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+if ASGI_MODE:
+    # Long polls wait on coroutines, so one event loop per worker is enough
+    wsgi_app = "asgi:app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    # Every long poll holds a thread for up to MAX_POLL_WAIT_SECONDS, so give each worker plenty
+    wsgi_app = "app:app"
+    worker_class = "gthread"
+    threads = int(os.environ.get("GUNICORN_THREADS", 32))
+    # One Redis connection per request thread, plus the listener threads
+    os.environ.setdefault("REDIS_MAX_CONNECTIONS", str(threads + 4))
+preload_app = False
+# Workers are restarted if silent this long, which must outlast a long poll
+timeout = MAX_POLL_WAIT_SECONDS + 30
+graceful_timeout = MAX_POLL_WAIT_SECONDS + 5
+keepalive = 5
+# Recycle workers now and then, staggered so they don't all restart at once
+max_requests = 10000
+max_requests_jitter = 1000
+# Badges reach the server through one reverse proxy
+forwarded_allow_ips = os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1")
+
+# Workers write their metrics here, so /metrics adds them up whichever worker serves the scrape.
+# It is set before any worker imports prometheus_client.
+if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="badge-metrics-")
+
+def on_starting(server):
+    # Samples left over from an earlier run would be added to this one's
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+def child_exit(server, worker):
+    # Drop the live gauges of a worker that has exited
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,159 @@
+import re
+
+# Matches IPv4 addresses such as 192.168.1.1
+IP_REGEX = re.compile(r'^((25[0-5]|(2[0-4]|1\d|[1-9]|)\d)\.?\b){4}$')
+
+MAX_STRING_FIELD_BYTES = 64 # Longest string sent to a device in a command, such as a new password, in UTF-8 bytes
+
+def parse_color(color_hex):
+    """
+    Convert a hex color value (e.g. #FF0000) to R, G, B values within the range of 0 to 255.
+    Parameters:
+    - color_hex: The hex color value.
+    Returns:
+    - fields: Dictionary with the r, g and b values.
+    """
+    try:
+        r = int(color_hex[1:3], 16)
+        g = int(color_hex[3:5], 16)
+        b = int(color_hex[5:7], 16)
+    except TypeError:
+        raise ValueError("Color must be a string")
+    return {'r': max(0, min(r, 255)), 'g': max(0, min(g, 255)), 'b': max(0, min(b, 255))}
+
+def parse_new_password(new_password):
+    """
+    Check a new device password.
+    Parameters:
+    - new_password: The new password.
+    Returns:
+    - fields: Dictionary with the new_password value.
+    """
+    if not isinstance(new_password, str):
+        raise ValueError("Password must be a string")
+    # The device gets exactly this password, so it must fit the string fields of the binary format
+    if len(new_password.encode()) > MAX_STRING_FIELD_BYTES:
+        raise ValueError(f"Password must be at most {MAX_STRING_FIELD_BYTES} bytes")
+    return {'new_password': new_password}
+
+# Every command a device can execute. This registry drives /get_commands, the validation in
+# /control_device and /control_devices, and the encoding of commands sent to the devices.
+# - code: Byte identifying the command in the compact binary format
+# - description: Description shown by /get_commands
+# - parameters: Request parameters for the command, each parsed into the fields sent to the device
+# - fields: Fields sent to the device, in order, with their binary type ('u8' or 'str')
+# - coalesce: True if a new command replaces any command of the same type still waiting to be delivered
+COMMANDS = {
+    'change_led_color': {
+        'code': 1,
+        'description': 'Change the color of the LED on the device',
+        'parameters': [
+            {'name': 'color', 'type': 'str', 'description': 'Hex color value (e.g. #FF0000 for red)', 'parse': parse_color}
+        ],
+        'fields': [('r', 'u8'), ('g', 'u8'), ('b', 'u8')],
+        'coalesce': True
+    },
+    'change_password': {
+        'code': 2,
+        'description': 'Change the password of the device',
+        'parameters': [
+            {'name': 'new_password', 'type': 'str', 'description': 'New password for the device', 'parse': parse_new_password}
+        ],
+        'fields': [('new_password', 'str')],
+        'coalesce': False
+    },
+    'display_password': {
+        'code': 3,
+        'description': 'Display the password of the device on the screen',
+        'parameters': [],
+        'fields': [],
+        'coalesce': False
+    },
+    'hide_password': {
+        'code': 4,
+        'description': 'Hide the password of the device from the screen',
+        'parameters': [],
+        'fields': [],
+        'coalesce': False
+    },
+    'rickroll': {
+        'code': 5,
+        'description': 'Plays the Rick Astley - Never Gonna Give You Up song on the device',
+        'parameters': [],
+        'fields': [],
+        'coalesce': False
+    }
+}
+
+def is_valid_ip(device_ip):
+    """
+    Check that an IP address is in IPv4 format.
+    Parameters:
+    - device_ip: The IP address to check.
+    Returns:
+    - status: True if the IP address is valid, False otherwise.
+    """
+    return bool(IP_REGEX.match(device_ip))
+
+def build_command(control_type, params, source_ip=None):
+    """
+    Validate a control command and build the command data to queue for a device.
+    Parameters:
+    - control_type: Type of control command to execute (e.g. change_led_color).
+    - params: Mapping to read the command parameters from (e.g. request.args or request.form).
+    - source_ip: The IP address sending the command, recorded in the hack events once it is delivered.
+      It is never sent to the device.
+    Returns:
+    - status: True if the command is valid, False otherwise.
+    - message: A message indicating the result of the operation.
+    - command_data: Dictionary with the command and its params, or None if the command is invalid.
+    """
+    command = COMMANDS.get(control_type)
+    if not command:
+        return False, "Invalid control type", None
+    command_params = {}
+    for parameter in command['parameters']:
+        label = parameter['name'].replace('_', ' ')
+        value = params.get(parameter['name'])
+        if not value:
+            return False, f"Missing {label} parameter", None
+        try:
+            command_params.update(parameter['parse'](value))
+        except ValueError:
+            return False, f"Invalid {label} parameter", None
+    command_data = {'command': control_type, 'params': command_params}
+    if source_ip:
+        command_data['source_ip'] = source_ip
+    return True, "Good", command_data
+
+def format_command(command_data):
+    """
+    Flatten a queued command into the JSON format the device expects.
+    Parameters:
+    - command_data: Dictionary with the command and its params.
+    Returns:
+    - command: Dictionary to send to the device, or None if the command is invalid.
+    """
+    command = COMMANDS.get(command_data.get('command'))
+    if not command:
+        return None
+    formatted = {'command': command_data['command']}
+    for field, field_type in command['fields']:
+        formatted[field] = command_data['params'][field]
+    return formatted
+
+def describe_commands():
+    """
+    Describe every command for /get_commands.
+    Returns:
+    - control_types: List of dictionaries with the command, description and parameters of each command.
+    """
+    control_types = []
+    for name, command in COMMANDS.items():
+        parameters = [{key: parameter[key] for key in ('name', 'type', 'description')} for parameter in command['parameters']]
+        control_types.append({
+            'command': name,
+            'description': command['description'],
+            'parameters': parameters or 'None'
+        })
+    return control_types
@@ -0,0 +1,191 @@
+"""
+In-process LRU cache of device password hashes, so repeated wrong guesses are answered without Redis.
+
+Every change to a device password is published on the device events channel, and a listener thread
+drops the matching entry in every worker. The cache is only used while that listener is connected
+to every Redis node holding devices,
+and entries also expire after a few seconds in case a message is lost. A cached hash is never
+enough to send a command: the queue script checks the hash stored in Redis as it queues.
+"""
+import collections
+import json
+import threading
+import time
+from helper_functions.device import DEVICE_EVENTS_CHANNEL, get_device_password_hashes
+from helper_functions import device_async
+from helper_functions.event_log import log_event
+from helper_functions.sharding import node_clients
+
+CREDENTIAL_CACHE_SIZE = 4096 # Most devices cached in each worker
+CREDENTIAL_CACHE_TTL_SECONDS = 5 # Longest time an entry is trusted without an invalidation
+
+# Maps each IP address to (password_hash, cached_at), with the least recently used first.
+# A password hash of None caches that the device was not found.
+_credential_cache = collections.OrderedDict()
+_credential_cache_lock = threading.Lock()
+# Bumped by every invalidation, so a lookup that raced with one doesn't cache a stale hash
+_credential_cache_generation = 0
+# Redis nodes the listener is subscribed to, out of the _listener_nodes it listens on
+_connected_nodes = set()
+_listener_nodes = 0
+_listener_connected = False
+
+def configure_credential_cache(max_size=CREDENTIAL_CACHE_SIZE, ttl_seconds=CREDENTIAL_CACHE_TTL_SECONDS):
+    """
+    Set the size and expiry of the cache.
+    Parameters:
+    - max_size: Most devices to cache, or 0 to turn the cache off.
+    - ttl_seconds: Longest time an entry is trusted without an invalidation.
+    """
+    global CREDENTIAL_CACHE_SIZE, CREDENTIAL_CACHE_TTL_SECONDS
+    CREDENTIAL_CACHE_SIZE = max_size
+    CREDENTIAL_CACHE_TTL_SECONDS = ttl_seconds
+    clear_credential_cache()
+
+def get_cached_password_hash(device_ip):
+    """
+    Look up the password hash of a device in the cache.
+    Parameters:
+    - device_ip: The IP address of the device.
+    Returns:
+    - hit: True if the device was found in the cache, False otherwise.
+    - password_hash: The cached password hash, or None if the device is not found or not cached.
+    - generation: Token to pass to cache_password_hash after reading the hash from Redis.
+    """
+    with _credential_cache_lock:
+        generation = _credential_cache_generation
+        if not _listener_connected or not CREDENTIAL_CACHE_SIZE:
+            return False, None, generation
+        entry = _credential_cache.get(device_ip)
+        if entry is None:
+            return False, None, generation
+        password_hash, cached_at = entry
+        if time.monotonic() - cached_at > CREDENTIAL_CACHE_TTL_SECONDS:
+            del _credential_cache[device_ip]
+            return False, None, generation
+        _credential_cache.move_to_end(device_ip)
+        return True, password_hash, generation
+
+def cache_password_hash(device_ip, password_hash, generation):
+    """
+    Cache the password hash of a device read from Redis, unless a device changed since the lookup began.
+    Parameters:
+    - device_ip: The IP address of the device.
+    - password_hash: The password hash, or None if the device was not found.
+    - generation: The token returned by get_cached_password_hash before reading from Redis.
+    """
+    with _credential_cache_lock:
+        if not _listener_connected or not CREDENTIAL_CACHE_SIZE or generation != _credential_cache_generation:
+            return
+        _credential_cache[device_ip] = (password_hash, time.monotonic())
+        _credential_cache.move_to_end(device_ip)
+        while len(_credential_cache) > CREDENTIAL_CACHE_SIZE:
+            _credential_cache.popitem(last=False)
+
+def lookup_password_hash(device_ip, redis_client):
+    """
+    Get the password hash of a device from the cache, reading it from Redis on a miss.
+    Parameters:
+    - device_ip: The IP address of the device.
+    - redis_client: The Redis client object.
+    Returns:
+    - password_hash: The password hash of the device, or None if the device is not found.
+    """
+    hit, password_hash, generation = get_cached_password_hash(device_ip)
+    if not hit:
+        password_hash = get_device_password_hashes([device_ip], redis_client)[device_ip]
+        cache_password_hash(device_ip, password_hash, generation)
+    return password_hash
+
+async def lookup_password_hash_async(device_ip, redis_client):
+    """
+    Get the password hash of a device from the cache, reading it from Redis on a miss.
+    Parameters:
+    - device_ip: The IP address of the device.
+    - redis_client: The redis.asyncio client object.
+    Returns:
+    - password_hash: The password hash of the device, or None if the device is not found.
+    """
+    hit, password_hash, generation = get_cached_password_hash(device_ip)
+    if not hit:
+        password_hash = (await device_async.get_device_password_hashes([device_ip], redis_client))[device_ip]
+        cache_password_hash(device_ip, password_hash, generation)
+    return password_hash
+
+def invalidate_password_hash(device_ip):
+    """
+    Drop a device from the cache.
+    Parameters:
+    - device_ip: The IP address of the device.
+    """
+    global _credential_cache_generation
+    with _credential_cache_lock:
+        _credential_cache_generation += 1
+        _credential_cache.pop(device_ip, None)
+
+def clear_credential_cache():
+    """
+    Drop every device from the cache.
+    """
+    global _credential_cache_generation
+    with _credential_cache_lock:
+        _credential_cache_generation += 1
+        _credential_cache.clear()
+
+def start_device_event_listener(redis_client):
+    """
+    Start background threads that drop devices from the cache when the device events channel reports a change.
+    Parameters:
+    - redis_client: The Redis client object or ShardRing, whose every node is subscribed to.
+    Returns:
+    - threads: List of the background threads handling the messages, one for each node.
+    """
+    global _listener_nodes
+    nodes = node_clients(redis_client)
+    _listener_nodes = len(nodes)
+    threads = []
+    for node, node_client in enumerate(nodes):
+        thread = threading.Thread(target=_listen_for_device_events, args=(node, node_client), daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+def _set_node_connected(node, connected):
+    global _listener_connected
+    with _credential_cache_lock:
+        if connected:
+            _connected_nodes.add(node)
+        else:
+            _connected_nodes.discard(node)
+        _listener_connected = len(_connected_nodes) == _listener_nodes
+
+def _listen_for_device_events(node, redis_client):
+
+    def handle_device_event(message):
+        try:
+            device_event = json.loads(message['data'])
+            device_ip = device_event['ip_address']
+        except (ValueError, KeyError, TypeError):
+            return
+        # Delivering a command leaves the password as it was
+        if device_event.get('event') != 'hacked':
+            invalidate_password_hash(device_ip)
+
+    while True:
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(**{DEVICE_EVENTS_CHANNEL: handle_device_event})
+            _set_node_connected(node, True)
+            # Every message is handled by handle_device_event. Wait for them a second at a time, so a
+            # socket timeout on the connection pool doesn't look like a lost connection.
+            while True:
+                pubsub.get_message(timeout=1)
+        except Exception as e:
+            if node in _connected_nodes:
+                log_event('device_event_listener_disconnected', level='error', node=node, error=str(e))
+        finally:
+            # Messages may be lost until the subscription is back, so stop trusting the cache
+            _set_node_connected(node, False)
+            clear_credential_cache()
+            pubsub.close()
+        time.sleep(1)
@@ -1,32 +1,97 @@
 import hashlib
-import random
+import heapq
 from flask import jsonify
-from helper_functions.time_helper import get_current_utc_time, get_current_utc_time_string, convert_string_time_to_datetime
-import os
+from helper_functions.time_helper import get_current_epoch_time, convert_string_time_to_epoch
+from helper_functions.password_pool import choose_password
+from helper_functions.redis_scripts import POLL_DEVICE_SCRIPT, QUEUE_DEVICE_COMMAND_SCRIPT, UPDATE_DEVICE_FIELDS_SCRIPT, PRUNE_DEVICE_INDEXES_SCRIPT, run_script
+from helper_functions.sharding import device_key, device_command_key, device_wakeup_key, device_ip_from_key, device_indexes, device_indexes_for, device_shard, client_for_device, group_devices_by_node, group_shards_by_node, node_clients, fan_out
+from helper_functions import hack_events
+from helper_functions.event_log import log_event
 import json
+import redis
 
-def insert_device_database(device_ip, redis_client):
+# Device records are stored as Redis hashes under device:{ip} (see sharding.py for the sharded layout)
+# with these fields:
+# - password: MD5 hash of the device password
+# - raw_password: The plaintext device password
+# - last_seen: Epoch time the device was last seen
+# - last_hacked_time: Epoch time a command was last delivered to the device (missing if never hacked)
+# Each record expires device_timeout_seconds after the device was last seen, so a device is active
+# exactly while its key exists and Redis removes stale devices on its own.
+DEVICE_TIME_FIELDS = ('last_seen', 'last_hacked_time')
+
+# Sorted sets of device IP addresses scored by their last seen and last hacked times,
+# so the active devices can be listed a page at a time without scanning the keyspace.
+# These are the single node indexes, each shard has its own (see device_indexes).
+DEVICE_INDEXES = device_indexes(None)
+DEVICE_LAST_SEEN_INDEX = DEVICE_INDEXES['last_seen']
+DEVICE_LAST_HACKED_INDEX = DEVICE_INDEXES['last_hacked_time']
+
+# Channel announcing every device that is inserted, removed, hacked or has its password changed, as JSON
+# objects with the event and ip_address plus the fields that changed, so workers can drop the device from
+# their credential cache and live admin dashboards can update their rows
+DEVICE_EVENTS_CHANNEL = 'device_events'
+
+# Messages for the failures reported by the queue script
+QUEUE_ERRORS = {0: "Command queue full", -1: "Device not found", -2: "Invalid password"}
+
+def device_event_message(event, device_ip, **fields):
+    # Message published on the device events channel
+    return json.dumps({'event': event, 'ip_address': device_ip, **fields})
+
+def insert_device(device_ip, device_timeout_seconds, redis_client):
     """
-    Insert a new device into the database.
+    Insert a new device into the database with a random password.
     Parameters:
     - device_ip: The IP address of the device.
+    - device_timeout_seconds: The time interval in seconds after which the device expires if not seen.
     - redis_client: The Redis client object.
     Returns:
     - status: True if the operation was successful, False otherwise.
     - message: A message indicating the result of the operation.
+    - raw_password: The plaintext password of the new device, or None if the operation failed.
     """
     try:
-        # Generate random insecure md5 password
-        hashed_password, raw_password = generate_md5_password()
-        # Get the current time in UTC
-        last_seen = get_current_utc_time_string()
-        # Insert device and password into Redis
-        device_data = {'password': hashed_password, 'raw_password': raw_password, 'last_seen': last_seen}
-        redis_key = f"device:{device_ip}"
-        redis_client.set(redis_key, json.dumps(device_data))
-        return jsonify({'ip_address': device_ip, 'password': raw_password}), 200
+        pipeline = client_for_device(device_ip, redis_client).pipeline()
+        raw_password = _queue_insert_device(pipeline, device_ip, device_timeout_seconds)
+        pipeline.execute()
+        return True, "Good", raw_password
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return False, str(e), None
+
+# The helpers starting with _queue or ending with _script_args only build the Redis commands, so the
+# blocking helpers here and the asyncio ones in device_async.py send exactly the same commands
+
+def _queue_insert_device(pipeline, device_ip, device_timeout_seconds):
+    # Queue the commands inserting a device with a random insecure MD5 password, replacing any old record,
+    # and return the password
+    hashed_password, raw_password = generate_md5_password()
+    last_seen = get_current_epoch_time()
+    device_data = {'password': hashed_password, 'raw_password': raw_password, 'last_seen': last_seen}
+    redis_key = device_key(device_ip)
+    indexes = device_indexes_for(device_ip)
+    pipeline.delete(redis_key)
+    pipeline.hset(redis_key, mapping=device_data)
+    pipeline.expire(redis_key, device_timeout_seconds)
+    pipeline.zadd(indexes['last_seen'], {device_ip: last_seen})
+    pipeline.zrem(indexes['last_hacked_time'], device_ip)
+    pipeline.publish(DEVICE_EVENTS_CHANNEL, device_event_message('inserted', device_ip, password_hash=hashed_password, last_seen=last_seen))
+    return raw_password
+
+def insert_device_database(device_ip, device_timeout_seconds, redis_client):
+    """
+    Insert a new device into the database.
+    Parameters:
+    - device_ip: The IP address of the device.
+    - device_timeout_seconds: The time interval in seconds after which the device expires if not seen.
+    - redis_client: The Redis client object.
+    Returns:
+    - response: JSON response with the IP address and password of the device, and the HTTP status code.
+    """
+    status, message, raw_password = insert_device(device_ip, device_timeout_seconds, redis_client)
+    if not status:
+        return jsonify({'error': message}), 500
+    return jsonify({'ip_address': device_ip, 'password': raw_password}), 200
 
 def remove_device_database(device_ip, redis_client):
     """
@@ -39,55 +104,432 @@ def remove_device_database(device_ip, redis_client):
     - message: A message indicating the result of the operation.
     """
     try:
-        redis_key = f"device:{device_ip}"
-        if redis_client.exists(redis_key):
-            redis_client.delete(redis_key)
+        indexes = device_indexes_for(device_ip)
+        pipeline = client_for_device(device_ip, redis_client).pipeline()
+        pipeline.delete(device_key(device_ip))
+        pipeline.zrem(indexes['last_seen'], device_ip)
+        pipeline.zrem(indexes['last_hacked_time'], device_ip)
+        pipeline.publish(DEVICE_EVENTS_CHANNEL, device_event_message('removed', device_ip))
+        deleted, _, _, _ = pipeline.execute()
+        if deleted:
             return True, "Good"
         else:
             return False, "Device not found"
     except Exception as e:
         return False, str(e)
 
-def update_last_seen(device_ip, redis_client, last_hacked=False):
+def remove_device_from_indexes(device_ip, redis_client):
+    """
+    Remove a device from the device indexes, e.g. once its record has expired.
+    Parameters:
+    - device_ip: The IP address of the device.
+    - redis_client: The Redis client object.
+    """
+    indexes = device_indexes_for(device_ip)
+    pipeline = client_for_device(device_ip, redis_client).pipeline()
+    pipeline.zrem(indexes['last_seen'], device_ip)
+    pipeline.zrem(indexes['last_hacked_time'], device_ip)
+    pipeline.execute()
+
+def prune_device_indexes(device_timeout_seconds, redis_client, limit=1000):
+    """
+    Drop devices that have expired from the device indexes.
+    Parameters:
+    - device_timeout_seconds: The time interval in seconds after which a device expires if not seen.
+    - redis_client: The Redis client object.
+    - limit: The maximum number of devices to drop in one call.
+    Returns:
+    - pruned: The number of devices dropped.
+    """
+    args = _prune_script_args(device_timeout_seconds, limit)
+
+    def prune_node(group):
+        node_client, shards = group
+        if len(shards) == 1:
+            return run_script(PRUNE_DEVICE_INDEXES_SCRIPT, node_client, _index_keys(shards[0]), args)
+        # Prune every shard on the node in one round trip
+        pipeline = node_client.pipeline(transaction=False)
+        for shard in shards:
+            run_script(PRUNE_DEVICE_INDEXES_SCRIPT, pipeline, _index_keys(shard), args)
+        return sum(pipeline.execute())
+
+    return sum(fan_out(prune_node, group_shards_by_node(redis_client)))
+
+def _prune_script_args(device_timeout_seconds, limit):
+    # Arguments of PRUNE_DEVICE_INDEXES_SCRIPT, dropping devices last seen before the device timeout
+    return [get_current_epoch_time() - device_timeout_seconds, limit]
+
+def _index_keys(shard):
+    # Keys of the last seen and last hacked indexes of a shard, in the order the scripts expect them
+    indexes = device_indexes(shard)
+    return [indexes['last_seen'], indexes['last_hacked_time']]
+
+def list_devices(device_timeout_seconds, redis_client, page=1, per_page=50, sort_by='last_seen'):
+    """
+    Get one page of active devices from the device indexes, most recent first.
+    Parameters:
+    - device_timeout_seconds: The time interval in seconds after which a device expires if not seen.
+    - redis_client: The Redis client object.
+    - page: The page number to get, starting at 1.
+    - per_page: The number of devices on each page.
+    - sort_by: The field to sort the devices by, either 'last_seen' or 'last_hacked_time'.
+      Sorting by last hacked time only lists devices that have been hacked.
+    Returns:
+    - devices: List of dictionaries with the ip_address, password_hash, last_seen and last_hacked_time of each device.
+    - total: The total number of devices in the index.
+    """
+    prune_device_indexes(device_timeout_seconds, redis_client)
+    start = (page - 1) * per_page
+    shard_groups = group_shards_by_node(redis_client)
+    single_index = len(shard_groups) == 1 and len(shard_groups[0][1]) == 1
+
+    def read_indexes(group):
+        node_client, shards = group
+        pipeline = node_client.pipeline(transaction=False)
+        _queue_index_page_reads(pipeline, shards, sort_by, start, per_page, single_index)
+        return pipeline.execute()
+
+    total, device_ips = _page_device_ips(fan_out(read_indexes, shard_groups), start, per_page, single_index)
+
+    # Fetch every device on the page in a single round trip to each node
+    def read_devices(group):
+        node_client, node_device_ips = group
+        pipeline = node_client.pipeline(transaction=False)
+        _queue_device_row_reads(pipeline, node_device_ips)
+        return zip(node_device_ips, pipeline.execute())
+
+    device_groups = group_devices_by_node(device_ips, redis_client)
+    device_fields = {device_ip: fields for results in fan_out(read_devices, device_groups) for device_ip, fields in results}
+    return _device_rows(device_ips, device_fields), total
+
+def _queue_index_page_reads(pipeline, shards, sort_by, start, per_page, single_index):
+    # Queue the reads of the size of each shard's index and of its devices up to the end of the page
+    for shard in shards:
+        index = device_indexes(shard)[sort_by]
+        pipeline.zcard(index)
+        if single_index:
+            pipeline.zrevrange(index, start, start + per_page - 1)
+        else:
+            # Any shard may hold devices on the page, so read each one up to the end of the page
+            pipeline.zrevrange(index, 0, start + per_page - 1, withscores=True)
+
+def _page_device_ips(node_results, start, per_page, single_index):
+    """
+    Cut one page of devices out of the index reads queued by _queue_index_page_reads.
+    Parameters:
+    - node_results: The pipeline results of each node.
+    - start: The position of the first device on the page.
+    - per_page: The number of devices on each page.
+    - single_index: True if there is only one index, which was read from the start of the page.
+    Returns:
+    - total: The total number of devices in the indexes.
+    - device_ips: The IP addresses of the devices on the page, most recent first.
+    """
+    total = 0
+    shard_pages = []
+    for results in node_results:
+        total += sum(results[0::2])
+        shard_pages.extend(results[1::2])
+    if single_index:
+        return total, [device_ip.decode() for device_ip in shard_pages[0]]
+    # Merge the shards, which are each sorted most recent first with ties in reverse IP order, and cut out the page
+    merged = heapq.merge(*shard_pages, key=lambda entry: (entry[1], entry[0]), reverse=True)
+    return total, [device_ip.decode() for device_ip, score in merged][start:start + per_page]
+
+def _queue_device_row_reads(pipeline, device_ips):
+    # Queue the reads of the fields listed for each device
+    for device_ip in device_ips:
+        pipeline.hmget(device_key(device_ip), 'password', 'last_seen', 'last_hacked_time')
+
+def _device_rows(device_ips, device_fields):
+    # Build the listed devices from the fields read by _queue_device_row_reads, in the order of device_ips
+    devices = []
+    for device_ip in device_ips:
+        password, last_seen, last_hacked_time = device_fields[device_ip]
+        # Device expired since the index was pruned
+        if password is None:
+            continue
+        devices.append({
+            'ip_address': device_ip,
+            'password_hash': password.decode(),
+            'last_seen': int(last_seen) if last_seen else None,
+            'last_hacked_time': int(last_hacked_time) if last_hacked_time else None
+        })
+    return devices
+
+def get_fleet_stats(device_timeout_seconds, redis_client):
+    """
+    Count the active devices, the ones that have been hacked and the commands waiting for them.
+    Parameters:
+    - device_timeout_seconds: The time interval in seconds after which a device expires if not seen.
+    - redis_client: The Redis client object.
+    Returns:
+    - active_devices: The number of devices seen within the device timeout.
+    - hacked_devices: The number of active devices that have been sent a command.
+    - pending_commands: The number of commands queued and not yet delivered to active devices.
+    """
+    cutoff = get_current_epoch_time() - device_timeout_seconds
+
+    def read_node(group):
+        node_client, shards = group
+        pipeline = node_client.pipeline(transaction=False)
+        for shard in shards:
+            indexes = device_indexes(shard)
+            pipeline.zrangebyscore(indexes['last_seen'], cutoff, '+inf')
+            pipeline.zcount(indexes['last_hacked_time'], cutoff, '+inf')
+        results = pipeline.execute()
+        device_ips = [device_ip.decode() for shard_device_ips in results[0::2] for device_ip in shard_device_ips]
+        # Count the commands waiting for every active device on the node in one round trip
+        pending_commands = 0
+        if device_ips:
+            pipeline = node_client.pipeline(transaction=False)
+            for device_ip in device_ips:
+                pipeline.llen(device_command_key(device_ip))
+            # A queue still stored as a single legacy command fails LLEN and is skipped
+            pending_commands = sum(length for length in pipeline.execute(raise_on_error=False) if isinstance(length, int))
+        return len(device_ips), sum(results[1::2]), pending_commands
+
+    active_devices, hacked_devices, pending_commands = (sum(counts) for counts in zip(*fan_out(read_node, group_shards_by_node(redis_client))))
+    return active_devices, hacked_devices, pending_commands
+
+def get_device_password_hashes(device_ips, redis_client):
+    """
+    Get the password hashes of many devices in a single round trip.
+    Parameters:
+    - device_ips: List of the IP addresses of the devices.
+    - redis_client: The Redis client object.
+    Returns:
+    - password_hashes: Dictionary mapping each IP address to its password hash, or None if the device is not found.
+    """
+    def read_passwords(group):
+        node_client, node_device_ips = group
+        pipeline = node_client.pipeline(transaction=False)
+        _queue_password_reads(pipeline, node_device_ips)
+        return zip(node_device_ips, pipeline.execute(raise_on_error=False))
+
+    passwords = {device_ip: password for results in fan_out(read_passwords, group_devices_by_node(device_ips, redis_client)) for device_ip, password in results}
+    password_hashes, legacy_device_ips = _decode_password_hashes(device_ips, passwords)
+    for device_ip in legacy_device_ips:
+        device_data = get_device_data(device_ip, redis_client)
+        password_hashes[device_ip] = device_data.get('password') if device_data else None
+    return password_hashes
+
+def _queue_password_reads(pipeline, device_ips):
+    # Queue the reads of the password hash of each device
+    for device_ip in device_ips:
+        pipeline.hget(device_key(device_ip), 'password')
+
+def _decode_password_hashes(device_ips, passwords):
+    """
+    Decode the password hashes read by _queue_password_reads.
+    Parameters:
+    - device_ips: List of the IP addresses of the devices.
+    - passwords: Dictionary mapping each IP address to its pipeline result.
+    Returns:
+    - password_hashes: Dictionary mapping each IP address to its password hash, or None if the device is not found.
+    - legacy_device_ips: The devices whose key is still a legacy JSON string, to read with get_device_data.
+    """
+    password_hashes = {}
+    legacy_device_ips = []
+    for device_ip in device_ips:
+        password = passwords[device_ip]
+        if isinstance(password, redis.ResponseError):
+            legacy_device_ips.append(device_ip)
+            password = None
+        password_hashes[device_ip] = password.decode() if isinstance(password, bytes) else password
+    return password_hashes, legacy_device_ips
+
+def get_device_data(device_ip, redis_client):
+    """
+    Get the record for a device, reading both the hash layout and the legacy JSON layout.
+    Parameters:
+    - device_ip: The IP address of the device.
+    - redis_client: The Redis client object.
+    Returns:
+    - device_data: Dictionary of the device fields with times as epoch integers, or None if the device is not found.
+    """
+    redis_key = device_key(device_ip)
+    redis_client = client_for_device(device_ip, redis_client)
+    try:
+        device_data = redis_client.hgetall(redis_key)
+    except redis.ResponseError:
+        # Key is still a legacy JSON string
+        return _parse_legacy_device_data(redis_client.get(redis_key))
+    return _decode_device_data(device_data)
+
+def _decode_device_data(device_data):
+    """
+    Convert the raw fields of a device hash to a dictionary of strings with times as epoch integers.
+    Parameters:
+    - device_data: Dictionary of the raw field names and values returned by HGETALL.
+    Returns:
+    - device_data: Dictionary of the device fields, or None if the device is not found.
+    """
+    if not device_data:
+        return None
+    device_data = {key.decode(): value.decode() for key, value in device_data.items()}
+    for field in DEVICE_TIME_FIELDS:
+        if field in device_data:
+            device_data[field] = int(device_data[field])
+    return device_data
+
+def _parse_legacy_device_data(device_data_json):
+    """
+    Convert a device record stored in the legacy JSON layout to the hash layout.
+    Parameters:
+    - device_data_json: The JSON string stored for the device.
+    Returns:
+    - device_data: Dictionary of the device fields with times as epoch integers, or None if there is no record.
+    """
+    if not device_data_json:
+        return None
+    device_data = json.loads(device_data_json)
+    for field in DEVICE_TIME_FIELDS:
+        if device_data.get(field):
+            device_data[field] = convert_string_time_to_epoch(device_data[field])
+        else:
+            device_data.pop(field, None)
+    return device_data
+
+def migrate_device_record(device_ip, device_timeout_seconds, redis_client):
+    """
+    Convert a device stored in the legacy JSON layout to the hash layout.
+    Parameters:
+    - device_ip: The IP address of the device.
+    - device_timeout_seconds: The time interval in seconds after which the device expires if not seen,
+      or 0 to leave the device without an expiry until the next heartbeat.
+    - redis_client: The Redis client object.
+    Returns:
+    - status: True if the device was migrated, False otherwise.
+    - message: A message indicating the result of the operation.
+    """
+    redis_key = device_key(device_ip)
+    try:
+        with client_for_device(device_ip, redis_client).pipeline() as pipeline:
+            # Watch the key so a concurrent writer can't be overwritten by the migration
+            pipeline.watch(redis_key)
+            if pipeline.type(redis_key) != b'string':
+                return False, "Device is not in the legacy format"
+            device_data = _parse_legacy_device_data(pipeline.get(redis_key))
+            pipeline.multi()
+            _queue_migrated_record(pipeline, device_ip, device_data, device_timeout_seconds)
+            pipeline.execute()
+        return True, "Successfully migrated device"
+    except redis.WatchError:
+        return False, "Device changed during migration"
+    except Exception as e:
+        return False, str(e)
+
+def _queue_migrated_record(pipeline, device_ip, device_data, device_timeout_seconds):
+    # Queue the commands replacing a legacy JSON record with the hash layout and adding it to the indexes
+    redis_key = device_key(device_ip)
+    pipeline.delete(redis_key)
+    pipeline.hset(redis_key, mapping=device_data)
+    if device_timeout_seconds:
+        pipeline.expireat(redis_key, device_data.get('last_seen', 0) + device_timeout_seconds)
+    for field, index in device_indexes_for(device_ip).items():
+        if field in device_data:
+            pipeline.zadd(index, {device_ip: device_data[field]})
+
+def migrate_device_database(device_timeout_seconds, redis_client):
+    """
+    One-shot migration of every device stored in the legacy JSON layout to the hash layout.
+    Device hashes written before records expired on their own are given an expiry as well,
+    and every device is added to the device indexes.
+    Parameters:
+    - device_timeout_seconds: The time interval in seconds after which a device expires if not seen.
+    - redis_client: The Redis client object.
+    Returns:
+    - migrated: The number of devices that were migrated.
+    """
+    migrated = 0
+    for node_client in node_clients(redis_client):
+        for redis_key in node_client.scan_iter(match='device:*', _type='string'):
+            device_ip = device_ip_from_key(redis_key.decode())
+            status, message = migrate_device_record(device_ip, device_timeout_seconds, redis_client)
+            if status:
+                migrated += 1
+        for redis_key in node_client.scan_iter(match='device:*', _type='hash'):
+            device_ip = device_ip_from_key(redis_key.decode())
+            indexes = device_indexes_for(device_ip)
+            last_seen, last_hacked_time = node_client.hmget(redis_key, 'last_seen', 'last_hacked_time')
+            last_seen = int(last_seen or 0)
+            if node_client.ttl(redis_key) == -1:
+                node_client.expireat(redis_key, last_seen + device_timeout_seconds)
+                migrated += 1
+            node_client.zadd(indexes['last_seen'], {device_ip: last_seen})
+            if last_hacked_time:
+                node_client.zadd(indexes['last_hacked_time'], {device_ip: int(last_hacked_time)})
+    return migrated
+
+def update_device_fields(device_ip, fields, redis_client, device_timeout_seconds=0):
+    """
+    Set fields on a device record with a single HSET, without touching the other fields.
+    Parameters:
+    - device_ip: The IP address of the device.
+    - fields: Dictionary of the field names and values to set.
+    - redis_client: The Redis client object.
+    - device_timeout_seconds: If set, the device expiry is pushed back to this many seconds from now.
+    Returns:
+    - status: True if the operation was successful, False otherwise.
+    - message: A message indicating the result of the operation.
+    """
+    keys, args = _update_fields_script_args(device_ip, fields, device_timeout_seconds)
+    node_client = client_for_device(device_ip, redis_client)
+    if run_script(UPDATE_DEVICE_FIELDS_SCRIPT, node_client, keys, args):
+        return True, "Good"
+    # Device may still be in the legacy format, so migrate it and try again
+    status, message = migrate_device_record(device_ip, device_timeout_seconds, redis_client)
+    if status and run_script(UPDATE_DEVICE_FIELDS_SCRIPT, node_client, keys, args):
+        return True, "Good"
+    return False, "Device not found"
+
+def _update_fields_script_args(device_ip, fields, device_timeout_seconds=0):
+    # Keys and arguments of UPDATE_DEVICE_FIELDS_SCRIPT
+    indexes = device_indexes_for(device_ip)
+    keys = [device_key(device_ip), indexes['last_seen'], indexes['last_hacked_time']]
+    args = [device_timeout_seconds, device_ip] + [item for field in fields.items() for item in field]
+    return keys, args
+
+def _last_seen_fields(last_hacked=False):
+    # Device fields marking a device as seen, and hacked if last_hacked is set, now
+    time_now = get_current_epoch_time()
+    fields = {'last_seen': time_now}
+    if last_hacked:
+        fields['last_hacked_time'] = time_now
+    return fields
+
+def _password_fields(new_password):
+    # MD5 hash of a new password, and the device fields storing it
+    hashed_password = hashlib.md5(new_password.encode()).hexdigest()
+    return hashed_password, {'password': hashed_password, 'raw_password': new_password}
+
+def update_last_seen(device_ip, device_timeout_seconds, redis_client, last_hacked=False):
     """
-    Update the last seen time for a device in the database.
+    Update the last seen time for a device in the database and push back its expiry.
     Parameters:
     - device_ip: The IP address of the device.
+    - device_timeout_seconds: The time interval in seconds after which the device expires if not seen.
     - redis_client: The Redis client object.
     Returns:
     - status: True if the operation was successful, False otherwise.
     - message: A message indicating the result of the operation.
     """
     try:
-        time_now = get_current_utc_time_string()
-        redis_key = f"device:{device_ip}"
-        if redis_client.exists(redis_key):
-            device_data = json.loads(redis_client.get(redis_key))
-            device_data['last_seen'] = time_now
-            if last_hacked:
-                device_data['last_hacked_time'] = time_now
-            redis_client.set(redis_key, json.dumps(device_data))
-            return True, "Good"
-        else:
-            return False, "Device not found"
+        return update_device_fields(device_ip, _last_seen_fields(last_hacked), redis_client, device_timeout_seconds)
     except Exception as e:
         return False, str(e)
 
 def generate_md5_password():
-    static_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'static')
-    file_path = os.path.join(static_folder, "common_passwords.txt")
-    # Read passwords from the file
-    with open(file_path, 'r') as file:
-        passwords = file.readlines()
-    # Select a random password
-    random_password = random.choice(passwords).strip()
-    # Hash the password using MD5
-    hashed_password = hashlib.md5(random_password.encode()).hexdigest()
+    # Select a random password, already hashed with MD5, from the preloaded pool
+    hashed_password, random_password = choose_password()
     return hashed_password, random_password
 
 def check_last_seen(device_ip, device_timeout_seconds, redis_client):
     """
     Check if the last seen time for a device in the database is within specified interval.
+    Devices expire from Redis once they haven't been seen for device_timeout_seconds,
+    so this only needs to check that the device still exists.
     Parameters:
     - device_ip: The IP address of the device.
     - device_timeout_seconds: The time interval in seconds within which the device must be seen.
@@ -97,19 +539,9 @@ def check_last_seen(device_ip, device_timeout_seconds, redis_client):
     - message: A message indicating the result of the operation.
     """
     try:
-        redis_key = f"device:{device_ip}"
-        if not redis_client.exists(redis_key):
+        if not client_for_device(device_ip, redis_client).exists(device_key(device_ip)):
             return False, "Device not found"
-        device_data = json.loads(redis_client.get(redis_key))
-        last_seen = device_data.get('last_seen')
-        if not last_seen:
-            return False, "Last seen time not found for device"
-        time_now = get_current_utc_time()
-        last_seen = convert_string_time_to_datetime(str(last_seen))
-        if (time_now - last_seen).total_seconds() > device_timeout_seconds:
-            return False, "Device has not been seen in the specified time interval"
-        else:
-            return True, "Device has been seen in the specified time interval"
+        return True, "Device has been seen in the specified time interval"
     except Exception as e:
         return False, str(e)
 
@@ -127,22 +559,193 @@ def ensure_device_active(device_ip, device_timeout_seconds, redis_client):
     # Check the last seen time for the device
     status, message = check_last_seen(device_ip, device_timeout_seconds, redis_client)
 
-    # If device hasn't been seen, remove device from DB and insert new device
+    # If device hasn't been seen it has expired, so insert it as a new device
     if not status:
-        # Remove device from DB
-        status, message = remove_device_database(device_ip, redis_client)
-        if not status:
-            return False, message, None
-        # Insert device into DB
-        result = insert_device_database(device_ip, redis_client)
+        result = insert_device_database(device_ip, device_timeout_seconds, redis_client)
         return True, "Successfully reinserted device", result
-    
+
     # Report that device is still active, and update last seen time
-    status, message = update_last_seen(device_ip, redis_client)
+    status, message = update_last_seen(device_ip, device_timeout_seconds, redis_client)
     if not status:
         return False, message, None
     return True, "Device is active", None
 
+def poll_device(device_ip, device_timeout_seconds, redis_client, max_commands=1):
+    """
+    Check that a device is active, refresh its last seen time and expiry, and pop its queued commands.
+    All of this happens atomically in a single Redis round trip, so a command can only be delivered once.
+    The delivered commands are recorded as hack events (see hack_events.py).
+    Parameters:
+    - device_ip: The IP address of the device.
+    - device_timeout_seconds: The time interval in seconds within which the device must be seen.
+    - redis_client: The Redis client object.
+    - max_commands: The maximum number of queued commands to pop.
+    Returns:
+    - status: True if the device is active, False otherwise.
+    - message: A message indicating the result of the operation.
+    - commands: List of the popped commands in the order they were queued.
+    """
+    try:
+        keys, args, now, sharded = _poll_script_args(device_ip, device_timeout_seconds, max_commands)
+        node_client = client_for_device(device_ip, redis_client)
+        result = run_script(POLL_DEVICE_SCRIPT, node_client, keys, args)
+        if result[0] == 3:
+            # Device is still in the legacy format, so migrate it and try again
+            migrate_device_record(device_ip, device_timeout_seconds, redis_client)
+            result = run_script(POLL_DEVICE_SCRIPT, node_client, keys, args)
+        if result[0] != 2:
+            return False, "Device not found", []
+        commands = [json.loads(command_data_json) for command_data_json in result[1:]]
+        if commands and sharded:
+            try:
+                hack_events.record_hack_events(device_ip, commands, now, redis_client)
+            except redis.RedisError as e:
+                # The commands were delivered anyway, only the hack statistics miss them
+                log_event('hack_events_not_recorded', level='error', device_ip=device_ip, error=str(e))
+        return True, "Device is active", commands
+    except Exception as e:
+        return False, str(e), []
+
+def _poll_script_args(device_ip, device_timeout_seconds, max_commands):
+    """
+    Build the keys and arguments of POLL_DEVICE_SCRIPT.
+    Parameters:
+    - device_ip: The IP address of the device.
+    - device_timeout_seconds: The time interval in seconds within which the device must be seen.
+    - max_commands: The maximum number of queued commands to pop.
+    Returns:
+    - keys: The keys of the script.
+    - args: The arguments of the script.
+    - now: The epoch time the commands are delivered at.
+    - sharded: True if the hacks must be recorded after the script, on the node holding the hack event stream.
+    """
+    indexes = device_indexes_for(device_ip)
+    keys = [device_key(device_ip), device_command_key(device_ip), indexes['last_seen'], indexes['last_hacked_time'], device_wakeup_key(device_ip)]
+    now = get_current_epoch_time()
+    args = [now, device_timeout_seconds, device_ip, max_commands, hack_events.HACK_EVENTS_MAX_LENGTH]
+    sharded = device_shard(device_ip) is not None
+    if not sharded:
+        # The hack event stream is on the same node, so the script records the hacks too
+        keys += hack_events.hack_event_script_keys()
+    return keys, args, now, sharded
+
+def _queue_command_keys(device_ip):
+    # Keys of QUEUE_DEVICE_COMMAND_SCRIPT
+    return [device_command_key(device_ip), device_wakeup_key(device_ip), device_key(device_ip)]
+
+def _queue_command_script_args(command_data, device_timeout_seconds, max_queued_commands, coalesce):
+    # Arguments of QUEUE_DEVICE_COMMAND_SCRIPT shared by every device, to follow with the password hash of each
+    return [json.dumps(command_data), command_data['command'], 1 if coalesce else 0, max_queued_commands, device_timeout_seconds]
+
+def _queue_result(result):
+    # Status and message for the result of QUEUE_DEVICE_COMMAND_SCRIPT, a queue length or an error code
+    if result <= 0:
+        return False, QUEUE_ERRORS.get(result, "Device not found")
+    return True, "Good"
+
+def queue_device_command(device_ip, command_data, device_timeout_seconds, redis_client, max_queued_commands=10, coalesce=False, password_hash=None):
+    """
+    Add a command to the end of a device's command queue and wake up any long poll waiting on it.
+    Parameters:
+    - device_ip: The IP address of the device.
+    - command_data: Dictionary with the command and its params.
+    - device_timeout_seconds: The time interval in seconds after which the queue expires if not picked up.
+    - redis_client: The Redis client object.
+    - max_queued_commands: The maximum number of commands that can wait in the queue.
+    - coalesce: True to drop queued commands of the same type, so only the latest one is delivered.
+    - password_hash: If set, the command is only queued if the device password still has this hash,
+      checked atomically in Redis so a stale cached hash can never authorize a command.
+    Returns:
+    - status: True if the command was queued, False otherwise.
+    - message: A message indicating the result of the operation.
+    """
+    keys = _queue_command_keys(device_ip)
+    args = _queue_command_script_args(command_data, device_timeout_seconds, max_queued_commands, coalesce) + [password_hash or '']
+    node_client = client_for_device(device_ip, redis_client)
+    result = run_script(QUEUE_DEVICE_COMMAND_SCRIPT, node_client, keys, args)
+    if result == -3:
+        # Device is still in the legacy format, so migrate it and try again
+        migrate_device_record(device_ip, device_timeout_seconds, redis_client)
+        result = run_script(QUEUE_DEVICE_COMMAND_SCRIPT, node_client, keys, args)
+    return _queue_result(result)
+
+def queue_device_commands(device_ips, command_data, device_timeout_seconds, redis_client, max_queued_commands=10, coalesce=False, password_hashes=None):
+    """
+    Add the same command to the command queues of many devices in one Redis transaction on each node.
+    Parameters:
+    - device_ips: List of the IP addresses of the devices.
+    - command_data: Dictionary with the command and its params.
+    - device_timeout_seconds: The time interval in seconds after which the queues expire if not picked up.
+    - redis_client: The Redis client object.
+    - max_queued_commands: The maximum number of commands that can wait in each queue.
+    - coalesce: True to drop queued commands of the same type, so only the latest one is delivered.
+    - password_hashes: If set, dictionary mapping each IP address to the password hash the device must still have.
+    Returns:
+    - results: Dictionary mapping each IP address to a (status, message) tuple.
+    """
+    password_hashes = password_hashes or {}
+    args = _queue_command_script_args(command_data, device_timeout_seconds, max_queued_commands, coalesce)
+
+    def queue_on_node(group):
+        node_client, node_device_ips = group
+        pipeline = node_client.pipeline()
+        for device_ip in node_device_ips:
+            run_script(QUEUE_DEVICE_COMMAND_SCRIPT, pipeline, _queue_command_keys(device_ip), args + [password_hashes.get(device_ip) or ''])
+        return zip(node_device_ips, pipeline.execute())
+
+    queue_lengths = {device_ip: queue_length for results in fan_out(queue_on_node, group_devices_by_node(device_ips, redis_client)) for device_ip, queue_length in results}
+    results = {}
+    for device_ip in device_ips:
+        queue_length = queue_lengths[device_ip]
+        if queue_length == -3:
+            # Device is still in the legacy format, which queue_device_command migrates
+            results[device_ip] = queue_device_command(device_ip, command_data, device_timeout_seconds, redis_client, max_queued_commands, coalesce, password_hashes.get(device_ip))
+        else:
+            results[device_ip] = _queue_result(queue_length)
+    return results
+
+def wait_for_device_command(device_ip, wait_seconds, redis_client):
+    """
+    Block until a command is queued for a device or the wait times out.
+    Parameters:
+    - device_ip: The IP address of the device.
+    - wait_seconds: The longest time in seconds to wait for a command.
+    - redis_client: The Redis client object.
+    Returns:
+    - status: True if a command was queued while waiting, False if the wait timed out.
+    """
+    return client_for_device(device_ip, redis_client).blpop([device_wakeup_key(device_ip)], timeout=wait_seconds) is not None
+
+def update_device_passwords(device_ips, new_password, redis_client):
+    """
+    Updates the password for many devices in one Redis transaction on each node.
+    Parameters:
+    - device_ips: List of the IP addresses of the devices.
+    - new_password: The new password for the devices.
+    - redis_client: The Redis client object.
+    Returns:
+    - results: Dictionary mapping each IP address to a (status, message) tuple.
+    """
+    fields = _password_fields(new_password)[1]
+
+    def update_on_node(group):
+        node_client, node_device_ips = group
+        pipeline = node_client.pipeline()
+        for device_ip in node_device_ips:
+            run_script(UPDATE_DEVICE_FIELDS_SCRIPT, pipeline, *_update_fields_script_args(device_ip, fields))
+        return zip(node_device_ips, pipeline.execute())
+
+    updated_devices = {device_ip: updated for results in fan_out(update_on_node, group_devices_by_node(device_ips, redis_client)) for device_ip, updated in results}
+    results = {}
+    for device_ip in device_ips:
+        if updated_devices[device_ip]:
+            results[device_ip] = (True, "Successfully updated password")
+        else:
+            # Device may still be in the legacy format, which update_password migrates
+            status, message, _ = update_password(device_ip, new_password, redis_client)
+            results[device_ip] = (status, message)
+    return results
+
 def update_password(device_ip, new_password, redis_client):
     """
     Updates the password for a device in the database.
@@ -155,25 +758,13 @@ def update_password(device_ip, new_password, redis_client):
     - message: A message indicating the result of the operation.
     """
     try:
-        redis_key = f"device:{device_ip}"
-        if not redis_client.exists(redis_key):
-            return False, "Device not found", None
-
-        # Load device data from Redis
-        device_data = json.loads(redis_client.get(redis_key))
-        
-        # Generate random insecure md5 password
-        hashed_password = hashlib.md5(new_password.encode()).hexdigest()
-
-        # Update device data values
-        device_data['last_seen'] = get_current_utc_time_string()
-        device_data['password'] = hashed_password
-        device_data['raw_password'] = new_password
-
-        # Set values in Redis
-        redis_client.set(redis_key, json.dumps(device_data))
+        # Update only the password fields in Redis
+        hashed_password, fields = _password_fields(new_password)
+        status, message = update_device_fields(device_ip, fields, redis_client)
+        if not status:
+            return False, message, None
 
         return True, "Successfully updated password", hashed_password
-    
+
     except Exception as e:
-        return False, "Error updating password: " + str(e), None
\ No newline at end of file
+        return False, "Error updating password: " + str(e), None
@@ -0,0 +1,321 @@
+"""
+Device helpers for the asyncio serving mode, using a redis.asyncio client.
+
+Each helper takes the same parameters and returns the same values as the one of the same name in
+device.py, which documents them and the record layout. They only send the commands built by the shared
+_queue and _script_args helpers there, awaiting each round trip, so the Flask and ASGI servers can share
+one Redis. Long polls wait on an asyncio.Event woken from a single pub/sub subscription per Redis node
+instead of holding a Redis connection each. With sharding, redis_client is a ShardRing of redis.asyncio
+clients and queries over many nodes are sent to them concurrently.
+"""
+import asyncio
+import contextlib
+import json
+import redis
+from helper_functions.device import _decode_device_data, _parse_legacy_device_data, _queue_insert_device, _queue_password_reads, _decode_password_hashes, _queue_migrated_record, _update_fields_script_args, _last_seen_fields, _password_fields, _poll_script_args, _queue_command_keys, _queue_command_script_args, _queue_result, _prune_script_args, _index_keys, _queue_index_page_reads, _page_device_ips, _queue_device_row_reads, _device_rows
+from helper_functions.redis_scripts import POLL_DEVICE_SCRIPT, QUEUE_DEVICE_COMMAND_SCRIPT, UPDATE_DEVICE_FIELDS_SCRIPT, PRUNE_DEVICE_INDEXES_SCRIPT, DEVICE_WAKEUP_CHANNEL, run_script_async
+from helper_functions.sharding import device_key, device_wakeup_key, device_ip_from_key, client_for_device, group_devices_by_node, group_shards_by_node, node_clients
+from helper_functions import hack_events
+from helper_functions.event_log import log_event
+
+# Events of the long polls waiting on each device, set when a command is queued for the device
+_wakeup_events = {}
+_wakeup_listener = None
+
+async def _fan_out(function, items):
+    # Await a coroutine for every item concurrently, keeping the order of the items
+    return await asyncio.gather(*(function(item) for item in items))
+
+async def insert_device(device_ip, device_timeout_seconds, redis_client):
+    # Insert a new device into the database with a random password
+    try:
+        pipeline = client_for_device(device_ip, redis_client).pipeline()
+        raw_password = _queue_insert_device(pipeline, device_ip, device_timeout_seconds)
+        await pipeline.execute()
+        return True, "Good", raw_password
+    except Exception as e:
+        return False, str(e), None
+
+async def get_device_data(device_ip, redis_client):
+    # Get the record for a device, reading both the hash layout and the legacy JSON layout
+    redis_key = device_key(device_ip)
+    redis_client = client_for_device(device_ip, redis_client)
+    try:
+        device_data = await redis_client.hgetall(redis_key)
+    except redis.ResponseError:
+        # Key is still a legacy JSON string
+        return _parse_legacy_device_data(await redis_client.get(redis_key))
+    return _decode_device_data(device_data)
+
+async def get_device_password_hashes(device_ips, redis_client):
+    # Get the password hashes of many devices in a single round trip to each node
+    async def read_passwords(group):
+        node_client, node_device_ips = group
+        pipeline = node_client.pipeline(transaction=False)
+        _queue_password_reads(pipeline, node_device_ips)
+        return zip(node_device_ips, await pipeline.execute(raise_on_error=False))
+
+    passwords = {device_ip: password for results in await _fan_out(read_passwords, group_devices_by_node(device_ips, redis_client)) for device_ip, password in results}
+    password_hashes, legacy_device_ips = _decode_password_hashes(device_ips, passwords)
+    for device_ip in legacy_device_ips:
+        device_data = await get_device_data(device_ip, redis_client)
+        password_hashes[device_ip] = device_data.get('password') if device_data else None
+    return password_hashes
+
+async def migrate_device_record(device_ip, device_timeout_seconds, redis_client):
+    # Convert a device stored in the legacy JSON layout to the hash layout
+    redis_key = device_key(device_ip)
+    try:
+        async with client_for_device(device_ip, redis_client).pipeline() as pipeline:
+            # Watch the key so a concurrent writer can't be overwritten by the migration
+            await pipeline.watch(redis_key)
+            if await pipeline.type(redis_key) != b'string':
+                return False, "Device is not in the legacy format"
+            device_data = _parse_legacy_device_data(await pipeline.get(redis_key))
+            pipeline.multi()
+            _queue_migrated_record(pipeline, device_ip, device_data, device_timeout_seconds)
+            await pipeline.execute()
+        return True, "Successfully migrated device"
+    except redis.WatchError:
+        return False, "Device changed during migration"
+    except Exception as e:
+        return False, str(e)
+
+async def update_device_fields(device_ip, fields, redis_client, device_timeout_seconds=0):
+    # Set fields on a device record with a single HSET, without touching the other fields
+    keys, args = _update_fields_script_args(device_ip, fields, device_timeout_seconds)
+    node_client = client_for_device(device_ip, redis_client)
+    if await run_script_async(UPDATE_DEVICE_FIELDS_SCRIPT, node_client, keys, args):
+        return True, "Good"
+    # Device may still be in the legacy format, so migrate it and try again
+    status, message = await migrate_device_record(device_ip, device_timeout_seconds, redis_client)
+    if status and await run_script_async(UPDATE_DEVICE_FIELDS_SCRIPT, node_client, keys, args):
+        return True, "Good"
+    return False, "Device not found"
+
+async def update_last_seen(device_ip, device_timeout_seconds, redis_client, last_hacked=False):
+    # Update the last seen time for a device and push back its expiry
+    try:
+        return await update_device_fields(device_ip, _last_seen_fields(last_hacked), redis_client, device_timeout_seconds)
+    except Exception as e:
+        return False, str(e)
+
+async def update_password(device_ip, new_password, redis_client):
+    # Update the password for a device
+    try:
+        hashed_password, fields = _password_fields(new_password)
+        status, message = await update_device_fields(device_ip, fields, redis_client)
+        if not status:
+            return False, message, None
+        return True, "Successfully updated password", hashed_password
+    except Exception as e:
+        return False, "Error updating password: " + str(e), None
+
+async def update_device_passwords(device_ips, new_password, redis_client):
+    # Update the password for many devices in one Redis transaction on each node
+    fields = _password_fields(new_password)[1]
+
+    async def update_on_node(group):
+        node_client, node_device_ips = group
+        pipeline = node_client.pipeline()
+        for device_ip in node_device_ips:
+            await run_script_async(UPDATE_DEVICE_FIELDS_SCRIPT, pipeline, *_update_fields_script_args(device_ip, fields))
+        return zip(node_device_ips, await pipeline.execute())
+
+    updated_devices = {device_ip: updated for results in await _fan_out(update_on_node, group_devices_by_node(device_ips, redis_client)) for device_ip, updated in results}
+    results = {}
+    for device_ip in device_ips:
+        if updated_devices[device_ip]:
+            results[device_ip] = (True, "Successfully updated password")
+        else:
+            # Device may still be in the legacy format, which update_password migrates
+            status, message, _ = await update_password(device_ip, new_password, redis_client)
+            results[device_ip] = (status, message)
+    return results
+
+async def poll_device(device_ip, device_timeout_seconds, redis_client, max_commands=1):
+    # Check that a device is active, refresh it and pop its queued commands in a single round trip
+    try:
+        keys, args, now, sharded = _poll_script_args(device_ip, device_timeout_seconds, max_commands)
+        node_client = client_for_device(device_ip, redis_client)
+        result = await run_script_async(POLL_DEVICE_SCRIPT, node_client, keys, args)
+        if result[0] == 3:
+            # Device is still in the legacy format, so migrate it and try again
+            await migrate_device_record(device_ip, device_timeout_seconds, redis_client)
+            result = await run_script_async(POLL_DEVICE_SCRIPT, node_client, keys, args)
+        if result[0] != 2:
+            return False, "Device not found", []
+        commands = [json.loads(command_data_json) for command_data_json in result[1:]]
+        if commands and sharded:
+            try:
+                await hack_events.record_hack_events_async(device_ip, commands, now, redis_client)
+            except redis.RedisError as e:
+                # The commands were delivered anyway, only the hack statistics miss them
+                log_event('hack_events_not_recorded', level='error', device_ip=device_ip, error=str(e))
+        return True, "Device is active", commands
+    except Exception as e:
+        return False, str(e), []
+
+async def queue_device_command(device_ip, command_data, device_timeout_seconds, redis_client, max_queued_commands=10, coalesce=False, password_hash=None):
+    # Add a command to the end of a device's command queue and wake up any long poll waiting on it
+    keys = _queue_command_keys(device_ip)
+    args = _queue_command_script_args(command_data, device_timeout_seconds, max_queued_commands, coalesce) + [password_hash or '']
+    node_client = client_for_device(device_ip, redis_client)
+    result = await run_script_async(QUEUE_DEVICE_COMMAND_SCRIPT, node_client, keys, args)
+    if result == -3:
+        # Device is still in the legacy format, so migrate it and try again
+        await migrate_device_record(device_ip, device_timeout_seconds, redis_client)
+        result = await run_script_async(QUEUE_DEVICE_COMMAND_SCRIPT, node_client, keys, args)
+    return _queue_result(result)
+
+async def queue_device_commands(device_ips, command_data, device_timeout_seconds, redis_client, max_queued_commands=10, coalesce=False, password_hashes=None):
+    # Add the same command to the command queues of many devices in one Redis transaction on each node
+    password_hashes = password_hashes or {}
+    args = _queue_command_script_args(command_data, device_timeout_seconds, max_queued_commands, coalesce)
+
+    async def queue_on_node(group):
+        node_client, node_device_ips = group
+        pipeline = node_client.pipeline()
+        for device_ip in node_device_ips:
+            await run_script_async(QUEUE_DEVICE_COMMAND_SCRIPT, pipeline, _queue_command_keys(device_ip), args + [password_hashes.get(device_ip) or ''])
+        return zip(node_device_ips, await pipeline.execute())
+
+    queue_lengths = {device_ip: queue_length for results in await _fan_out(queue_on_node, group_devices_by_node(device_ips, redis_client)) for device_ip, queue_length in results}
+    results = {}
+    for device_ip in device_ips:
+        queue_length = queue_lengths[device_ip]
+        if queue_length == -3:
+            # Device is still in the legacy format, which queue_device_command migrates
+            results[device_ip] = await queue_device_command(device_ip, command_data, device_timeout_seconds, redis_client, max_queued_commands, coalesce, password_hashes.get(device_ip))
+        else:
+            results[device_ip] = _queue_result(queue_length)
+    return results
+
+async def prune_device_indexes(device_timeout_seconds, redis_client, limit=1000):
+    # Drop devices that have expired from the device indexes
+    args = _prune_script_args(device_timeout_seconds, limit)
+
+    async def prune_node(group):
+        node_client, shards = group
+        if len(shards) == 1:
+            return await run_script_async(PRUNE_DEVICE_INDEXES_SCRIPT, node_client, _index_keys(shards[0]), args)
+        # Prune every shard on the node in one round trip
+        pipeline = node_client.pipeline(transaction=False)
+        for shard in shards:
+            await run_script_async(PRUNE_DEVICE_INDEXES_SCRIPT, pipeline, _index_keys(shard), args)
+        return sum(await pipeline.execute())
+
+    return sum(await _fan_out(prune_node, group_shards_by_node(redis_client)))
+
+async def list_devices(device_timeout_seconds, redis_client, page=1, per_page=50, sort_by='last_seen'):
+    # Get one page of active devices from the device indexes, most recent first
+    await prune_device_indexes(device_timeout_seconds, redis_client)
+    start = (page - 1) * per_page
+    shard_groups = group_shards_by_node(redis_client)
+    single_index = len(shard_groups) == 1 and len(shard_groups[0][1]) == 1
+
+    async def read_indexes(group):
+        node_client, shards = group
+        pipeline = node_client.pipeline(transaction=False)
+        _queue_index_page_reads(pipeline, shards, sort_by, start, per_page, single_index)
+        return await pipeline.execute()
+
+    total, device_ips = _page_device_ips(await _fan_out(read_indexes, shard_groups), start, per_page, single_index)
+
+    # Fetch every device on the page in a single round trip to each node
+    async def read_devices(group):
+        node_client, node_device_ips = group
+        pipeline = node_client.pipeline(transaction=False)
+        _queue_device_row_reads(pipeline, node_device_ips)
+        return zip(node_device_ips, await pipeline.execute())
+
+    device_groups = group_devices_by_node(device_ips, redis_client)
+    device_fields = {device_ip: fields for results in await _fan_out(read_devices, device_groups) for device_ip, fields in results}
+    return _device_rows(device_ips, device_fields), total
+
+def start_wakeup_listener(redis_client):
+    """
+    Start a background task that wakes the long polls of a device whenever a command is queued for it.
+    Parameters:
+    - redis_client: The redis.asyncio client object or ShardRing, whose every node is subscribed to.
+    Returns:
+    - task: The asyncio task handling the subscriptions.
+    """
+    global _wakeup_listener
+    _wakeup_listener = asyncio.create_task(_fan_out(_listen_for_wakeups, node_clients(redis_client)))
+    return _wakeup_listener
+
+async def stop_wakeup_listener():
+    """
+    Stop the background task started by start_wakeup_listener.
+    """
+    global _wakeup_listener
+    if _wakeup_listener is None:
+        return
+    _wakeup_listener.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await _wakeup_listener
+    _wakeup_listener = None
+
+async def _listen_for_wakeups(redis_client):
+    while True:
+        try:
+            async with redis_client.pubsub(ignore_subscribe_messages=True) as pubsub:
+                await pubsub.subscribe(DEVICE_WAKEUP_CHANNEL)
+                while True:
+                    # Wait a second at a time, so a socket timeout on the connection pool doesn't look like a lost connection
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+                    if message is None:
+                        continue
+                    device_ip = device_ip_from_key(message['data'].decode())
+                    for event in _wakeup_events.get(device_ip, ()):
+                        event.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log_event('device_wakeup_listener_failed', level='error', error=str(e))
+            # Commands may have been queued while disconnected, so every waiting long poll polls again
+            for events in _wakeup_events.values():
+                for event in events:
+                    event.set()
+            await asyncio.sleep(1)
+
+@contextlib.contextmanager
+def watch_device_commands(device_ip):
+    """
+    Watch for commands queued for a device. Start watching before polling the device,
+    so a command queued between the poll and the wait still wakes it.
+    Parameters:
+    - device_ip: The IP address of the device.
+    Returns:
+    - wakeup: The event set when a command is queued for the device.
+    """
+    wakeup = asyncio.Event()
+    _wakeup_events.setdefault(device_ip, set()).add(wakeup)
+    try:
+        yield wakeup
+    finally:
+        events = _wakeup_events.get(device_ip)
+        events.discard(wakeup)
+        if not events:
+            del _wakeup_events[device_ip]
+
+async def wait_for_device_command(device_ip, wakeup, wait_seconds, redis_client):
+    """
+    Wait until a command is queued for a device or the wait times out.
+    Falls back to blocking on the device wakeup key if the wakeup listener is not running.
+    Parameters:
+    - device_ip: The IP address of the device.
+    - wakeup: The event from watch_device_commands.
+    - wait_seconds: The longest time in seconds to wait for a command.
+    - redis_client: The redis.asyncio client object.
+    Returns:
+    - status: True if a command was queued while waiting, False if the wait timed out.
+    """
+    if _wakeup_listener is None or _wakeup_listener.done():
+        return await client_for_device(device_ip, redis_client).blpop([device_wakeup_key(device_ip)], timeout=wait_seconds) is not None
+    try:
+        await asyncio.wait_for(wakeup.wait(), wait_seconds)
+        return True
+    except asyncio.TimeoutError:
+        return False
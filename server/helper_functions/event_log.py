@@ -0,0 +1,148 @@
+"""
+Structured event log written as JSON lines from a background thread.
+
+log_event only puts the event on a bounded in-memory queue, so a request never waits on console
+or file I/O: if the writer falls behind and the queue fills up, events are dropped and counted
+instead. The writer thread encodes and redacts the events and writes them in batches.
+High-rate events such as failed password guesses can be sampled, and every sampled event carries
+its sample_rate so counts can be scaled back up.
+"""
+import atexit
+import hashlib
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+LOG_QUEUE_SIZE = 10000 # Most events waiting for the writer before new ones are dropped
+LOG_BATCH_SIZE = 256 # Most events written at once
+LOG_FLUSH_INTERVAL_SECONDS = 0.5 # Longest time an event waits for a batch to fill up
+
+# Fields holding secrets, and how they are written: 'redact' replaces them, 'hash' writes a short
+# SHA-256 digest so repeated guesses can still be correlated, 'none' writes them as they are
+REDACTED_FIELDS = {'password', 'new_password', 'raw_password', 'admin_token'}
+REDACTION_POLICIES = ('redact', 'hash', 'none')
+_redaction = 'redact'
+
+# Fraction of each event name to keep, for events not listed every one is kept
+_sample_rates = {}
+_stream = sys.stdout
+_log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_dropped_events = 0
+_dropped_events_lock = threading.Lock()
+# Process the writer thread was started in, so a forked worker starts its own
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+def configure_event_log(stream=None, redaction='redact', sample_rates=None):
+    """
+    Set where events are written and how they are redacted and sampled.
+    Parameters:
+    - stream: File object the JSON lines are written to, standard output by default.
+    - redaction: How password fields are written, one of REDACTION_POLICIES.
+    - sample_rates: Dictionary mapping event names to the fraction of those events to keep.
+    """
+    global _stream, _redaction, _sample_rates
+    if redaction not in REDACTION_POLICIES:
+        raise ValueError(f"Unknown redaction policy {redaction!r}, expected one of {', '.join(REDACTION_POLICIES)}")
+    _stream = stream or sys.stdout
+    _redaction = redaction
+    _sample_rates = dict(sample_rates or {})
+
+def log_event(event, level='info', **fields):
+    """
+    Queue an event to be written, without waiting on any I/O.
+    Parameters:
+    - event: Name of the event, e.g. failed_guess.
+    - level: Severity of the event, e.g. info or error.
+    - fields: Values written with the event. Password fields are redacted by the writer.
+    Returns:
+    - status: True if the event was queued, False if it was sampled out or the queue is full.
+    """
+    global _dropped_events
+    sample_rate = _sample_rates.get(event, 1)
+    if sample_rate < 1:
+        if random.random() >= sample_rate:
+            return False
+        fields['sample_rate'] = sample_rate
+    _ensure_writer()
+    try:
+        _log_queue.put_nowait((time.time(), level, event, fields))
+        return True
+    except queue.Full:
+        with _dropped_events_lock:
+            _dropped_events += 1
+        return False
+
+def flush_event_log(timeout=5):
+    """
+    Wait until every queued event has been written.
+    Parameters:
+    - timeout: Longest time in seconds to wait.
+    Returns:
+    - status: True if the queue was emptied, False if the timeout passed first.
+    """
+    if _writer_pid != os.getpid():
+        return _log_queue.empty()
+    deadline = time.monotonic() + timeout
+    while _log_queue.unfinished_tasks:
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def _ensure_writer():
+    global _writer_pid, _log_queue
+    if _writer_pid == os.getpid():
+        return
+    with _writer_lock:
+        if _writer_pid == os.getpid():
+            return
+        if _writer_pid is not None:
+            # Forked from a process that was already logging, whose writer thread didn't survive the fork
+            _log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        threading.Thread(target=_write_events, args=(_log_queue,), daemon=True).start()
+        _writer_pid = os.getpid()
+
+def _redact(value):
+    if _redaction == 'none' or value is None:
+        return value
+    if _redaction == 'hash':
+        return 'sha256:' + hashlib.sha256(str(value).encode()).hexdigest()[:12]
+    return '[REDACTED]'
+
+def _encode_event(timestamp, level, event, fields):
+    record = {'time': round(timestamp, 3), 'level': level, 'event': event}
+    for name, value in fields.items():
+        record[name] = _redact(value) if name in REDACTED_FIELDS else value
+    return json.dumps(record, default=str)
+
+def _write_events(log_queue):
+    global _dropped_events
+    while True:
+        # Wait for one event, then take whatever else is already queued, up to a batch
+        batch = [log_queue.get()]
+        deadline = time.monotonic() + LOG_FLUSH_INTERVAL_SECONDS
+        while len(batch) < LOG_BATCH_SIZE:
+            try:
+                batch.append(log_queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        with _dropped_events_lock:
+            dropped, _dropped_events = _dropped_events, 0
+        lines = [_encode_event(*item) for item in batch]
+        if dropped:
+            lines.append(_encode_event(time.time(), 'warning', 'log_events_dropped', {'count': dropped}))
+        try:
+            _stream.write('\n'.join(lines) + '\n')
+            _stream.flush()
+        except Exception:
+            # Nowhere left to report a broken log stream, so drop the batch rather than stop logging
+            pass
+        for _ in batch:
+            log_queue.task_done()
+
+atexit.register(flush_event_log, 1)
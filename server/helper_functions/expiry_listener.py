@@ -0,0 +1,99 @@
+"""
+Optional listener for Redis keyspace notifications about expired device keys.
+
+Devices expire on their own through key TTLs, so nothing has to run for stale devices to
+disappear. The listener is only needed for cleanup hooks that should react to an expiry.
+"""
+import threading
+import time
+from helper_functions.event_log import log_event
+from helper_functions.sharding import device_ip_from_key, node_clients
+
+# Functions called with the IP address of each device that expires
+_device_expired_hooks = []
+
+def register_device_expired_hook(hook):
+    """
+    Register a function to call whenever a device key expires.
+    Parameters:
+    - hook: Function taking the IP address of the expired device and the Redis client object.
+    """
+    _device_expired_hooks.append(hook)
+
+def start_expiry_listener(redis_client, configure_notifications=True):
+    """
+    Start a background thread on each Redis node that calls the registered hooks when device keys expire.
+    Parameters:
+    - redis_client: The Redis client object or ShardRing.
+    - configure_notifications: True to enable expired key events on the Redis servers,
+      False if the servers are already configured (e.g. CONFIG is disabled on a managed Redis).
+    Returns:
+    - threads: List of the background threads handling the notifications.
+    """
+    threads = []
+    for node, node_client in enumerate(node_clients(redis_client)):
+        thread = threading.Thread(target=_listen_for_expired_keys, args=(node, node_client, redis_client, configure_notifications), daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+def merge_notification_flags(current_flags, required_flags='Ex'):
+    """
+    Add flags to the notify-keyspace-events setting, keeping the ones already set.
+    Parameters:
+    - current_flags: The current setting, e.g. 'Kg'.
+    - required_flags: The flags needed.
+    Returns:
+    - flags: The current flags followed by any required ones missing, e.g. 'KgEx'.
+    """
+    flags = current_flags
+    for flag in required_flags:
+        # A stands for every key event class, expired ones (x) included
+        if flag not in flags and not (flag in 'g$lshzxetd' and 'A' in flags):
+            flags += flag
+    return flags
+
+def enable_expired_key_events(node_client):
+    # Turn on the expired key events without turning off any other notifications the server sends
+    current_flags = node_client.config_get('notify-keyspace-events').get('notify-keyspace-events', '')
+    flags = merge_notification_flags(current_flags)
+    if flags != current_flags:
+        node_client.config_set('notify-keyspace-events', flags)
+
+def _listen_for_expired_keys(node, node_client, redis_client, configure_notifications):
+    db = node_client.connection_pool.connection_kwargs.get('db', 0)
+
+    def handle_expired_key(message):
+        redis_key = message['data'].decode()
+        if not redis_key.startswith('device:'):
+            return
+        device_ip = device_ip_from_key(redis_key)
+        for hook in _device_expired_hooks:
+            try:
+                hook(device_ip, redis_client)
+            except Exception as e:
+                log_event('device_expired_hook_failed', level='error', device_ip=device_ip, hook=getattr(hook, '__name__', repr(hook)), error=str(e))
+
+    failing = False
+    while True:
+        pubsub = node_client.pubsub(ignore_subscribe_messages=True)
+        connected = False
+        try:
+            # Configure again after every reconnect, since a restarted Redis may have lost the setting
+            if configure_notifications:
+                enable_expired_key_events(node_client)
+            pubsub.subscribe(**{f"__keyevent@{db}__:expired": handle_expired_key})
+            connected = True
+            # Every message is handled by the callback. Wait for them a second at a time, so a socket
+            # timeout on the connection pool doesn't look like a lost connection.
+            while True:
+                pubsub.get_message(timeout=1)
+        except Exception as e:
+            # Expiries while disconnected are missed, and their devices stay in the indexes until pruned.
+            # Log once when the listener stops working rather than on every retry.
+            if connected or not failing:
+                log_event('expiry_listener_disconnected', level='error', node=node, error=str(e))
+            failing = not connected
+        finally:
+            pubsub.close()
+        time.sleep(1)
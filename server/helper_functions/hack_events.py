@@ -0,0 +1,128 @@
+"""
+Stream of hack events and the leaderboards counted from them.
+
+Every command delivered to a device is a hack. Each one is appended to a capped Redis Stream with the
+device, the command and the IP address that sent it, and counted in two sorted sets, so the leaderboards
+answer top N queries in O(log N) and consumers can replay the stream from a cursor instead of scanning
+every device.
+
+In the single node layout the poll script records the hacks in the same round trip that delivers the
+commands. With sharded devices the stream and the leaderboards stay on the primary node, like the other
+keys that don't belong to a device, and are written by one more pipeline after the delivery.
+"""
+import re
+
+HACK_EVENTS_STREAM = 'hack_events' # Stream of every delivered command
+HACKED_DEVICES_LEADERBOARD = 'leaderboard:hacked_devices' # Device IP addresses scored by the commands delivered to them
+HACKERS_LEADERBOARD = 'leaderboard:hackers' # Source IP addresses scored by the commands they sent that were delivered
+
+HACK_EVENTS_MAX_LENGTH = 10000 # Roughly how many of the latest hack events the stream keeps
+
+# Stream entry IDs as used for cursors, with 0 for the start of the stream
+HACK_EVENT_CURSOR_PATTERN = re.compile(r'^\d+(-\d+)?$')
+
+def configure_hack_events(max_length=HACK_EVENTS_MAX_LENGTH):
+    """
+    Set how many hack events the stream keeps.
+    Parameters:
+    - max_length: Roughly how many of the latest hack events to keep.
+    """
+    global HACK_EVENTS_MAX_LENGTH
+    HACK_EVENTS_MAX_LENGTH = max_length
+
+def hack_event_script_keys():
+    # Keys the poll script records the hacks in, in the order it expects them
+    return [HACK_EVENTS_STREAM, HACKED_DEVICES_LEADERBOARD, HACKERS_LEADERBOARD]
+
+def is_valid_cursor(cursor):
+    # Whether a cursor is a stream entry ID
+    return bool(HACK_EVENT_CURSOR_PATTERN.match(cursor))
+
+def _queue_hack_events(pipeline, device_ip, commands, hacked_time):
+    for command_data in commands:
+        source_ip = command_data.get('source_ip') or ''
+        pipeline.xadd(HACK_EVENTS_STREAM, {'ip_address': device_ip, 'command': str(command_data.get('command')), 'source_ip': source_ip, 'time': hacked_time}, maxlen=HACK_EVENTS_MAX_LENGTH, approximate=True)
+        pipeline.zincrby(HACKED_DEVICES_LEADERBOARD, 1, device_ip)
+        if source_ip:
+            pipeline.zincrby(HACKERS_LEADERBOARD, 1, source_ip)
+
+def record_hack_events(device_ip, commands, hacked_time, redis_client):
+    """
+    Record commands delivered to a device in the hack event stream and the leaderboards.
+    Only needed with sharded devices, since the poll script records them otherwise.
+    Parameters:
+    - device_ip: The IP address of the device.
+    - commands: List of the delivered commands.
+    - hacked_time: Epoch time the commands were delivered.
+    - redis_client: The Redis client object or ShardRing, whose primary node holds the stream.
+    """
+    pipeline = redis_client.pipeline(transaction=False)
+    _queue_hack_events(pipeline, device_ip, commands, hacked_time)
+    pipeline.execute()
+
+async def record_hack_events_async(device_ip, commands, hacked_time, redis_client):
+    """
+    Record commands delivered to a device in the hack event stream and the leaderboards.
+    Parameters:
+    - device_ip: The IP address of the device.
+    - commands: List of the delivered commands.
+    - hacked_time: Epoch time the commands were delivered.
+    - redis_client: The redis.asyncio client object or ShardRing, whose primary node holds the stream.
+    """
+    pipeline = redis_client.pipeline(transaction=False)
+    _queue_hack_events(pipeline, device_ip, commands, hacked_time)
+    await pipeline.execute()
+
+def read_hack_events(cursor, limit, redis_client):
+    """
+    Read the hack events recorded after a cursor, oldest first.
+    Parameters:
+    - cursor: ID of the last event already read, or 0 to read from the oldest event still kept.
+    - limit: The maximum number of events to read.
+    - redis_client: The Redis client object or ShardRing.
+    Returns:
+    - events: List of dictionaries with the id, ip_address, command, source_ip and time of each event.
+    - cursor: ID of the last event read, to pass back for the next events, or the given cursor if there were none.
+    """
+    streams = redis_client.xread({HACK_EVENTS_STREAM: cursor}, count=limit)
+    events = []
+    for stream_name, entries in streams:
+        for entry_id, fields in entries:
+            events.append(format_hack_event(entry_id.decode(), {field.decode(): value.decode() for field, value in fields.items()}))
+    return events, events[-1]['id'] if events else cursor
+
+def format_hack_event(entry_id, fields):
+    """
+    Build the JSON form of a hack event.
+    Parameters:
+    - entry_id: The stream entry ID.
+    - fields: Dictionary of the entry fields as strings.
+    Returns:
+    - event: Dictionary with the id, ip_address, command, source_ip (None if unknown) and time of the event.
+    """
+    return {
+        'id': entry_id,
+        'ip_address': fields.get('ip_address'),
+        'command': fields.get('command'),
+        'source_ip': fields.get('source_ip') or None,
+        'time': int(fields.get('time', 0))
+    }
+
+def get_leaderboards(limit, redis_client):
+    """
+    Get the most hacked devices and the most successful hackers.
+    Parameters:
+    - limit: The number of entries on each leaderboard.
+    - redis_client: The Redis client object or ShardRing.
+    Returns:
+    - leaderboards: Dictionary with hacked_devices and hackers, each a list of dictionaries with the
+      ip_address and hacks, most hacks first.
+    """
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.zrevrange(HACKED_DEVICES_LEADERBOARD, 0, limit - 1, withscores=True)
+    pipeline.zrevrange(HACKERS_LEADERBOARD, 0, limit - 1, withscores=True)
+    hacked_devices, hackers = pipeline.execute()
+    return {
+        'hacked_devices': [{'ip_address': member.decode(), 'hacks': int(score)} for member, score in hacked_devices],
+        'hackers': [{'ip_address': member.decode(), 'hacks': int(score)} for member, score in hackers]
+    }
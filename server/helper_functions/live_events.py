@@ -0,0 +1,280 @@
+"""
+Live device events for the admin dashboard, streamed to the browser as server-sent events.
+
+Each process keeps a single subscription to the device events channel on every Redis node, started
+when the first dashboard connects, and hands every message to all the dashboards open on it. N open
+dashboards then cost one subscription instead of N rescans of the device indexes. With the memory
+store, the store hands its events over directly.
+
+Dashboards are sent JSON objects with the event and ip_address, plus the fields that changed:
+- joined: password_hash and last_seen
+- password_changed: password_hash
+- hacked: last_hacked_time
+- expired, removed: nothing else
+- resync: events may have been lost, so the dashboard should reload
+Expired devices are only reported by Redis with keyspace notifications on (DEVICE_EXPIRY_LISTENER).
+"""
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+from helper_functions.device import DEVICE_EVENTS_CHANNEL
+from helper_functions.event_log import log_event
+from helper_functions.sharding import device_ip_from_key, node_clients
+from helper_functions.time_helper import convert_epoch_to_string
+
+LIVE_EVENTS_KEEPALIVE_SECONDS = 15 # Longest silence on a stream, so proxies keep it open and dead viewers are noticed
+LIVE_EVENTS_RETRY_MILLISECONDS = 5000 # How long a browser waits before reconnecting a closed stream
+MAX_PENDING_EVENTS = 1000 # Events waiting for a slow viewer before it is told to reload instead
+
+# Names of the device events shown on the dashboards
+DASHBOARD_EVENTS = {'inserted': 'joined', 'expired': 'expired', 'removed': 'removed', 'password_changed': 'password_changed', 'hacked': 'hacked'}
+
+# Viewers of the dashboards open on this process
+_viewers = set()
+_viewers_lock = threading.Lock()
+# Where the device events come from, set by configure_live_events
+_redis_client = None
+_expiry_events = False
+# Process the listener threads were started in
+_listeners_pid = None
+
+def configure_live_events(redis_client=None, expiry_events=False):
+    """
+    Set where the device events come from.
+    Parameters:
+    - redis_client: The Redis client object or ShardRing to subscribe to, or None if the device store publishes its events itself.
+    - expiry_events: True to also report expired devices, if keyspace notifications are on in Redis.
+    """
+    global _redis_client, _expiry_events
+    _redis_client = redis_client
+    _expiry_events = expiry_events
+
+def dashboard_event(device_event):
+    """
+    Format a device event for the dashboards.
+    Parameters:
+    - device_event: Dictionary of the event as published on the device events channel.
+    Returns:
+    - event: Dictionary sent to the dashboards, or None if they don't show the event.
+    """
+    event_name = DASHBOARD_EVENTS.get(device_event.get('event'))
+    if not event_name or not device_event.get('ip_address'):
+        return None
+    event = {'event': event_name, 'ip_address': device_event['ip_address']}
+    if device_event.get('password_hash'):
+        event['password_hash'] = device_event['password_hash']
+    for field in ('last_seen', 'last_hacked_time'):
+        if device_event.get(field):
+            event[field] = convert_epoch_to_string(device_event[field])
+    return event
+
+def publish_live_event(device_event):
+    """
+    Send a device event to every dashboard open on this process.
+    Parameters:
+    - device_event: Dictionary of the event as published on the device events channel.
+    """
+    event = dashboard_event(device_event)
+    if event:
+        _deliver(event)
+
+def _deliver(event):
+    with _viewers_lock:
+        viewers = list(_viewers)
+    for viewer in viewers:
+        viewer.deliver(event)
+
+def add_viewer(viewer, max_viewers=None):
+    """
+    Start sending the device events to a dashboard, subscribing to Redis if it is the first one.
+    Parameters:
+    - viewer: The LiveEventViewer or AsyncLiveEventViewer of the dashboard.
+    - max_viewers: Most dashboards this process streams to at once, or None for no limit.
+    Returns:
+    - status: True if the viewer was added, False if there are too many already.
+    """
+    global _listeners_pid
+    with _viewers_lock:
+        if max_viewers is not None and len(_viewers) >= max_viewers:
+            return False
+        _viewers.add(viewer)
+        start_listeners = _redis_client is not None and _listeners_pid != os.getpid()
+        if start_listeners:
+            _listeners_pid = os.getpid()
+    if start_listeners:
+        start_live_event_listener(_redis_client, _expiry_events)
+    return True
+
+def remove_viewer(viewer):
+    """
+    Stop sending the device events to a dashboard.
+    Parameters:
+    - viewer: The viewer passed to add_viewer.
+    """
+    with _viewers_lock:
+        _viewers.discard(viewer)
+
+class LiveEventViewer:
+    """
+    Events waiting to be streamed to one dashboard by a request thread.
+    """
+    def __init__(self, max_pending=MAX_PENDING_EVENTS):
+        self._events = queue.Queue(max_pending)
+        # Set once an event had to be dropped, so the dashboard is out of date
+        self.overflowed = False
+
+    def deliver(self, event):
+        try:
+            self._events.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def next_event(self, timeout):
+        """
+        Wait for the next event.
+        Parameters:
+        - timeout: Longest time to wait in seconds.
+        Returns:
+        - event: The event dictionary, or None if there was none in time.
+        """
+        try:
+            return self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+class AsyncLiveEventViewer:
+    """
+    Events waiting to be streamed to one dashboard by a coroutine. Create it on the event loop serving the stream.
+    """
+    def __init__(self, max_pending=MAX_PENDING_EVENTS):
+        self._loop = asyncio.get_running_loop()
+        self._events = asyncio.Queue(max_pending)
+        self.overflowed = False
+
+    def deliver(self, event):
+        # Called from the listener threads, so hand the event over to the event loop
+        try:
+            self._loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # The event loop has closed
+            pass
+
+    def _put(self, event):
+        try:
+            self._events.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def next_event(self, timeout):
+        try:
+            return await asyncio.wait_for(self._events.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+def format_server_sent_event(event):
+    # One event in the text/event-stream format
+    return f"data: {json.dumps(event)}\n\n"
+
+def stream_live_events(viewer, max_seconds):
+    """
+    Stream the device events to a dashboard until it disconnects or max_seconds have passed,
+    after which the browser reconnects on its own. The viewer must have been added with add_viewer.
+    Parameters:
+    - viewer: The LiveEventViewer of the dashboard.
+    - max_seconds: Longest time to hold the request open.
+    Returns:
+    - stream: Generator of the text/event-stream chunks.
+    """
+    deadline = time.monotonic() + max_seconds
+    try:
+        yield f"retry: {LIVE_EVENTS_RETRY_MILLISECONDS}\n\n"
+        while (remaining := deadline - time.monotonic()) > 0:
+            event = viewer.next_event(min(LIVE_EVENTS_KEEPALIVE_SECONDS, remaining))
+            if viewer.overflowed:
+                yield format_server_sent_event({'event': 'resync'})
+                return
+            # A comment line keeps the connection busy, and fails once the dashboard has gone away
+            yield format_server_sent_event(event) if event else ": keepalive\n\n"
+    finally:
+        remove_viewer(viewer)
+
+async def stream_live_events_async(viewer, max_seconds):
+    """
+    Stream the device events to a dashboard, like stream_live_events but on an event loop.
+    Parameters:
+    - viewer: The AsyncLiveEventViewer of the dashboard.
+    - max_seconds: Longest time to hold the request open.
+    Returns:
+    - stream: Async generator of the text/event-stream chunks.
+    """
+    deadline = time.monotonic() + max_seconds
+    try:
+        yield f"retry: {LIVE_EVENTS_RETRY_MILLISECONDS}\n\n"
+        while (remaining := deadline - time.monotonic()) > 0:
+            event = await viewer.next_event(min(LIVE_EVENTS_KEEPALIVE_SECONDS, remaining))
+            if viewer.overflowed:
+                yield format_server_sent_event({'event': 'resync'})
+                return
+            yield format_server_sent_event(event) if event else ": keepalive\n\n"
+    finally:
+        remove_viewer(viewer)
+
+def start_live_event_listener(redis_client, expiry_events=False):
+    """
+    Start background threads that send the device events published on every Redis node to the dashboards.
+    Parameters:
+    - redis_client: The Redis client object or ShardRing, whose every node is subscribed to.
+    - expiry_events: True to also subscribe to the expired key events, if keyspace notifications are on.
+    Returns:
+    - threads: List of the background threads handling the messages, one for each node.
+    """
+    threads = []
+    for node, node_client in enumerate(node_clients(redis_client)):
+        thread = threading.Thread(target=_listen_for_live_events, args=(node, node_client, expiry_events), daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+def _listen_for_live_events(node, redis_client, expiry_events):
+
+    def handle_device_event(message):
+        try:
+            device_event = json.loads(message['data'])
+        except (ValueError, TypeError):
+            return
+        if isinstance(device_event, dict):
+            publish_live_event(device_event)
+
+    def handle_expired_key(message):
+        redis_key = message['data'].decode()
+        if redis_key.startswith('device:'):
+            publish_live_event({'event': 'expired', 'ip_address': device_ip_from_key(redis_key)})
+
+    channels = {DEVICE_EVENTS_CHANNEL: handle_device_event}
+    if expiry_events:
+        db = redis_client.connection_pool.connection_kwargs.get('db', 0)
+        channels[f"__keyevent@{db}__:expired"] = handle_expired_key
+    connected_before = False
+    while True:
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        connected = False
+        try:
+            pubsub.subscribe(**channels)
+            connected = True
+            if connected_before:
+                # Events published while the subscription was down are lost
+                _deliver({'event': 'resync'})
+            connected_before = True
+            # Every message is handled by the callbacks. Wait for them a second at a time, so a socket
+            # timeout on the connection pool doesn't look like a lost connection.
+            while True:
+                pubsub.get_message(timeout=1)
+        except Exception as e:
+            if connected:
+                log_event('live_event_listener_disconnected', level='error', node=node, error=str(e))
+        finally:
+            pubsub.close()
+        time.sleep(1)
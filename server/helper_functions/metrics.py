@@ -0,0 +1,222 @@
+"""
+Prometheus metrics for the badge control server, served by /metrics in the Prometheus text format.
+
+Request and Redis metrics are prometheus_client counters and histograms, which are thread safe.
+Under a pre-fork server, set PROMETHEUS_MULTIPROC_DIR to an empty directory before the workers start
+so every worker writes its samples there and /metrics adds them up across workers.
+The fleet gauges are read from the device store when /metrics is scraped, so they are the same in every worker.
+"""
+import contextvars
+import functools
+import os
+import time
+import redis
+import redis.asyncio
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client import multiprocess
+
+METRICS_CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+REQUEST_COUNT = Counter('badge_http_requests_total', 'HTTP requests handled', ['endpoint', 'method', 'status'])
+REQUEST_LATENCY = Histogram('badge_http_request_duration_seconds', 'Time spent handling HTTP requests', ['endpoint'],
+                            buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+REDIS_LATENCY = Histogram('badge_redis_call_duration_seconds', 'Time spent on each Redis round trip', ['command'],
+                          buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 5, 30))
+REDIS_CALLS_PER_REQUEST = Histogram('badge_redis_calls_per_request', 'Redis round trips made while handling each HTTP request', ['endpoint'],
+                                    buckets=(0, 1, 2, 3, 4, 5, 8, 13, 21, 50, 100))
+CREDENTIAL_REISSUES = Counter('badge_credential_reissues_total', 'New credentials issued to a polling device whose record had timed out', ['endpoint'])
+
+# Redis round trips made by the request being handled, or None outside a request
+_request_redis_calls = contextvars.ContextVar('request_redis_calls', default=None)
+
+def _record_redis_call(command, seconds):
+    REDIS_LATENCY.labels(command).observe(seconds)
+    calls = _request_redis_calls.get()
+    if calls is not None:
+        calls[0] += 1
+
+class InstrumentedRedis(redis.Redis):
+    """
+    Redis client that times every round trip and counts it against the current request.
+    """
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            _record_redis_call(str(args[0]).upper(), time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    """
+    Pipeline that times each execute, and each command sent immediately while watching keys.
+    """
+    def immediate_execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().immediate_execute_command(*args, **options)
+        finally:
+            _record_redis_call(str(args[0]).upper(), time.perf_counter() - start)
+
+    def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            _record_redis_call('PIPELINE', time.perf_counter() - start)
+
+class InstrumentedAsyncRedis(redis.asyncio.Redis):
+    """
+    redis.asyncio client that times every round trip and counts it against the current request.
+    """
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            _record_redis_call(str(args[0]).upper(), time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedAsyncPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+class InstrumentedAsyncPipeline(redis.asyncio.client.Pipeline):
+    """
+    redis.asyncio pipeline that times each execute, and each command sent immediately while watching keys.
+    """
+    async def immediate_execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().immediate_execute_command(*args, **options)
+        finally:
+            _record_redis_call(str(args[0]).upper(), time.perf_counter() - start)
+
+    async def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            _record_redis_call('PIPELINE', time.perf_counter() - start)
+
+def start_request_metrics():
+    """
+    Start counting the Redis round trips of the request being handled.
+    Returns:
+    - token: Token to pass to finish_request_metrics.
+    """
+    return _request_redis_calls.set([0])
+
+def finish_request_metrics(token, endpoint, method, status_code, seconds):
+    """
+    Record a handled request.
+    Parameters:
+    - token: The token returned by start_request_metrics.
+    - endpoint: The route the request matched, e.g. /poll_commands.
+    - method: The HTTP method of the request.
+    - status_code: The HTTP status code of the response.
+    - seconds: The time spent handling the request.
+    """
+    calls = _request_redis_calls.get()
+    _request_redis_calls.reset(token)
+    REQUEST_COUNT.labels(endpoint, method, str(status_code)).inc()
+    REQUEST_LATENCY.labels(endpoint).observe(seconds)
+    REDIS_CALLS_PER_REQUEST.labels(endpoint).observe(calls[0] if calls else 0)
+
+def init_flask_metrics(app):
+    """
+    Record the request metrics of every request handled by a Flask app.
+    Parameters:
+    - app: The Flask app.
+    """
+    from flask import g, request
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_start = time.perf_counter()
+        g.metrics_token = start_request_metrics()
+
+    @app.after_request
+    def record_request(response):
+        if 'metrics_token' in g:
+            # Label by the route rule rather than the path, so every device shares one series
+            endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+            finish_request_metrics(g.pop('metrics_token'), endpoint, request.method, response.status_code, time.perf_counter() - g.metrics_start)
+        return response
+
+    @app.teardown_request
+    def record_failed_request(exception):
+        # after_request is skipped when a view raises, so record the request as a server error here
+        if 'metrics_token' in g:
+            endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+            finish_request_metrics(g.pop('metrics_token'), endpoint, request.method, 500, time.perf_counter() - g.metrics_start)
+
+def instrument_async_endpoint(endpoint):
+    """
+    Record the request metrics of an async Starlette endpoint.
+    Parameters:
+    - endpoint: The endpoint function.
+    Returns:
+    - wrapper: The endpoint function recording its requests.
+    """
+    @functools.wraps(endpoint)
+    async def wrapper(request):
+        start = time.perf_counter()
+        token = start_request_metrics()
+        status_code = 500
+        try:
+            response = await endpoint(request)
+            status_code = response.status_code
+            return response
+        finally:
+            finish_request_metrics(token, request.url.path, request.method, status_code, time.perf_counter() - start)
+    return wrapper
+
+class FleetCollector:
+    """
+    Gauges describing the badge fleet, read from the device store at scrape time.
+    """
+    def __init__(self, device_store):
+        self.device_store = device_store
+
+    def collect(self):
+        try:
+            active_devices, hacked_devices, pending_commands = self.device_store.get_fleet_stats()
+        except redis.RedisError:
+            # Leave the gauges out of this scrape rather than failing it
+            return
+        yield GaugeMetricFamily('badge_active_devices', 'Devices seen within the device timeout', value=active_devices)
+        yield GaugeMetricFamily('badge_hacked_devices', 'Active devices that have been sent a command', value=hacked_devices)
+        yield GaugeMetricFamily('badge_pending_commands', 'Commands queued and not yet delivered to active devices', value=pending_commands)
+
+_fleet_registry = CollectorRegistry(auto_describe=False)
+_fleet_collector = None
+
+def register_fleet_collector(device_store):
+    """
+    Expose the fleet gauges on /metrics, replacing any collector registered before.
+    Parameters:
+    - device_store: The DeviceStore holding the devices.
+    Returns:
+    - collector: The registered collector.
+    """
+    global _fleet_collector
+    if _fleet_collector is not None:
+        _fleet_registry.unregister(_fleet_collector)
+    _fleet_collector = FleetCollector(device_store)
+    _fleet_registry.register(_fleet_collector)
+    return _fleet_collector
+
+def generate_metrics():
+    """
+    Render every metric in the Prometheus text format, adding up the samples of all workers in multiprocess mode.
+    Returns:
+    - data: The metrics as bytes.
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry) + generate_latest(_fleet_registry)
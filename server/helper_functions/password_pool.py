@@ -0,0 +1,58 @@
+"""
+Pool of common passwords handed out to new devices, kept in memory with their MD5 hashes.
+"""
+import hashlib
+import os
+import random
+import threading
+import time
+
+PASSWORDS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'static', 'common_passwords.txt')
+MTIME_CHECK_INTERVAL_SECONDS = 5 # How often to check whether the passwords file has changed
+
+# Tuple of (hashed_password, raw_password) pairs, replaced as a whole when the file changes
+_password_pool = ()
+_password_pool_mtime = None
+_password_pool_checked_at = 0
+_password_pool_lock = threading.Lock()
+
+def load_password_pool(file_path=PASSWORDS_FILE):
+    """
+    Read a passwords file and hash every password in it.
+    Parameters:
+    - file_path: The path of the file with one password on each line.
+    Returns:
+    - password_pool: Tuple of (hashed_password, raw_password) pairs.
+    """
+    with open(file_path, 'r') as file:
+        passwords = [line.strip() for line in file]
+    return tuple((hashlib.md5(password.encode()).hexdigest(), password) for password in passwords if password)
+
+def get_password_pool():
+    """
+    Get the password pool, reloading it only if the passwords file was modified since it was loaded.
+    Returns:
+    - password_pool: Tuple of (hashed_password, raw_password) pairs.
+    """
+    global _password_pool, _password_pool_mtime, _password_pool_checked_at
+    if _password_pool and time.monotonic() - _password_pool_checked_at < MTIME_CHECK_INTERVAL_SECONDS:
+        return _password_pool
+    with _password_pool_lock:
+        # Another thread may have checked the file while this one waited for the lock
+        if _password_pool and time.monotonic() - _password_pool_checked_at < MTIME_CHECK_INTERVAL_SECONDS:
+            return _password_pool
+        mtime = os.stat(PASSWORDS_FILE).st_mtime_ns
+        if mtime != _password_pool_mtime or not _password_pool:
+            _password_pool = load_password_pool()
+            _password_pool_mtime = mtime
+        _password_pool_checked_at = time.monotonic()
+    return _password_pool
+
+def choose_password():
+    """
+    Choose a random password from the pool.
+    Returns:
+    - hashed_password: The MD5 hash of the password.
+    - raw_password: The plaintext password.
+    """
+    return random.choice(get_password_pool())
@@ -0,0 +1,85 @@
+"""
+Token bucket rate limits kept in Redis, so every worker shares them.
+
+Each bucket holds up to a burst of tokens and refills at a steady rate. A request takes its cost in
+tokens from each of its buckets in one atomic script, and is rejected without taking any if one of them
+is short. A bulk request pays one source token for every device it targets, so it can't guess more
+passwords than the same requests sent one at a time.
+"""
+import math
+import time
+from helper_functions.redis_scripts import RATE_LIMIT_SCRIPT, run_script, run_script_async
+
+def get_rate_limit_buckets(source_ip, device_ips, source_limit, device_limit):
+    """
+    Build the buckets pacing requests from a source IP address to some devices.
+    The source bucket costs a token for every target, and each device bucket one token.
+    Parameters:
+    - source_ip: The IP address the request came from.
+    - device_ips: List of the IP addresses of the target devices.
+    - source_limit: (burst, tokens_per_second) for each source IP address, or a rate of 0 for no limit.
+    - device_limit: (burst, tokens_per_second) for each target device, or a rate of 0 for no limit.
+    Returns:
+    - buckets: List of (key, burst, tokens_per_second, cost) tuples.
+    """
+    buckets = []
+    if source_limit[1] > 0:
+        buckets.append((f"rate_limit:source:{source_ip}",) + tuple(source_limit) + (max(len(device_ips), 1),))
+    if device_limit[1] > 0:
+        buckets.extend((f"rate_limit:device:{device_ip}",) + tuple(device_limit) + (1,) for device_ip in device_ips)
+    return buckets
+
+def max_paced_targets(source_limit, max_targets):
+    """
+    Get the most devices one bulk request can target while still fitting in a full source bucket,
+    since a request costing more than the burst would never be allowed.
+    Parameters:
+    - source_limit: (burst, tokens_per_second) for each source IP address, or a rate of 0 for no limit.
+    - max_targets: The most devices one request may target regardless of the rate limit.
+    Returns:
+    - max_targets: The most devices one paced request may target.
+    """
+    if source_limit[1] <= 0:
+        return max_targets
+    return min(max_targets, int(source_limit[0]))
+
+def _rate_limit_args(buckets):
+    keys = [key for key, burst, rate, cost in buckets]
+    args = [int(time.time() * 1000)] + [value for key, burst, rate, cost in buckets for value in (burst, rate, cost)]
+    return keys, args
+
+def _retry_after_seconds(retry_after_ms):
+    # Retry-After only takes whole seconds
+    return max(math.ceil(retry_after_ms / 1000), 1) if retry_after_ms else 0
+
+def check_rate_limit(buckets, redis_client):
+    """
+    Take its cost from every bucket, unless one of them is short.
+    Parameters:
+    - buckets: List of (key, burst, tokens_per_second, cost) tuples.
+    - redis_client: The Redis client object.
+    Returns:
+    - status: True if the request is allowed, False if it is over the limit.
+    - retry_after: Seconds to wait before retrying, or 0 if the request is allowed.
+    """
+    if not buckets:
+        return True, 0
+    keys, args = _rate_limit_args(buckets)
+    retry_after = _retry_after_seconds(run_script(RATE_LIMIT_SCRIPT, redis_client, keys, args))
+    return not retry_after, retry_after
+
+async def check_rate_limit_async(buckets, redis_client):
+    """
+    Take its cost from every bucket, unless one of them is short, using a redis.asyncio client.
+    Parameters:
+    - buckets: List of (key, burst, tokens_per_second, cost) tuples.
+    - redis_client: The redis.asyncio client object.
+    Returns:
+    - status: True if the request is allowed, False if it is over the limit.
+    - retry_after: Seconds to wait before retrying, or 0 if the request is allowed.
+    """
+    if not buckets:
+        return True, 0
+    keys, args = _rate_limit_args(buckets)
+    retry_after = _retry_after_seconds(await run_script_async(RATE_LIMIT_SCRIPT, redis_client, keys, args))
+    return not retry_after, retry_after
@@ -0,0 +1,229 @@
+"""
+Lua scripts that run server-side in Redis so hot paths cost a single round trip.
+"""
+
+# Refresh a device's last seen time and expiry, and pop up to a batch of its queued commands.
+# KEYS[1]: device key, KEYS[2]: device command queue, KEYS[3]: last seen index, KEYS[4]: last hacked index,
+# KEYS[5]: device wakeup key, and optionally KEYS[6]: hack event stream, KEYS[7]: hacked devices leaderboard,
+# KEYS[8]: hackers leaderboard to record the delivered commands in (see hack_events.py)
+# ARGV[1]: current epoch time, ARGV[2]: device timeout in seconds, ARGV[3]: device IP address,
+# ARGV[4]: maximum number of commands to pop, ARGV[5]: approximate maximum length of the hack event stream
+# Returns: {status, command_json...} where status is 0 (not found or expired), 2 (active)
+# or 3 (device is still stored in the legacy JSON format), followed by the popped commands oldest first
+# Delivering commands is announced on the device events channel, since it is when a device counts as hacked.
+POLL_DEVICE_SCRIPT = """
+local key_type = redis.call('TYPE', KEYS[1])['ok']
+if key_type == 'none' then
+    return {0}
+end
+if key_type ~= 'hash' then
+    return {3}
+end
+local commands
+if redis.call('TYPE', KEYS[2])['ok'] == 'string' then
+    -- Single command saved before commands were queued
+    commands = {redis.call('GET', KEYS[2])}
+    redis.call('DEL', KEYS[2])
+else
+    local batch_size = tonumber(ARGV[4])
+    commands = redis.call('LRANGE', KEYS[2], 0, batch_size - 1)
+    redis.call('LTRIM', KEYS[2], batch_size, -1)
+end
+if #commands > 0 then
+    redis.call('HSET', KEYS[1], 'last_seen', ARGV[1], 'last_hacked_time', ARGV[1])
+    redis.call('ZADD', KEYS[4], ARGV[1], ARGV[3])
+    redis.call('PUBLISH', 'device_events', cjson.encode({event = 'hacked', ip_address = ARGV[3], last_hacked_time = tonumber(ARGV[1])}))
+    if #KEYS > 5 then
+        for _, command_json in ipairs(commands) do
+            local decoded, command_data = pcall(cjson.decode, command_json)
+            if decoded and type(command_data) == 'table' then
+                local source_ip = command_data['source_ip']
+                if type(source_ip) ~= 'string' then
+                    source_ip = ''
+                end
+                redis.call('XADD', KEYS[6], 'MAXLEN', '~', ARGV[5], '*', 'ip_address', ARGV[3], 'command', tostring(command_data['command']), 'source_ip', source_ip, 'time', ARGV[1])
+                redis.call('ZINCRBY', KEYS[7], 1, ARGV[3])
+                if source_ip ~= '' then
+                    redis.call('ZINCRBY', KEYS[8], 1, source_ip)
+                end
+            end
+        end
+    end
+else
+    redis.call('HSET', KEYS[1], 'last_seen', ARGV[1])
+end
+-- Only clear the wakeup token once the queue is drained, so a waiting long poll picks up the rest
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    redis.call('DEL', KEYS[5])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('ZADD', KEYS[3], ARGV[1], ARGV[3])
+table.insert(commands, 1, 2)
+return commands
+"""
+
+# Channel the wakeup key of a device is published on whenever a command is queued for it,
+# so an async server can wake its long polls from one shared subscription
+DEVICE_WAKEUP_CHANNEL = 'device_wakeups'
+
+# Add a command to the end of a device's bounded command queue and wake up any waiting long poll,
+# optionally only if the device password still has the hash the request was authorized with.
+# KEYS[1]: device command queue, KEYS[2]: device wakeup key, KEYS[3]: device key
+# ARGV[1]: command json, ARGV[2]: command name, ARGV[3]: 1 to drop queued commands with the same name first,
+# ARGV[4]: maximum queue length, ARGV[5]: queue expiry in seconds,
+# ARGV[6]: expected password hash of the device, or an empty string to skip the check
+# Returns: the new queue length, 0 if the queue is full, -1 if the device was not found,
+# -2 if the password hash doesn't match or -3 if the device is still stored in the legacy JSON format
+QUEUE_DEVICE_COMMAND_SCRIPT = """
+if ARGV[6] ~= '' then
+    local device_type = redis.call('TYPE', KEYS[3])['ok']
+    if device_type == 'none' then
+        return -1
+    end
+    if device_type ~= 'hash' then
+        return -3
+    end
+    if redis.call('HGET', KEYS[3], 'password') ~= ARGV[6] then
+        return -2
+    end
+end
+if redis.call('TYPE', KEYS[1])['ok'] == 'string' then
+    -- Move a single command saved before commands were queued into the queue
+    local command = redis.call('GET', KEYS[1])
+    redis.call('DEL', KEYS[1])
+    redis.call('RPUSH', KEYS[1], command)
+end
+if ARGV[3] == '1' then
+    for _, queued in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+        if cjson.decode(queued)['command'] == ARGV[2] then
+            redis.call('LREM', KEYS[1], 0, queued)
+        end
+    end
+end
+if redis.call('LLEN', KEYS[1]) >= tonumber(ARGV[4]) then
+    return 0
+end
+local queue_length = redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+-- Leave exactly one wakeup token for a waiting long poll to pop
+redis.call('DEL', KEYS[2])
+redis.call('RPUSH', KEYS[2], 1)
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+redis.call('PUBLISH', 'device_wakeups', KEYS[2])
+return queue_length
+"""
+
+# Set fields on a device hash, but only if the device exists, keeping the device indexes in step.
+# A password change is announced on the device events channel, with the new hash, so workers drop their cached one.
+# KEYS[1]: device key, KEYS[2]: last seen index, KEYS[3]: last hacked index
+# ARGV[1]: new expiry in seconds, or 0 to leave the expiry unchanged, ARGV[2]: device IP address
+# ARGV[3..]: alternating field names and values
+# Returns: 1 if the fields were set, 0 if the device was not found
+UPDATE_DEVICE_FIELDS_SCRIPT = """
+if redis.call('TYPE', KEYS[1])['ok'] ~= 'hash' then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+for i = 3, #ARGV, 2 do
+    if ARGV[i] == 'last_seen' then
+        redis.call('ZADD', KEYS[2], ARGV[i + 1], ARGV[2])
+    elseif ARGV[i] == 'last_hacked_time' then
+        redis.call('ZADD', KEYS[3], ARGV[i + 1], ARGV[2])
+    elseif ARGV[i] == 'password' then
+        redis.call('PUBLISH', 'device_events', cjson.encode({event = 'password_changed', ip_address = ARGV[2], password_hash = ARGV[i + 1]}))
+    end
+end
+if tonumber(ARGV[1]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return 1
+"""
+
+# Drop devices that have expired from the device indexes.
+# KEYS[1]: last seen index, KEYS[2]: last hacked index
+# ARGV[1]: cutoff epoch time (devices last seen before this have expired), ARGV[2]: maximum devices to drop
+# Returns: the number of devices dropped
+PRUNE_DEVICE_INDEXES_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[1], 'LIMIT', 0, ARGV[2])
+if #expired > 0 then
+    redis.call('ZREM', KEYS[1], unpack(expired))
+    redis.call('ZREM', KEYS[2], unpack(expired))
+end
+return #expired
+"""
+
+# Take its cost in tokens from every one of a set of token buckets, or from none of them if any is short.
+# KEYS[1..n]: bucket keys
+# ARGV[1]: current time in milliseconds, then for each bucket ARGV[3i-1]: burst size, ARGV[3i]: tokens refilled
+# per second, ARGV[3i+1]: tokens taken
+# Returns: 0 if the tokens were taken from every bucket, otherwise the milliseconds until every bucket has enough
+RATE_LIMIT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local tokens = {}
+local retry_after = 0
+for i, key in ipairs(KEYS) do
+    local burst = tonumber(ARGV[3 * i - 1])
+    local rate = tonumber(ARGV[3 * i])
+    local cost = tonumber(ARGV[3 * i + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+    local available = tonumber(bucket[1]) or burst
+    local updated = tonumber(bucket[2]) or now
+    available = math.min(burst, available + math.max(now - updated, 0) * rate / 1000)
+    tokens[i] = available - cost
+    if available < cost then
+        retry_after = math.max(retry_after, math.ceil((cost - available) * 1000 / rate))
+    end
+end
+if retry_after > 0 then
+    return retry_after
+end
+for i, key in ipairs(KEYS) do
+    local burst = tonumber(ARGV[3 * i - 1])
+    local rate = tonumber(ARGV[3 * i])
+    redis.call('HSET', key, 'tokens', tostring(tokens[i]), 'updated', ARGV[1])
+    -- A bucket left alone refills completely, so it can be dropped once that has happened
+    redis.call('PEXPIRE', key, math.ceil(burst * 1000 / rate) + 1000)
+end
+return 0
+"""
+
+# Scripts registered with Redis, keyed by their source. Registering hashes the source once
+# so every later call goes out as EVALSHA (with an automatic EVAL fallback after a SCRIPT FLUSH).
+_registered_scripts = {}
+
+def run_script(script_source, redis_client, keys, args):
+    """
+    Run a Lua script in Redis using EVALSHA.
+    Parameters:
+    - script_source: The Lua source of the script.
+    - redis_client: The Redis client object.
+    - keys: The list of keys the script touches.
+    - args: The list of arguments passed to the script.
+    Returns:
+    - The value returned by the script.
+    """
+    script = _registered_scripts.get(script_source)
+    if script is None:
+        script = redis_client.register_script(script_source)
+        _registered_scripts[script_source] = script
+    return script(keys=keys, args=args, client=redis_client)
+
+# Scripts registered with an asyncio Redis client, kept apart because their calls must be awaited
+_registered_async_scripts = {}
+
+async def run_script_async(script_source, redis_client, keys, args):
+    """
+    Run a Lua script in Redis using EVALSHA from an asyncio Redis client.
+    Parameters:
+    - script_source: The Lua source of the script.
+    - redis_client: The redis.asyncio client object.
+    - keys: The list of keys the script touches.
+    - args: The list of arguments passed to the script.
+    Returns:
+    - The value returned by the script.
+    """
+    script = _registered_async_scripts.get(script_source)
+    if script is None:
+        script = redis_client.register_script(script_source)
+        _registered_async_scripts[script_source] = script
+    return await script(keys=keys, args=args, client=redis_client)
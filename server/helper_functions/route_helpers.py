@@ -0,0 +1,340 @@
+"""
+Request parsing and response shaping shared by the Flask app and the ASGI app, so both
+serving modes answer every request the same way. Nothing here touches Redis or a framework.
+"""
+import hashlib
+import hmac
+import ipaddress
+import math
+from helper_functions.commands import build_command, format_command, is_valid_ip
+from helper_functions.device import DEVICE_INDEXES
+from helper_functions.event_log import log_event
+from helper_functions.hack_events import is_valid_cursor
+from helper_functions.rate_limit import get_rate_limit_buckets, max_paced_targets
+from helper_functions.time_helper import convert_epoch_to_string
+
+# HTTP status of the errors that aren't a bad request
+ERROR_STATUS_CODES = {
+    'Command queue full': 429,
+}
+
+def error_status_code(message):
+    # HTTP status code to answer an error message with
+    return ERROR_STATUS_CODES.get(message, 400)
+
+def get_int_arg(args, name, default=0):
+    """
+    Read an integer from the query string.
+    Parameters:
+    - args: Mapping of the query string arguments.
+    - name: The name of the argument.
+    - default: The value to use if the argument is missing or not an integer.
+    Returns:
+    - value: The integer value.
+    """
+    try:
+        return int(args.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+def get_poll_options(args, max_wait_seconds, max_batch_size):
+    """
+    Read the long poll and batch options of /poll_commands.
+    Parameters:
+    - args: Mapping of the query string arguments.
+    - max_wait_seconds: Longest time the request may be held open.
+    - max_batch_size: Most commands that can be delivered in one response.
+    Returns:
+    - wait_seconds: How long to hold the request open waiting for a command.
+    - batch_size: The batch size the device asked for, or 0 for the legacy single command response.
+    - max_commands: The number of commands to pop.
+    """
+    # Optional long poll: how long to hold the request open waiting for a command
+    wait_seconds = min(max(get_int_arg(args, 'wait'), 0), max_wait_seconds)
+    # Optional batch: devices that ask for one get up to this many commands in a list
+    batch_size = get_int_arg(args, 'batch')
+    max_commands = min(max(batch_size, 1), max_batch_size)
+    return wait_seconds, batch_size, max_commands
+
+def format_poll_commands(queued_commands, batch_size):
+    """
+    Build the JSON body of a /poll_commands response.
+    Parameters:
+    - queued_commands: List of the popped commands in the order they were queued.
+    - batch_size: The batch size the device asked for, or 0 for the legacy single command response.
+    Returns:
+    - body: Dictionary to send as JSON.
+    - status_code: The HTTP status code.
+    """
+    commands = [format_command(command_data) for command_data in queued_commands]
+    if batch_size:
+        # Send every valid command, in the order they were queued
+        return {'commands': [command for command in commands if command]}, 200
+
+    # Return None if no command is found
+    if not commands:
+        return {'command': None}, 200
+    if not commands[0]:
+        return {'error': 'Invalid command'}, 400
+    return commands[0], 200
+
+def check_password(password, hashed_password):
+    """
+    Compare a password with the MD5 hash stored for a device.
+    Parameters:
+    - password: The password sent with the request.
+    - hashed_password: The password hash stored for the device.
+    Returns:
+    - status: True if the password matches, False otherwise.
+    """
+    if not password or not hashed_password:
+        return False
+    return hashlib.md5(str(password).encode()).hexdigest() == hashed_password
+
+def check_admin_token(admin_token, expected_token):
+    """
+    Check the admin token sent to /control_devices in constant time.
+    Parameters:
+    - admin_token: The token sent with the request.
+    - expected_token: The ADMIN_TOKEN setting, or None if admin tokens are disabled.
+    Returns:
+    - status: True if the token matches, False otherwise.
+    """
+    return bool(expected_token) and hmac.compare_digest(str(admin_token or ''), expected_token)
+
+def parse_control_device_request(params, source_ip, source_limit, device_limit):
+    """
+    Read the parameters of a /control_device request.
+    Parameters:
+    - params: Mapping of the query string arguments of a GET, or of the form of a POST.
+    - source_ip: The IP address the request came from.
+    - source_limit: (burst, tokens_per_second) for each source IP address.
+    - device_limit: (burst, tokens_per_second) for each target device.
+    Returns:
+    - status: True if the parameters are all there, False otherwise.
+    - message: A message indicating the result of the operation.
+    - control_request: Dictionary with the device_ip, password and control_type, and the rate limit
+      buckets pacing the guess, to check before looking up the device.
+    """
+    device_ip = params.get('ip_address')
+    password = params.get('password')
+    control_type = params.get('control_type')
+    if not device_ip or not password or not control_type:
+        return False, "Missing parameters", None
+    buckets = get_rate_limit_buckets(source_ip, [device_ip] if is_valid_ip(device_ip) else [], source_limit, device_limit)
+    return True, "Good", {'device_ip': device_ip, 'password': password, 'control_type': control_type, 'buckets': buckets}
+
+def authorize_device_command(control_request, hashed_password, params, source_ip):
+    """
+    Check the password of a /control_device request against the stored hash, and build its command.
+    Failed guesses are logged.
+    Parameters:
+    - control_request: The dictionary returned by parse_control_device_request.
+    - hashed_password: The stored password hash of the device, or None if not found.
+    - params: Mapping of the request parameters, holding the command parameters.
+    - source_ip: The IP address the request came from.
+    Returns:
+    - status: True if the command may be queued, False otherwise.
+    - message: A message indicating the result of the operation.
+    - command_data: Dictionary with the command and its params.
+    """
+    device_ip, password, control_type = control_request['device_ip'], control_request['password'], control_request['control_type']
+    if not hashed_password:
+        log_event('failed_guess', source_ip=source_ip, device_ip=device_ip, password=password, control_type=control_type, reason='device_not_found')
+        return False, "Device not found", None
+    if not check_password(password, hashed_password):
+        log_event('failed_guess', source_ip=source_ip, device_ip=device_ip, password=password, control_type=control_type, reason='invalid_password')
+        return False, "Invalid password", None
+    # Ensure ip address is in IP format with regex
+    if not is_valid_ip(device_ip):
+        return False, "Invalid IP address format", None
+    return build_command(control_type, params, source_ip)
+
+def parse_bulk_request(data, source_ip, max_targets, admin_token, source_limit, device_limit):
+    """
+    Read and validate the JSON body of a /control_devices request.
+    Parameters:
+    - data: The JSON body of the request, or None if it isn't JSON.
+    - source_ip: The IP address the request came from.
+    - max_targets: The most devices one request may target. Without an admin token, it is also capped at
+      the source burst, since every target costs a source token.
+    - admin_token: The ADMIN_TOKEN setting, or None if admin tokens are disabled.
+    - source_limit: (burst, tokens_per_second) for each source IP address.
+    - device_limit: (burst, tokens_per_second) for each target device.
+    Returns:
+    - status: True if the request is valid, False otherwise.
+    - message: A message indicating the result of the operation.
+    - bulk_request: Dictionary with the control_type, command_data, passwords of each target, is_admin,
+      the valid device_ips, the results so far with an error for every invalid target, and the rate
+      limit buckets to check before looking up the devices (none for an admin).
+    """
+    if not isinstance(data, dict):
+        return False, "Missing JSON body", None
+    control_type = data.get('control_type')
+    if not control_type:
+        return False, "Missing parameters", None
+
+    # Validate the command once for every target
+    status, message, command_data = build_command(control_type, data, source_ip)
+    if not status:
+        return False, message, None
+
+    # Collect the targets and their passwords, no more than a full source bucket can pay for unless sent by an admin
+    is_admin = check_admin_token(data.get('admin_token'), admin_token)
+    status, message, passwords = collect_bulk_targets(data, max_targets if is_admin else max_paced_targets(source_limit, max_targets))
+    if not status:
+        return False, message, None
+    device_ips, results = split_valid_targets(passwords)
+
+    # Every target takes a token from its device and from the source, as if it had been sent on its own
+    buckets = [] if is_admin else get_rate_limit_buckets(source_ip, device_ips, source_limit, device_limit)
+    return True, "Good", {
+        'control_type': control_type,
+        'command_data': command_data,
+        'passwords': passwords,
+        'is_admin': is_admin,
+        'device_ips': device_ips,
+        'results': results,
+        'buckets': buckets
+    }
+
+def collect_bulk_targets(data, max_targets):
+    """
+    Collect the targets of a /control_devices request and their passwords.
+    Parameters:
+    - data: The JSON body of the request.
+    - max_targets: The most devices one request may target.
+    Returns:
+    - status: True if the targets are valid, False otherwise.
+    - message: A message indicating the result of the operation.
+    - passwords: Dictionary mapping each target IP address to its password.
+    """
+    passwords = {}
+    if data.get('targets'):
+        if not isinstance(data['targets'], list):
+            return False, "Invalid targets", None
+        for target in data['targets']:
+            if not isinstance(target, dict) or not target.get('ip_address'):
+                return False, "Invalid targets", None
+            passwords[str(target['ip_address'])] = target.get('password')
+    elif data.get('cidr'):
+        try:
+            network = ipaddress.IPv4Network(str(data['cidr']), strict=False)
+        except ValueError:
+            return False, "Invalid CIDR range", None
+        if network.num_addresses > max_targets:
+            return False, f"Too many targets, at most {max_targets}", None
+        target_passwords = data.get('passwords') or {}
+        if not isinstance(target_passwords, dict):
+            return False, "Invalid passwords", None
+        for address in network.hosts():
+            passwords[str(address)] = target_passwords.get(str(address), data.get('password'))
+    else:
+        return False, "Missing targets or cidr", None
+    if len(passwords) > max_targets:
+        return False, f"Too many targets, at most {max_targets}", None
+    return True, "Good", passwords
+
+def split_valid_targets(passwords):
+    """
+    Split the targets of a /control_devices request into valid IP addresses and errors.
+    Parameters:
+    - passwords: Dictionary mapping each target IP address to its password.
+    Returns:
+    - device_ips: List of the target IP addresses in IPv4 format.
+    - results: Dictionary with an error for every other target.
+    """
+    device_ips = [device_ip for device_ip in passwords if is_valid_ip(device_ip)]
+    results = {device_ip: {'error': 'Invalid IP address format'} for device_ip in passwords if not is_valid_ip(device_ip)}
+    return device_ips, results
+
+def authorize_targets(passwords, password_hashes, is_admin, results):
+    """
+    Check the password of every target of a /control_devices request.
+    Parameters:
+    - passwords: Dictionary mapping each target IP address to its password.
+    - password_hashes: Dictionary mapping each target IP address to its stored password hash, or None if not found.
+    - is_admin: True if the request carried a valid admin token, which stands in for the passwords.
+    - results: Dictionary of results for each target, updated with an error for every rejected target.
+    Returns:
+    - authorized_ips: List of the IP addresses the command may be sent to.
+    """
+    authorized_ips = []
+    for device_ip, hashed_password in password_hashes.items():
+        if not hashed_password:
+            results[device_ip] = {'error': 'Device not found'}
+            continue
+        if not is_admin and not check_password(passwords[device_ip], hashed_password):
+            results[device_ip] = {'error': 'Invalid password'}
+            continue
+        authorized_ips.append(device_ip)
+    return authorized_ips
+
+def record_results(results, outcomes, success=True):
+    """
+    Record the outcome of an operation on each target of a /control_devices request.
+    Parameters:
+    - results: Dictionary of results for each target, updated in place.
+    - outcomes: Dictionary mapping each IP address to a (status, message) tuple.
+    - success: True to record a success for targets that succeeded, False to only record the errors.
+    Returns:
+    - succeeded_ips: List of the IP addresses the operation succeeded for.
+    """
+    succeeded_ips = []
+    for device_ip, (status, message) in outcomes.items():
+        if status:
+            succeeded_ips.append(device_ip)
+            if success:
+                results[device_ip] = {'status': 'success'}
+        else:
+            results[device_ip] = {'error': message}
+    return succeeded_ips
+
+def get_admin_options(args, default_per_page, max_per_page):
+    """
+    Read the page and sort order of /admin from the query string.
+    Parameters:
+    - args: Mapping of the query string arguments.
+    - default_per_page: Number of devices on each page if not given.
+    - max_per_page: Largest number of devices on one page.
+    Returns:
+    - page: The page number, starting at 1.
+    - per_page: The number of devices on each page.
+    - sort_by: The field to sort the devices by.
+    """
+    page = max(get_int_arg(args, 'page', 1), 1)
+    per_page = min(max(get_int_arg(args, 'per_page', default_per_page), 1), max_per_page)
+    sort_by = args.get('sort', 'last_seen')
+    if sort_by not in DEVICE_INDEXES:
+        sort_by = 'last_seen'
+    return page, per_page, sort_by
+
+def get_hack_event_options(args, default_limit, max_limit):
+    """
+    Read the cursor and page size of /hack_events from the query string.
+    Parameters:
+    - args: Mapping of the query string arguments.
+    - default_limit: Number of events to read if not given.
+    - max_limit: Largest number of events to read at once.
+    Returns:
+    - cursor: ID of the last event already read, 0 to start from the oldest event, or None if the cursor is invalid.
+    - limit: The number of events to read.
+    """
+    cursor = args.get('cursor') or '0'
+    limit = min(max(get_int_arg(args, 'limit', default_limit), 1), max_limit)
+    return (cursor if is_valid_cursor(cursor) else None), limit
+
+def prepare_admin_devices(devices, total, per_page):
+    """
+    Format one page of devices for the admin template.
+    Parameters:
+    - devices: List of device dictionaries from list_devices, formatted in place.
+    - total: The total number of devices in the index.
+    - per_page: The number of devices on each page.
+    Returns:
+    - total_pages: The number of pages of devices.
+    """
+    for device in devices:
+        last_hacked_time = device['last_hacked_time']
+        device['last_hacked_time'] = convert_epoch_to_string(last_hacked_time) if last_hacked_time else 'N/A'
+    return max(math.ceil(total / per_page), 1)
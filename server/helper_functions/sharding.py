@@ -0,0 +1,220 @@
+"""
+Device storage sharded over several Redis nodes.
+
+By default every device lives in one Redis under device:{ip}, next to one pair of device indexes.
+With DEVICE_SHARDS set, each device belongs to one of that many shards, picked by a hash of its IP
+address, and every key of the device carries its shard as a Redis hash tag, e.g. device:{s12}:10.0.0.1
+and device_command:{s12}:10.0.0.1. Each shard keeps its own device indexes, e.g. devices:last_seen:{s12}.
+Every script and transaction on a device then stays inside a single hash slot, so it remains atomic
+wherever the shard is stored.
+
+Shards are placed on the Redis nodes by a client-side consistent-hash ring, so adding a node only moves
+the shards that land on it. Keys that don't belong to a device, such as the rate limit buckets, stay on
+the primary node. Listings of every device fan out to all the nodes in parallel.
+
+Switching layouts doesn't move existing devices: they are issued new credentials the next time they poll.
+"""
+import bisect
+import concurrent.futures
+import contextvars
+import hashlib
+import os
+import threading
+import zlib
+
+DEVICE_SHARDS = 0 # Shards the devices are spread over, or 0 for the single node layout
+RING_POINTS_PER_NODE = 128 # Points each node has on the ring, so shards spread evenly
+
+# Threads running the fan-out queries, created in each process that needs them
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+def configure_sharding(device_shards):
+    """
+    Set the number of device shards. Every worker sharing a Redis must use the same number.
+    Parameters:
+    - device_shards: Shards to spread the devices over, or 0 for the single node layout.
+    """
+    global DEVICE_SHARDS
+    DEVICE_SHARDS = device_shards
+
+def device_shard(device_ip):
+    """
+    Get the shard a device belongs to.
+    Parameters:
+    - device_ip: The IP address of the device.
+    Returns:
+    - shard: The shard number, or None in the single node layout.
+    """
+    if not DEVICE_SHARDS:
+        return None
+    return zlib.crc32(device_ip.encode()) % DEVICE_SHARDS
+
+def _device_key(prefix, device_ip):
+    shard = device_shard(device_ip)
+    if shard is None:
+        return f"{prefix}:{device_ip}"
+    return f"{prefix}:{{s{shard}}}:{device_ip}"
+
+def device_key(device_ip):
+    # Hash holding the device record
+    return _device_key('device', device_ip)
+
+def device_command_key(device_ip):
+    # List of the commands queued for the device
+    return _device_key('device_command', device_ip)
+
+def device_wakeup_key(device_ip):
+    # Token pushed whenever a command is queued, which long polls block on
+    return _device_key('device_wakeup', device_ip)
+
+def device_ip_from_key(redis_key):
+    """
+    Get the IP address of a device from one of its keys.
+    Parameters:
+    - redis_key: The key as a string, e.g. device:10.0.0.1 or device:{s12}:10.0.0.1.
+    Returns:
+    - device_ip: The IP address of the device.
+    """
+    device_ip = redis_key.split(':', 1)[1]
+    if device_ip.startswith('{'):
+        device_ip = device_ip.split('}:', 1)[1]
+    return device_ip
+
+def device_indexes(shard):
+    """
+    Get the device indexes of a shard.
+    Parameters:
+    - shard: The shard number, or None in the single node layout.
+    Returns:
+    - indexes: Dictionary mapping the last_seen and last_hacked_time fields to the keys of their indexes.
+    """
+    if shard is None:
+        return {'last_seen': 'devices:last_seen', 'last_hacked_time': 'devices:last_hacked'}
+    return {'last_seen': f"devices:last_seen:{{s{shard}}}", 'last_hacked_time': f"devices:last_hacked:{{s{shard}}}"}
+
+def device_indexes_for(device_ip):
+    # Indexes of the shard the device belongs to
+    return device_indexes(device_shard(device_ip))
+
+def _ring_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+class ShardRing:
+    """
+    Redis nodes holding the device shards, placed on a consistent-hash ring.
+    Commands that aren't about a device are sent to the primary node, so the ring can stand in for
+    a single Redis client wherever the code doesn't look up a device.
+    """
+    def __init__(self, primary, nodes, points_per_node=RING_POINTS_PER_NODE):
+        """
+        Parameters:
+        - primary: The Redis client of the node holding the keys that don't belong to a device.
+        - nodes: Dictionary mapping a stable name for each node, e.g. its URL, to its Redis client.
+        - points_per_node: Points each node has on the ring.
+        """
+        self.primary = primary
+        self.nodes = dict(nodes)
+        # Place the nodes by name rather than order, so every worker builds the same ring
+        self._ring = sorted((_ring_hash(f"{name}#{point}"), name) for name in self.nodes for point in range(points_per_node))
+        self._ring_hashes = [point_hash for point_hash, name in self._ring]
+        self._shard_clients = {}
+
+    def client_for_shard(self, shard):
+        """
+        Get the Redis client of the node holding a shard.
+        Parameters:
+        - shard: The shard number.
+        Returns:
+        - redis_client: The Redis client object.
+        """
+        redis_client = self._shard_clients.get(shard)
+        if redis_client is None:
+            position = bisect.bisect(self._ring_hashes, _ring_hash(f"s{shard}")) % len(self._ring)
+            redis_client = self._shard_clients[shard] = self.nodes[self._ring[position][1]]
+        return redis_client
+
+    def __getattr__(self, name):
+        return getattr(self.primary, name)
+
+def client_for_device(device_ip, redis_client):
+    """
+    Get the Redis client of the node holding a device.
+    Parameters:
+    - device_ip: The IP address of the device.
+    - redis_client: The Redis client object or ShardRing.
+    Returns:
+    - redis_client: The Redis client object.
+    """
+    if isinstance(redis_client, ShardRing):
+        return redis_client.client_for_shard(device_shard(device_ip))
+    return redis_client
+
+def group_devices_by_node(device_ips, redis_client):
+    """
+    Group devices by the Redis node holding them, so each node can be sent one pipeline.
+    Parameters:
+    - device_ips: List of the IP addresses of the devices.
+    - redis_client: The Redis client object or ShardRing.
+    Returns:
+    - groups: List of (redis_client, device_ips) tuples, keeping the order of the devices in each.
+    """
+    if not isinstance(redis_client, ShardRing):
+        return [(redis_client, list(device_ips))]
+    groups = {}
+    for device_ip in device_ips:
+        node_client = client_for_device(device_ip, redis_client)
+        groups.setdefault(id(node_client), (node_client, []))[1].append(device_ip)
+    return list(groups.values())
+
+def group_shards_by_node(redis_client):
+    """
+    Group every shard by the Redis node holding it, for queries over every device.
+    Parameters:
+    - redis_client: The Redis client object or ShardRing.
+    Returns:
+    - groups: List of (redis_client, shards) tuples, where shards is [None] in the single node layout.
+    """
+    if not DEVICE_SHARDS:
+        return [(redis_client, [None])]
+    if not isinstance(redis_client, ShardRing):
+        return [(redis_client, list(range(DEVICE_SHARDS)))]
+    groups = {}
+    for shard in range(DEVICE_SHARDS):
+        node_client = redis_client.client_for_shard(shard)
+        groups.setdefault(id(node_client), (node_client, []))[1].append(shard)
+    return list(groups.values())
+
+def node_clients(redis_client):
+    """
+    Get the Redis client of every node holding devices, e.g. to subscribe to the channels their scripts publish on.
+    Parameters:
+    - redis_client: The Redis client object or ShardRing.
+    Returns:
+    - redis_clients: List of Redis client objects.
+    """
+    if isinstance(redis_client, ShardRing):
+        return list(redis_client.nodes.values())
+    return [redis_client]
+
+def fan_out(function, items):
+    """
+    Call a function on every item, in parallel threads when there is more than one.
+    Parameters:
+    - function: Function taking one item.
+    - items: List of the items.
+    Returns:
+    - results: List of the results, in the order of the items.
+    """
+    global _executor, _executor_pid
+    if len(items) <= 1:
+        return [function(item) for item in items]
+    with _executor_lock:
+        if _executor_pid != os.getpid():
+            # Threads don't survive a fork, so a forked worker starts its own
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix='shard-fan-out')
+            _executor_pid = os.getpid()
+    # Run each call in a copy of the caller's context, so its Redis calls still count against the request
+    context = contextvars.copy_context()
+    return list(_executor.map(lambda item: context.copy().run(function, item), items))
@@ -0,0 +1,615 @@
+"""
+Device stores holding the device records, their command queues and the rate limit buckets.
+
+The routes only talk to a DeviceStore, so the server can run on either of:
+- RedisDeviceStore: the helpers in device.py, shared by every worker and server through Redis.
+- MemoryDeviceStore: plain dictionaries in the server process, for a single process classroom
+  server without Redis, or as a deterministic stand-in. Every worker would have its own devices,
+  so it only suits one process.
+
+Both stores behave the same way, which tests/test_storage_conformance.py checks.
+"""
+import collections
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import threading
+import time
+from helper_functions import credential_cache, device, hack_events, rate_limit
+from helper_functions.rate_limit import _retry_after_seconds
+from helper_functions.device import QUEUE_ERRORS, generate_md5_password
+
+STORAGE_BACKENDS = ('redis', 'memory')
+SWEEP_INTERVAL_SECONDS = 60 # How often the memory store drops expired devices nobody asked about
+
+class DeviceStore:
+    """
+    Storage for the devices, their command queues and the rate limit buckets.
+    Devices expire device_timeout_seconds after they were last seen, like the Redis key TTLs.
+    """
+    def __init__(self, device_timeout_seconds):
+        """
+        Parameters:
+        - device_timeout_seconds: The time interval in seconds after which a device expires if not seen.
+        """
+        self.device_timeout_seconds = device_timeout_seconds
+
+    def insert_device(self, device_ip):
+        """
+        Insert a new device with a random password, replacing any device with the same IP address.
+        Parameters:
+        - device_ip: The IP address of the device.
+        Returns:
+        - status: True if the operation was successful, False otherwise.
+        - message: A message indicating the result of the operation.
+        - raw_password: The plaintext password of the new device, or None if the operation failed.
+        """
+        raise NotImplementedError
+
+    def get_device_data(self, device_ip):
+        """
+        Get the record of a device.
+        Parameters:
+        - device_ip: The IP address of the device.
+        Returns:
+        - device_data: Dictionary of the device fields with times as epoch integers, or None if the device is not found.
+        """
+        raise NotImplementedError
+
+    def get_device_password_hashes(self, device_ips):
+        """
+        Get the password hashes of many devices at once.
+        Parameters:
+        - device_ips: List of the IP addresses of the devices.
+        Returns:
+        - password_hashes: Dictionary mapping each IP address to its password hash, or None if the device is not found.
+        """
+        raise NotImplementedError
+
+    def get_password_hash(self, device_ip):
+        """
+        Get the password hash of a device, which may come from a cache.
+        Parameters:
+        - device_ip: The IP address of the device.
+        Returns:
+        - password_hash: The password hash of the device, or None if the device is not found.
+        """
+        return self.get_device_password_hashes([device_ip])[device_ip]
+
+    def invalidate_password_hash(self, device_ip):
+        """
+        Stop trusting any cached password hash of a device.
+        Parameters:
+        - device_ip: The IP address of the device.
+        """
+
+    def update_last_seen(self, device_ip):
+        """
+        Update the last seen time of a device and push back its expiry.
+        Parameters:
+        - device_ip: The IP address of the device.
+        Returns:
+        - status: True if the operation was successful, False otherwise.
+        - message: A message indicating the result of the operation.
+        """
+        raise NotImplementedError
+
+    def update_password(self, device_ip, new_password):
+        """
+        Update the password of a device.
+        Parameters:
+        - device_ip: The IP address of the device.
+        - new_password: The new password for the device.
+        Returns:
+        - status: True if the operation was successful, False otherwise.
+        - message: A message indicating the result of the operation.
+        - hashed_password: The MD5 hash of the new password, or None if the operation failed.
+        """
+        raise NotImplementedError
+
+    def update_device_passwords(self, device_ips, new_password):
+        """
+        Update the password of many devices at once.
+        Parameters:
+        - device_ips: List of the IP addresses of the devices.
+        - new_password: The new password for the devices.
+        Returns:
+        - results: Dictionary mapping each IP address to a (status, message) tuple.
+        """
+        raise NotImplementedError
+
+    def poll_device(self, device_ip, max_commands=1):
+        """
+        Check that a device is active, refresh its last seen time and expiry, and pop its queued commands.
+        Parameters:
+        - device_ip: The IP address of the device.
+        - max_commands: The maximum number of queued commands to pop.
+        Returns:
+        - status: True if the device is active, False otherwise.
+        - message: A message indicating the result of the operation.
+        - commands: List of the popped commands in the order they were queued.
+        """
+        raise NotImplementedError
+
+    def queue_device_command(self, device_ip, command_data, max_queued_commands=10, coalesce=False, password_hash=None):
+        """
+        Add a command to the end of a device's command queue and wake up any long poll waiting on it.
+        Parameters:
+        - device_ip: The IP address of the device.
+        - command_data: Dictionary with the command and its params.
+        - max_queued_commands: The maximum number of commands that can wait in the queue.
+        - coalesce: True to drop queued commands of the same type, so only the latest one is delivered.
+        - password_hash: If set, the command is only queued if the device password still has this hash.
+        Returns:
+        - status: True if the command was queued, False otherwise.
+        - message: A message indicating the result of the operation.
+        """
+        raise NotImplementedError
+
+    def queue_device_commands(self, device_ips, command_data, max_queued_commands=10, coalesce=False, password_hashes=None):
+        """
+        Add the same command to the command queues of many devices at once.
+        Parameters:
+        - device_ips: List of the IP addresses of the devices.
+        - command_data: Dictionary with the command and its params.
+        - max_queued_commands: The maximum number of commands that can wait in each queue.
+        - coalesce: True to drop queued commands of the same type, so only the latest one is delivered.
+        - password_hashes: If set, dictionary mapping each IP address to the password hash the device must still have.
+        Returns:
+        - results: Dictionary mapping each IP address to a (status, message) tuple.
+        """
+        raise NotImplementedError
+
+    def wait_for_device_command(self, device_ip, wait_seconds):
+        """
+        Wait until a command is queued for a device or the wait times out.
+        Parameters:
+        - device_ip: The IP address of the device.
+        - wait_seconds: The longest time in seconds to wait for a command.
+        Returns:
+        - status: True if a command is waiting, False if the wait timed out.
+        """
+        raise NotImplementedError
+
+    def list_devices(self, page=1, per_page=50, sort_by='last_seen'):
+        """
+        Get one page of active devices, most recent first.
+        Parameters:
+        - page: The page number to get, starting at 1.
+        - per_page: The number of devices on each page.
+        - sort_by: The field to sort the devices by, either 'last_seen' or 'last_hacked_time'.
+        Returns:
+        - devices: List of dictionaries with the ip_address, password_hash, last_seen and last_hacked_time of each device.
+        - total: The total number of devices with the sort field set.
+        """
+        raise NotImplementedError
+
+    def remove_device(self, device_ip):
+        """
+        Remove a device.
+        Parameters:
+        - device_ip: The IP address of the device.
+        Returns:
+        - status: True if the operation was successful, False otherwise.
+        - message: A message indicating the result of the operation.
+        """
+        raise NotImplementedError
+
+    def get_fleet_stats(self):
+        """
+        Count the active devices, the ones that have been hacked and the commands waiting for them.
+        Returns:
+        - active_devices: The number of devices seen within the device timeout.
+        - hacked_devices: The number of active devices that have been sent a command.
+        - pending_commands: The number of commands queued and not yet delivered to active devices.
+        """
+        raise NotImplementedError
+
+    def check_rate_limit(self, buckets):
+        """
+        Take its cost from every rate limit bucket, unless one of them is short.
+        Parameters:
+        - buckets: List of (key, burst, tokens_per_second, cost) tuples from get_rate_limit_buckets.
+        Returns:
+        - status: True if the request is allowed, False if it is over the limit.
+        - retry_after: Seconds to wait before retrying, or 0 if the request is allowed.
+        """
+        raise NotImplementedError
+
+    def read_hack_events(self, cursor='0', limit=100):
+        """
+        Read the hack events recorded after a cursor, oldest first. Every command delivered by poll_device
+        is a hack event, and only roughly the latest hack_events.HACK_EVENTS_MAX_LENGTH are kept.
+        Parameters:
+        - cursor: ID of the last event already read, or 0 to read from the oldest event still kept.
+        - limit: The maximum number of events to read.
+        Returns:
+        - events: List of dictionaries with the id, ip_address, command, source_ip and time of each event.
+        - cursor: ID of the last event read, or the given cursor if there were none.
+        """
+        raise NotImplementedError
+
+    def get_leaderboards(self, limit=10):
+        """
+        Get the devices that were delivered the most commands and the IP addresses that sent the most of them.
+        Parameters:
+        - limit: The number of entries on each leaderboard.
+        Returns:
+        - leaderboards: Dictionary with hacked_devices and hackers, each a list of dictionaries with the
+          ip_address and hacks, most hacks first.
+        """
+        raise NotImplementedError
+
+    def migrate_devices(self):
+        """
+        Convert devices stored in an older layout to the current one.
+        Returns:
+        - migrated: The number of devices migrated.
+        """
+        return 0
+
+class RedisDeviceStore(DeviceStore):
+    """
+    Devices kept in Redis by the helpers in device.py, with password hashes cached by credential_cache.py.
+    """
+    def __init__(self, redis_client, device_timeout_seconds):
+        """
+        Parameters:
+        - redis_client: The Redis client object or ShardRing.
+        - device_timeout_seconds: The time interval in seconds after which a device expires if not seen.
+        """
+        super().__init__(device_timeout_seconds)
+        self.redis_client = redis_client
+
+    def insert_device(self, device_ip):
+        return device.insert_device(device_ip, self.device_timeout_seconds, self.redis_client)
+
+    def get_device_data(self, device_ip):
+        return device.get_device_data(device_ip, self.redis_client)
+
+    def get_device_password_hashes(self, device_ips):
+        return device.get_device_password_hashes(device_ips, self.redis_client)
+
+    def get_password_hash(self, device_ip):
+        return credential_cache.lookup_password_hash(device_ip, self.redis_client)
+
+    def invalidate_password_hash(self, device_ip):
+        credential_cache.invalidate_password_hash(device_ip)
+
+    def update_last_seen(self, device_ip):
+        return device.update_last_seen(device_ip, self.device_timeout_seconds, self.redis_client)
+
+    def update_password(self, device_ip, new_password):
+        return device.update_password(device_ip, new_password, self.redis_client)
+
+    def update_device_passwords(self, device_ips, new_password):
+        return device.update_device_passwords(device_ips, new_password, self.redis_client)
+
+    def poll_device(self, device_ip, max_commands=1):
+        return device.poll_device(device_ip, self.device_timeout_seconds, self.redis_client, max_commands)
+
+    def queue_device_command(self, device_ip, command_data, max_queued_commands=10, coalesce=False, password_hash=None):
+        return device.queue_device_command(device_ip, command_data, self.device_timeout_seconds, self.redis_client, max_queued_commands, coalesce, password_hash)
+
+    def queue_device_commands(self, device_ips, command_data, max_queued_commands=10, coalesce=False, password_hashes=None):
+        return device.queue_device_commands(device_ips, command_data, self.device_timeout_seconds, self.redis_client, max_queued_commands, coalesce, password_hashes)
+
+    def wait_for_device_command(self, device_ip, wait_seconds):
+        return device.wait_for_device_command(device_ip, wait_seconds, self.redis_client)
+
+    def list_devices(self, page=1, per_page=50, sort_by='last_seen'):
+        return device.list_devices(self.device_timeout_seconds, self.redis_client, page, per_page, sort_by)
+
+    def remove_device(self, device_ip):
+        return device.remove_device_database(device_ip, self.redis_client)
+
+    def get_fleet_stats(self):
+        return device.get_fleet_stats(self.device_timeout_seconds, self.redis_client)
+
+    def check_rate_limit(self, buckets):
+        return rate_limit.check_rate_limit(buckets, self.redis_client)
+
+    def read_hack_events(self, cursor='0', limit=100):
+        return hack_events.read_hack_events(cursor, limit, self.redis_client)
+
+    def get_leaderboards(self, limit=10):
+        return hack_events.get_leaderboards(limit, self.redis_client)
+
+    def migrate_devices(self):
+        return device.migrate_device_database(self.device_timeout_seconds, self.redis_client)
+
+class MemoryDeviceStore(DeviceStore):
+    """
+    Devices kept in dictionaries in this process, guarded by one lock. Expired devices, command queues
+    and rate limit buckets are dropped when they are next read, and swept now and then.
+    """
+    def __init__(self, device_timeout_seconds, clock=time.time):
+        """
+        Parameters:
+        - device_timeout_seconds: The time interval in seconds after which a device expires if not seen.
+        - clock: Function returning the current epoch time in seconds, replaceable for deterministic runs.
+        """
+        super().__init__(device_timeout_seconds)
+        self._clock = clock
+        # Notified whenever a command is queued, to wake the long polls
+        self._condition = threading.Condition()
+        # Maps each IP address to its device fields, and to the time the device expires
+        self._devices = {}
+        self._device_expiry = {}
+        # Maps each IP address to a deque of its queued commands as JSON, and to the time the queue expires
+        self._commands = {}
+        self._command_expiry = {}
+        # Maps each bucket key to (tokens, updated_ms, expires_ms)
+        self._rate_limits = {}
+        self._next_sweep = 0
+        # Delivered commands as (entry_id, event) tuples oldest first, with the (time_ms, sequence) of the
+        # last ID, and the hacks counted for each device and source IP address
+        self._hack_events = collections.deque(maxlen=hack_events.HACK_EVENTS_MAX_LENGTH)
+        self._last_hack_event_id = (0, 0)
+        self._hacked_devices = collections.Counter()
+        self._hackers = collections.Counter()
+        # Function called with every device event, in the format of the device events channel
+        self.event_handler = None
+
+    def _now(self):
+        now = self._clock()
+        if now >= self._next_sweep:
+            self._sweep(now)
+            self._next_sweep = now + SWEEP_INTERVAL_SECONDS
+        return now
+
+    def _publish_event(self, event, device_ip, **fields):
+        if self.event_handler:
+            self.event_handler({'event': event, 'ip_address': device_ip, **fields})
+
+    def _sweep(self, now):
+        for device_ip in [device_ip for device_ip, expires in self._device_expiry.items() if expires <= now]:
+            self._drop_device(device_ip)
+            self._publish_event('expired', device_ip)
+        for device_ip in [device_ip for device_ip, expires in self._command_expiry.items() if expires <= now]:
+            self._drop_commands(device_ip)
+        now_ms = now * 1000
+        for key in [key for key, (tokens, updated, expires) in self._rate_limits.items() if expires <= now_ms]:
+            del self._rate_limits[key]
+
+    def _drop_device(self, device_ip):
+        self._devices.pop(device_ip, None)
+        self._device_expiry.pop(device_ip, None)
+
+    def _drop_commands(self, device_ip):
+        self._commands.pop(device_ip, None)
+        self._command_expiry.pop(device_ip, None)
+
+    def _get_device(self, device_ip, now):
+        # The device fields, or None if the device is not found or has expired
+        if self._device_expiry.get(device_ip, now) <= now:
+            if device_ip in self._devices:
+                self._drop_device(device_ip)
+                self._publish_event('expired', device_ip)
+            return None
+        return self._devices[device_ip]
+
+    def _get_commands(self, device_ip, now):
+        # The queued commands of a device, or an empty tuple if there are none or the queue has expired
+        if self._command_expiry.get(device_ip, now) <= now:
+            self._drop_commands(device_ip)
+            return ()
+        return self._commands[device_ip]
+
+    def insert_device(self, device_ip):
+        hashed_password, raw_password = generate_md5_password()
+        with self._condition:
+            now = self._now()
+            self._devices[device_ip] = {'password': hashed_password, 'raw_password': raw_password, 'last_seen': int(now)}
+            self._device_expiry[device_ip] = now + self.device_timeout_seconds
+            self._publish_event('inserted', device_ip, password_hash=hashed_password, last_seen=int(now))
+        return True, "Good", raw_password
+
+    def get_device_data(self, device_ip):
+        with self._condition:
+            device_data = self._get_device(device_ip, self._now())
+            return dict(device_data) if device_data else None
+
+    def get_device_password_hashes(self, device_ips):
+        with self._condition:
+            now = self._now()
+            password_hashes = {}
+            for device_ip in device_ips:
+                device_data = self._get_device(device_ip, now)
+                password_hashes[device_ip] = device_data['password'] if device_data else None
+            return password_hashes
+
+    def update_last_seen(self, device_ip):
+        with self._condition:
+            now = self._now()
+            device_data = self._get_device(device_ip, now)
+            if not device_data:
+                return False, "Device not found"
+            device_data['last_seen'] = int(now)
+            self._device_expiry[device_ip] = now + self.device_timeout_seconds
+            return True, "Good"
+
+    def update_password(self, device_ip, new_password):
+        hashed_password = hashlib.md5(new_password.encode()).hexdigest()
+        with self._condition:
+            device_data = self._get_device(device_ip, self._now())
+            if not device_data:
+                return False, "Device not found", None
+            device_data.update({'password': hashed_password, 'raw_password': new_password})
+            self._publish_event('password_changed', device_ip, password_hash=hashed_password)
+        return True, "Successfully updated password", hashed_password
+
+    def update_device_passwords(self, device_ips, new_password):
+        with self._condition:
+            results = {}
+            for device_ip in device_ips:
+                status, message, hashed_password = self.update_password(device_ip, new_password)
+                results[device_ip] = (status, message)
+            return results
+
+    def poll_device(self, device_ip, max_commands=1):
+        with self._condition:
+            now = self._now()
+            device_data = self._get_device(device_ip, now)
+            if not device_data:
+                return False, "Device not found", []
+            queue = self._get_commands(device_ip, now)
+            commands = [json.loads(queue.popleft()) for _ in range(min(max_commands, len(queue)))]
+            if not queue:
+                self._drop_commands(device_ip)
+            device_data['last_seen'] = int(now)
+            if commands:
+                device_data['last_hacked_time'] = int(now)
+                self._publish_event('hacked', device_ip, last_hacked_time=int(now))
+                self._record_hack_events(device_ip, commands, now)
+            self._device_expiry[device_ip] = now + self.device_timeout_seconds
+            return True, "Device is active", commands
+
+    def _record_hack_events(self, device_ip, commands, now):
+        # Same entries and counts as the poll script, with IDs ordered like Redis Stream IDs
+        for command_data in commands:
+            time_ms, sequence = self._last_hack_event_id
+            entry_id = (time_ms, sequence + 1) if int(now * 1000) <= time_ms else (int(now * 1000), 0)
+            self._last_hack_event_id = entry_id
+            source_ip = command_data.get('source_ip') or ''
+            fields = {'ip_address': device_ip, 'command': str(command_data.get('command')), 'source_ip': source_ip, 'time': str(int(now))}
+            self._hack_events.append((entry_id, hack_events.format_hack_event(f"{entry_id[0]}-{entry_id[1]}", fields)))
+            self._hacked_devices[device_ip] += 1
+            if source_ip:
+                self._hackers[source_ip] += 1
+
+    def _queue_command(self, device_ip, command_data, command_json, now, max_queued_commands, coalesce, password_hash):
+        # Same checks and result codes as QUEUE_DEVICE_COMMAND_SCRIPT
+        if password_hash:
+            device_data = self._get_device(device_ip, now)
+            if not device_data:
+                return -1
+            if device_data['password'] != password_hash:
+                return -2
+        queue = self._get_commands(device_ip, now) or collections.deque()
+        if coalesce:
+            queue = collections.deque(queued for queued in queue if json.loads(queued)['command'] != command_data['command'])
+        if len(queue) >= max_queued_commands:
+            return 0
+        queue.append(command_json)
+        self._commands[device_ip] = queue
+        self._command_expiry[device_ip] = now + self.device_timeout_seconds
+        return len(queue)
+
+    def queue_device_command(self, device_ip, command_data, max_queued_commands=10, coalesce=False, password_hash=None):
+        command_json = json.dumps(command_data)
+        with self._condition:
+            result = self._queue_command(device_ip, command_data, command_json, self._now(), max_queued_commands, coalesce, password_hash)
+            if result > 0:
+                self._condition.notify_all()
+        if result <= 0:
+            return False, QUEUE_ERRORS.get(result, "Device not found")
+        return True, "Good"
+
+    def queue_device_commands(self, device_ips, command_data, max_queued_commands=10, coalesce=False, password_hashes=None):
+        password_hashes = password_hashes or {}
+        command_json = json.dumps(command_data)
+        results = {}
+        with self._condition:
+            now = self._now()
+            for device_ip in device_ips:
+                queue_length = self._queue_command(device_ip, command_data, command_json, now, max_queued_commands, coalesce, password_hashes.get(device_ip))
+                results[device_ip] = (True, "Good") if queue_length > 0 else (False, QUEUE_ERRORS.get(queue_length, "Device not found"))
+            self._condition.notify_all()
+        return results
+
+    def wait_for_device_command(self, device_ip, wait_seconds):
+        with self._condition:
+            return self._condition.wait_for(lambda: bool(self._get_commands(device_ip, self._now())), wait_seconds)
+
+    def list_devices(self, page=1, per_page=50, sort_by='last_seen'):
+        with self._condition:
+            now = self._now()
+            self._sweep(now)
+            # Most recent first, with ties in reverse IP address order like ZREVRANGE
+            entries = sorted(((device_data[sort_by], device_ip) for device_ip, device_data in self._devices.items() if device_data.get(sort_by) is not None), reverse=True)
+            start = (page - 1) * per_page
+            devices = []
+            for score, device_ip in entries[start:start + per_page]:
+                device_data = self._devices[device_ip]
+                devices.append({
+                    'ip_address': device_ip,
+                    'password_hash': device_data['password'],
+                    'last_seen': device_data.get('last_seen'),
+                    'last_hacked_time': device_data.get('last_hacked_time')
+                })
+            return devices, len(entries)
+
+    def remove_device(self, device_ip):
+        with self._condition:
+            if not self._get_device(device_ip, self._now()):
+                return False, "Device not found"
+            self._drop_device(device_ip)
+            self._publish_event('removed', device_ip)
+            return True, "Good"
+
+    def get_fleet_stats(self):
+        with self._condition:
+            now = self._now()
+            self._sweep(now)
+            cutoff = int(now) - self.device_timeout_seconds
+            active_ips = [device_ip for device_ip, device_data in self._devices.items() if device_data['last_seen'] >= cutoff]
+            hacked_devices = sum(1 for device_data in self._devices.values() if device_data.get('last_hacked_time', -math.inf) >= cutoff)
+            pending_commands = sum(len(self._get_commands(device_ip, now)) for device_ip in active_ips)
+            return len(active_ips), hacked_devices, pending_commands
+
+    def read_hack_events(self, cursor='0', limit=100):
+        time_ms, _, sequence = cursor.partition('-')
+        after = (int(time_ms), int(sequence or 0))
+        with self._condition:
+            events = [dict(event) for entry_id, event in itertools.islice((entry for entry in self._hack_events if entry[0] > after), limit)]
+        return events, events[-1]['id'] if events else cursor
+
+    def get_leaderboards(self, limit=10):
+        with self._condition:
+            # Most hacks first, with ties in reverse IP address order like ZREVRANGE
+            return {
+                'hacked_devices': [{'ip_address': device_ip, 'hacks': hacks} for device_ip, hacks in heapq.nlargest(limit, self._hacked_devices.items(), key=lambda item: (item[1], item[0]))],
+                'hackers': [{'ip_address': source_ip, 'hacks': hacks} for source_ip, hacks in heapq.nlargest(limit, self._hackers.items(), key=lambda item: (item[1], item[0]))]
+            }
+
+    def check_rate_limit(self, buckets):
+        if not buckets:
+            return True, 0
+        with self._condition:
+            # Same token buckets as RATE_LIMIT_SCRIPT
+            now_ms = int(self._now() * 1000)
+            tokens = []
+            retry_after_ms = 0
+            for key, burst, rate, cost in buckets:
+                available, updated, expires = self._rate_limits.get(key, (burst, now_ms, math.inf))
+                if expires <= now_ms:
+                    available, updated = burst, now_ms
+                available = min(burst, available + max(now_ms - updated, 0) * rate / 1000)
+                tokens.append(available - cost)
+                if available < cost:
+                    retry_after_ms = max(retry_after_ms, math.ceil((cost - available) * 1000 / rate))
+            if not retry_after_ms:
+                for (key, burst, rate, cost), remaining in zip(buckets, tokens):
+                    # A bucket left alone refills completely, so it can be dropped once that has happened
+                    self._rate_limits[key] = (remaining, now_ms, now_ms + math.ceil(burst * 1000 / rate) + 1000)
+        retry_after = _retry_after_seconds(retry_after_ms)
+        return not retry_after, retry_after
+
+def create_device_store(backend, device_timeout_seconds, redis_client=None):
+    """
+    Create the device store of the server.
+    Parameters:
+    - backend: One of STORAGE_BACKENDS.
+    - device_timeout_seconds: The time interval in seconds after which a device expires if not seen.
+    - redis_client: The Redis client object, needed by the redis backend.
+    Returns:
+    - device_store: The DeviceStore.
+    """
+    if backend == 'redis':
+        return RedisDeviceStore(redis_client, device_timeout_seconds)
+    if backend == 'memory':
+        return MemoryDeviceStore(device_timeout_seconds)
+    raise ValueError(f"Unknown storage backend {backend!r}, expected one of {', '.join(STORAGE_BACKENDS)}")
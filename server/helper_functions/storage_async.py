@@ -0,0 +1,120 @@
+"""
+Device store for the asyncio serving mode.
+
+AsyncRedisDeviceStore has the methods of DeviceStore that the routes of asgi.py use, as coroutines
+running the helpers in device_async.py on a redis.asyncio client, so those routes talk to a store like
+the Flask routes do instead of calling the Redis helpers directly.
+
+There is no asyncio memory store: the in-memory store waits for commands on a thread condition,
+which would block the event loop, so the asyncio serving mode needs STORAGE_BACKEND=redis.
+"""
+from helper_functions import credential_cache, device_async, rate_limit
+
+class AsyncRedisDeviceStore:
+    """
+    Devices kept in Redis by the helpers in device_async.py, with password hashes cached by credential_cache.py.
+    Each method is a coroutine behaving like the RedisDeviceStore method of the same name, except for the
+    long polls, which watch for a command with watch_device_commands before polling.
+    """
+    def __init__(self, redis_client, device_timeout_seconds):
+        """
+        Parameters:
+        - redis_client: The redis.asyncio client object or ShardRing.
+        - device_timeout_seconds: The time interval in seconds after which a device expires if not seen.
+        """
+        self.redis_client = redis_client
+        self.device_timeout_seconds = device_timeout_seconds
+
+    def start(self):
+        # Share one pub/sub subscription between every long poll in this process
+        device_async.start_wakeup_listener(self.redis_client)
+
+    async def stop(self):
+        # Stop the wakeup listener started by start
+        await device_async.stop_wakeup_listener()
+
+    async def insert_device(self, device_ip):
+        return await device_async.insert_device(device_ip, self.device_timeout_seconds, self.redis_client)
+
+    async def get_device_data(self, device_ip):
+        return await device_async.get_device_data(device_ip, self.redis_client)
+
+    async def get_device_password_hashes(self, device_ips):
+        return await device_async.get_device_password_hashes(device_ips, self.redis_client)
+
+    async def get_password_hash(self, device_ip):
+        return await credential_cache.lookup_password_hash_async(device_ip, self.redis_client)
+
+    def invalidate_password_hash(self, device_ip):
+        credential_cache.invalidate_password_hash(device_ip)
+
+    async def update_last_seen(self, device_ip):
+        return await device_async.update_last_seen(device_ip, self.device_timeout_seconds, self.redis_client)
+
+    async def update_password(self, device_ip, new_password):
+        return await device_async.update_password(device_ip, new_password, self.redis_client)
+
+    async def update_device_passwords(self, device_ips, new_password):
+        return await device_async.update_device_passwords(device_ips, new_password, self.redis_client)
+
+    async def poll_device(self, device_ip, max_commands=1):
+        return await device_async.poll_device(device_ip, self.device_timeout_seconds, self.redis_client, max_commands)
+
+    async def queue_device_command(self, device_ip, command_data, max_queued_commands=10, coalesce=False, password_hash=None):
+        return await device_async.queue_device_command(device_ip, command_data, self.device_timeout_seconds, self.redis_client, max_queued_commands, coalesce, password_hash)
+
+    async def queue_device_commands(self, device_ips, command_data, max_queued_commands=10, coalesce=False, password_hashes=None):
+        return await device_async.queue_device_commands(device_ips, command_data, self.device_timeout_seconds, self.redis_client, max_queued_commands, coalesce, password_hashes)
+
+    def watch_device_commands(self, device_ip):
+        """
+        Watch for commands queued for a device. Start watching before polling the device,
+        so a command queued between the poll and the wait still wakes it.
+        Parameters:
+        - device_ip: The IP address of the device.
+        Returns:
+        - wakeup: Context manager giving the value to pass to wait_for_device_command.
+        """
+        return device_async.watch_device_commands(device_ip)
+
+    async def wait_for_device_command(self, device_ip, wakeup, wait_seconds):
+        """
+        Wait until a command is queued for a device or the wait times out.
+        Parameters:
+        - device_ip: The IP address of the device.
+        - wakeup: The value given by watch_device_commands.
+        - wait_seconds: The longest time in seconds to wait for a command.
+        Returns:
+        - status: True if a command was queued while waiting, False if the wait timed out.
+        """
+        return await device_async.wait_for_device_command(device_ip, wakeup, wait_seconds, self.redis_client)
+
+    async def list_devices(self, page=1, per_page=50, sort_by='last_seen'):
+        return await device_async.list_devices(self.device_timeout_seconds, self.redis_client, page, per_page, sort_by)
+
+    async def check_rate_limit(self, buckets):
+        return await rate_limit.check_rate_limit_async(buckets, self.redis_client)
+
+def check_async_backend(backend):
+    """
+    Refuse to serve the asyncio routes on a storage backend they can't share with the Flask app.
+    Parameters:
+    - backend: The STORAGE_BACKEND of the Flask app.
+    Raises:
+    - ValueError: If the backend has no asyncio store.
+    """
+    if backend != 'redis':
+        raise ValueError(f"The asyncio serving mode needs STORAGE_BACKEND=redis, not {backend!r}: the {backend} store can't be shared with it")
+
+def create_async_device_store(backend, device_timeout_seconds, redis_client):
+    """
+    Create the device store of the asyncio serving mode.
+    Parameters:
+    - backend: The STORAGE_BACKEND of the Flask app, whose devices the store must share.
+    - device_timeout_seconds: The time interval in seconds after which a device expires if not seen.
+    - redis_client: The redis.asyncio client object or ShardRing.
+    Returns:
+    - device_store: The AsyncRedisDeviceStore.
+    """
+    check_async_backend(backend)
+    return AsyncRedisDeviceStore(redis_client, device_timeout_seconds)
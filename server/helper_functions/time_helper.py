@@ -1,10 +1,11 @@
 from datetime import datetime, timezone
+import time
 
 def get_current_utc_time():
-    # Format the time as a string in the MySQL TIMESTAMP format ('YYYY-MM-DD HH:MM:SS')
-    formatted_utc_time = datetime.strptime(get_current_utc_time_string(), '%Y-%m-%d %H:%M:%S')
-    
-    return formatted_utc_time
+    # Get the current time in UTC, truncated to the precision of the MySQL TIMESTAMP format ('YYYY-MM-DD HH:MM:SS')
+    current_utc_time = datetime.now(timezone.utc).replace(microsecond=0, tzinfo=None)
+
+    return current_utc_time
 
 def get_current_utc_time_string():
     # Get the current time in UTC
@@ -19,4 +20,20 @@ def convert_string_time_to_datetime(time_string):
     # Convert the string to a datetime object
     time_object = datetime.strptime(str(time_string), '%Y-%m-%d %H:%M:%S')
     
-    return time_object
\ No newline at end of file
+    return time_object
+
+def get_current_epoch_time():
+    # Get the current time as whole seconds since the Unix epoch
+    return int(time.time())
+
+def convert_string_time_to_epoch(time_string):
+    # Convert a UTC time string in the MySQL TIMESTAMP format to seconds since the Unix epoch
+    time_object = convert_string_time_to_datetime(time_string).replace(tzinfo=timezone.utc)
+
+    return int(time_object.timestamp())
+
+def convert_epoch_to_string(epoch_time):
+    # Convert seconds since the Unix epoch to a UTC time string in the MySQL TIMESTAMP format
+    time_object = datetime.fromtimestamp(int(epoch_time), timezone.utc)
+
+    return time_object.strftime('%Y-%m-%d %H:%M:%S')
\ No newline at end of file
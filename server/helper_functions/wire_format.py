@@ -0,0 +1,95 @@
+"""
+Compact binary encoding for the badge-facing endpoints.
+
+Devices ask for it with ?format=bin or an Accept: application/octet-stream header. Every message
+starts with a type byte:
+- Commands (1): a count byte, then for each command its code byte from the command registry
+  followed by its fields in order.
+- Credentials (2): the IP address and then the password of the device.
+Fields of type u8 are one byte. Strings are a length byte followed by up to 255 bytes of UTF-8.
+
+A message must fit the buffer the firmware reads it into, so a batch of commands is limited to the
+number that fit even if every string field is as long as the command parameters allow.
+"""
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from helper_functions.commands import COMMANDS, MAX_STRING_FIELD_BYTES
+
+BINARY_MIMETYPE = 'application/octet-stream'
+MESSAGE_COMMANDS = 1
+MESSAGE_CREDENTIALS = 2
+MAX_MESSAGE_BYTES = 1024 # Size of the firmware's response buffer, MAX_RESPONSE_SIZE in src/cyber/cyber.cpp
+
+def max_command_bytes():
+    # Longest encoding of any command: its code byte, then each field at its longest
+    field_bytes = {'u8': 1, 'str': 1 + MAX_STRING_FIELD_BYTES}
+    return max(1 + sum(field_bytes[field_type] for field, field_type in command['fields']) for command in COMMANDS.values())
+
+# Most commands one binary message can carry, after its type and count bytes
+MAX_BINARY_BATCH_SIZE = min((MAX_MESSAGE_BYTES - 2) // max_command_bytes(), 255)
+
+def wants_binary(query_format, accept_header):
+    """
+    Check whether a device asked for the compact binary format.
+    Parameters:
+    - query_format: The format query string argument, if any.
+    - accept_header: The Accept header of the request, if any.
+    Returns:
+    - status: True if the response should use the binary format, False for JSON.
+    """
+    if query_format == 'bin':
+        return True
+    accept = parse_accept_header(accept_header, MIMEAccept)
+    return accept.best_match(['application/json', BINARY_MIMETYPE]) == BINARY_MIMETYPE
+
+def encode_string(value):
+    """
+    Encode a string as a length byte followed by its UTF-8 bytes.
+    Parameters:
+    - value: The string to encode.
+    Returns:
+    - data: The encoded bytes.
+    Raises:
+    - ValueError: If the string is longer than 255 bytes, rather than send the device a different string.
+    """
+    encoded = str(value).encode()
+    if len(encoded) > 255:
+        raise ValueError(f"String of {len(encoded)} bytes is too long for the binary format")
+    return bytes([len(encoded)]) + encoded
+
+def encode_commands(queued_commands):
+    """
+    Encode queued commands in the binary format, skipping any that are not in the command registry.
+    Pop at most MAX_BINARY_BATCH_SIZE commands for one message, so it always fits the firmware's buffer.
+    Parameters:
+    - queued_commands: List of dictionaries with the command and its params.
+    Returns:
+    - data: The encoded bytes.
+    Raises:
+    - ValueError: If the message would not fit the firmware's buffer.
+    """
+    commands = [command_data for command_data in queued_commands if command_data.get('command') in COMMANDS]
+    data = bytearray([MESSAGE_COMMANDS, len(commands)])
+    for command_data in commands:
+        command = COMMANDS[command_data['command']]
+        data.append(command['code'])
+        for field, field_type in command['fields']:
+            value = command_data['params'][field]
+            if field_type == 'u8':
+                data.append(int(value) & 0xFF)
+            else:
+                data += encode_string(value)
+    if len(data) > MAX_MESSAGE_BYTES:
+        raise ValueError(f"Message of {len(data)} bytes is too long for the firmware's buffer")
+    return bytes(data)
+
+def encode_credentials(device_ip, password):
+    """
+    Encode the credentials of a device in the binary format.
+    Parameters:
+    - device_ip: The IP address of the device.
+    - password: The password of the device.
+    Returns:
+    - data: The encoded bytes.
+    """
+    return bytes([MESSAGE_CREDENTIALS]) + encode_string(device_ip) + encode_string(password)
@@ -0,0 +1,123 @@
+// Keep the admin device table up to date from the server-sent device events, instead of reloading the page
+document.addEventListener("DOMContentLoaded", function () {
+    var table = document.getElementById('deviceTable');
+    var liveStatus = document.getElementById('liveStatus');
+    if (!table || !window.EventSource) {
+        liveStatus.textContent = 'Reload to update';
+        return;
+    }
+    var tbody = table.querySelector('tbody');
+    var page = parseInt(table.dataset.page, 10);
+    var perPage = parseInt(table.dataset.perPage, 10);
+    var sortBy = table.dataset.sortBy;
+
+    function setStatus(text, style) {
+        liveStatus.textContent = text;
+        liveStatus.className = 'badge align-middle badge-' + style;
+    }
+
+    function findRow(ipAddress) {
+        return tbody.querySelector('tr[data-ip-address="' + CSS.escape(ipAddress) + '"]');
+    }
+
+    function addRow(ipAddress) {
+        var row = document.createElement('tr');
+        row.className = 'text-center';
+        row.dataset.ipAddress = ipAddress;
+        ['ip-address', 'password-hash', 'last-hacked-time'].forEach(function (name) {
+            var cell = document.createElement('td');
+            cell.className = name;
+            row.appendChild(cell);
+        });
+        row.querySelector('.ip-address').textContent = ipAddress;
+        row.querySelector('.last-hacked-time').textContent = 'N/A';
+        return row;
+    }
+
+    function moveToTop(row) {
+        // Only the first page shows the most recent devices, and it keeps its size
+        tbody.insertBefore(row, tbody.firstChild);
+        while (tbody.rows.length > perPage) {
+            tbody.deleteRow(-1);
+        }
+    }
+
+    function flash(row) {
+        row.classList.add('table-warning');
+        setTimeout(function () { row.classList.remove('table-warning'); }, 2000);
+    }
+
+    var handlers = {
+        joined: function (event, row) {
+            if (!row && page === 1 && sortBy === 'last_seen') {
+                row = addRow(event.ip_address);
+            }
+            if (!row) {
+                return;
+            }
+            // A device rejoining gets a new password and has not been hacked since
+            row.querySelector('.password-hash').textContent = event.password_hash || '';
+            row.querySelector('.last-hacked-time').textContent = 'N/A';
+            if (page === 1 && sortBy === 'last_seen') {
+                moveToTop(row);
+            }
+            flash(row);
+        },
+        password_changed: function (event, row) {
+            if (row) {
+                row.querySelector('.password-hash').textContent = event.password_hash || '';
+                flash(row);
+            }
+        },
+        hacked: function (event, row) {
+            if (!row && page === 1 && sortBy === 'last_hacked_time') {
+                row = addRow(event.ip_address);
+                row.querySelector('.password-hash').textContent = '(reload to see)';
+            }
+            if (!row) {
+                return;
+            }
+            row.querySelector('.last-hacked-time').textContent = event.last_hacked_time;
+            if (page === 1 && sortBy === 'last_hacked_time') {
+                moveToTop(row);
+            }
+            flash(row);
+        },
+        expired: function (event, row) {
+            if (row) {
+                row.remove();
+            }
+        },
+        removed: function (event, row) {
+            if (row) {
+                row.remove();
+            }
+        }
+    };
+
+    var source = new EventSource(table.dataset.eventsUrl);
+    source.onopen = function () {
+        setStatus('Live', 'success');
+    };
+    source.onerror = function () {
+        // The browser reconnects on its own, unless the server turned the stream away
+        if (source.readyState === EventSource.CLOSED) {
+            setStatus('Reload to update', 'secondary');
+        } else {
+            setStatus('Reconnecting', 'warning');
+        }
+    };
+    source.onmessage = function (message) {
+        var event = JSON.parse(message.data);
+        if (event.event === 'resync') {
+            // Some events were missed, so fetch the whole page again
+            source.close();
+            window.location.reload();
+            return;
+        }
+        var handler = handlers[event.event];
+        if (handler) {
+            handler(event, findRow(event.ip_address));
+        }
+    };
+});
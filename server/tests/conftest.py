@@ -0,0 +1,54 @@
+"""
+Fixtures for the route tests, run from the server directory with `python -m pytest tests`.
+
+The app is created with the in-memory device store, so the tests need neither Redis nor a network.
+"""
+import os
+import sys
+import pytest
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+os.chdir(SERVER_DIR)
+# Set before importing the app, which creates one app from the environment as it loads
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ['CREDENTIAL_CACHE_SIZE'] = '0'
+
+import app as app_module
+from helper_functions.storage import RedisDeviceStore
+
+SOURCE_RATE_LIMIT = (20, 5) # Burst and tokens per second of each source, as by default
+
+@pytest.fixture
+def app():
+    # A fresh app and memory store for every test
+    return app_module.create_app({'STORAGE_BACKEND': 'memory', 'SOURCE_RATE_LIMIT': SOURCE_RATE_LIMIT, 'DEVICE_RATE_LIMIT': (20, 5)})
+
+@pytest.fixture
+def redis_client():
+    # An empty Redis for every test, for the checks that need the Redis layout
+    fakeredis = pytest.importorskip('fakeredis')
+    return fakeredis.FakeRedis(server=fakeredis.FakeServer())
+
+@pytest.fixture
+def redis_device_store(app, redis_client, monkeypatch):
+    # Serve the app's routes from a RedisDeviceStore instead of the memory store
+    device_store = RedisDeviceStore(redis_client, app_module.DEVICE_TIMEOUT_SECONDS)
+    monkeypatch.setattr(app_module, 'device_store', device_store)
+    return device_store
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def insert_devices():
+    def insert(device_ips):
+        # Maps each inserted device to its password
+        passwords = {}
+        for device_ip in device_ips:
+            status, message, password = app_module.device_store.insert_device(device_ip)
+            passwords[device_ip] = password
+        return passwords
+    return insert
@@ -0,0 +1,29 @@
+from conftest import SOURCE_RATE_LIMIT
+
+def test_bulk_request_is_capped_at_the_source_burst(client, insert_devices):
+    # One request for more devices than the source burst could never be paid for, so it isn't worth retrying
+    passwords = insert_devices([f"10.0.0.{i}" for i in range(1, int(SOURCE_RATE_LIMIT[0]) + 2)])
+    targets = [{'ip_address': device_ip, 'password': password} for device_ip, password in passwords.items()]
+    response = client.post('/control_devices', json={'control_type': 'rickroll', 'targets': targets})
+    assert response.status_code == 400
+    assert response.get_json() == {'error': f"Too many targets, at most {int(SOURCE_RATE_LIMIT[0])}"}
+    # A request for the whole burst goes through
+    response = client.post('/control_devices', json={'control_type': 'rickroll', 'targets': targets[:-1]})
+    assert response.status_code == 200
+
+def test_bulk_requests_share_the_source_budget(client, insert_devices):
+    # Two requests that each fit in the burst, but not together
+    passwords = insert_devices([f"10.0.1.{i}" for i in range(1, int(SOURCE_RATE_LIMIT[0]) + 1)])
+    targets = [{'ip_address': device_ip, 'password': password} for device_ip, password in passwords.items()]
+    half = len(targets) // 2 + 1
+    response = client.post('/control_devices', json={'control_type': 'rickroll', 'targets': targets[:half]})
+    assert response.status_code == 200
+    response = client.post('/control_devices', json={'control_type': 'rickroll', 'targets': targets[half - 1:]})
+    assert response.status_code == 429
+    assert 'Retry-After' in response.headers
+
+def test_cidr_passwords_must_map_addresses(client):
+    for passwords in (['hunter2'], 'hunter2'):
+        response = client.post('/control_devices', json={'control_type': 'rickroll', 'cidr': '10.0.2.0/30', 'passwords': passwords})
+        assert response.status_code == 400
+        assert response.get_json() == {'error': 'Invalid passwords'}
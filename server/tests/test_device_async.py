@@ -0,0 +1,57 @@
+"""
+Tests of the asyncio device store, which sends the same Redis commands as RedisDeviceStore.
+"""
+import asyncio
+import json
+import pytest
+from helper_functions.device import device_key
+from helper_functions.storage import RedisDeviceStore
+from helper_functions.storage_async import AsyncRedisDeviceStore
+from helper_functions.time_helper import convert_epoch_to_string, get_current_epoch_time
+
+DEVICE_TIMEOUT_SECONDS = 300
+
+@pytest.fixture
+def stores():
+    # An asyncio store and a blocking store on the same empty Redis
+    fakeredis = pytest.importorskip('fakeredis')
+    from fakeredis import aioredis
+    server = fakeredis.FakeServer()
+    return AsyncRedisDeviceStore(aioredis.FakeRedis(server=server), DEVICE_TIMEOUT_SECONDS), RedisDeviceStore(fakeredis.FakeRedis(server=server), DEVICE_TIMEOUT_SECONDS)
+
+def test_devices_are_shared_with_the_blocking_store(stores):
+    async_store, store = stores
+
+    async def run():
+        status, message, raw_password = await async_store.insert_device('10.0.0.1')
+        assert status and store.get_device_data('10.0.0.1')['raw_password'] == raw_password
+        store.insert_device('10.0.0.2')
+        password_hashes = await async_store.get_device_password_hashes(['10.0.0.1', '10.0.0.2', '10.0.0.9'])
+        assert password_hashes == store.get_device_password_hashes(['10.0.0.1', '10.0.0.2', '10.0.0.9'])
+        assert await async_store.queue_device_command('10.0.0.1', {'command': 'rickroll', 'params': {}}, password_hash='0' * 32) == (False, "Invalid password")
+        results = await async_store.queue_device_commands(['10.0.0.1', '10.0.0.2'], {'command': 'rickroll', 'params': {}})
+        assert results == {'10.0.0.1': (True, "Good"), '10.0.0.2': (True, "Good")}
+        assert store.poll_device('10.0.0.2', 10)[2] == [{'command': 'rickroll', 'params': {}}]
+        status, message, commands = await async_store.poll_device('10.0.0.1', 10)
+        assert status and commands == [{'command': 'rickroll', 'params': {}}]
+        results = await async_store.update_device_passwords(['10.0.0.1', '10.0.0.9'], 'hunter2')
+        assert results['10.0.0.1'][0] and not results['10.0.0.9'][0]
+        assert store.get_device_data('10.0.0.1')['raw_password'] == 'hunter2'
+        devices, total = await async_store.list_devices(sort_by='last_hacked_time')
+        assert (devices, total) == store.list_devices(sort_by='last_hacked_time')
+        assert total == 2
+
+    asyncio.run(run())
+
+def test_legacy_record_is_migrated(stores):
+    async_store, store = stores
+    last_seen = convert_epoch_to_string(get_current_epoch_time())
+    store.redis_client.set(device_key('10.0.0.1'), json.dumps({'password': 'hash', 'raw_password': 'legacy', 'last_seen': last_seen}))
+
+    async def run():
+        assert await async_store.get_password_hash('10.0.0.1') == 'hash'
+        assert await async_store.update_last_seen('10.0.0.1') == (True, "Good")
+        status, message, hashed_password = await async_store.update_password('10.0.0.1', 'hunter2')
+        assert status and store.get_device_data('10.0.0.1')['raw_password'] == 'hunter2'
+
+    asyncio.run(run())
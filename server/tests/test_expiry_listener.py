@@ -0,0 +1,8 @@
+from helper_functions.expiry_listener import merge_notification_flags
+
+def test_expired_key_events_keep_existing_flags():
+    assert merge_notification_flags('') == 'Ex'
+    assert merge_notification_flags('Kg') == 'KgEx'
+    assert merge_notification_flags('xE') == 'xE'
+    # A already covers the expired events
+    assert merge_notification_flags('KA') == 'KAE'
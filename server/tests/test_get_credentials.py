@@ -0,0 +1,18 @@
+import json
+from helper_functions.device import device_key
+from helper_functions.time_helper import convert_epoch_to_string, get_current_epoch_time
+
+def test_new_device_gets_credentials(client):
+    response = client.get('/get_credentials')
+    assert response.status_code == 200
+    assert response.get_json()['ip_address'] == '127.0.0.1'
+
+def test_stale_legacy_record_gets_new_credentials(client, redis_device_store, redis_client):
+    # A device left in the legacy JSON layout, last seen longer ago than the device timeout
+    last_seen = convert_epoch_to_string(get_current_epoch_time() - redis_device_store.device_timeout_seconds - 60)
+    redis_client.set(device_key('127.0.0.1'), json.dumps({'ip_address': '127.0.0.1', 'password': 'hash', 'raw_password': 'stale', 'last_seen': last_seen}))
+    response = client.get('/get_credentials')
+    assert response.status_code == 200
+    password = response.get_json()['password']
+    assert password != 'stale'
+    assert redis_device_store.get_device_data('127.0.0.1')['raw_password'] == password
@@ -0,0 +1,33 @@
+import pytest
+from helper_functions.route_helpers import parse_control_device_request, parse_bulk_request, error_status_code
+from helper_functions.storage_async import check_async_backend
+
+SOURCE_LIMIT = DEVICE_LIMIT = (20, 5)
+
+def test_control_device_request_needs_every_parameter():
+    status, message, control_request = parse_control_device_request({'ip_address': '10.0.3.1', 'control_type': 'rickroll'}, '10.0.9.9', SOURCE_LIMIT, DEVICE_LIMIT)
+    assert (status, message, control_request) == (False, "Missing parameters", None)
+
+def test_control_device_request_only_paces_valid_devices():
+    # An invalid IP address still costs the source a token, but has no device bucket of its own
+    status, message, control_request = parse_control_device_request({'ip_address': 'nope', 'password': 'x', 'control_type': 'rickroll'}, '10.0.9.9', SOURCE_LIMIT, DEVICE_LIMIT)
+    assert status
+    assert len(control_request['buckets']) == 1
+
+def test_bulk_request_errors_share_status_codes():
+    assert parse_bulk_request(['not', 'a', 'dict'], '10.0.9.9', 16, None, SOURCE_LIMIT, DEVICE_LIMIT)[:2] == (False, "Missing JSON body")
+    targets = [{'ip_address': f"10.0.4.{i}", 'password': 'x'} for i in range(1, 30)]
+    status, message, bulk_request = parse_bulk_request({'control_type': 'rickroll', 'targets': targets}, '10.0.9.9', 64, None, SOURCE_LIMIT, DEVICE_LIMIT)
+    assert (status, message, error_status_code(message)) == (False, "Too many targets, at most 20", 400)
+    assert error_status_code("Command queue full") == 429
+
+def test_bulk_request_from_admin_is_not_paced():
+    targets = [{'ip_address': f"10.0.5.{i}", 'password': 'x'} for i in range(1, 30)]
+    status, message, bulk_request = parse_bulk_request({'control_type': 'rickroll', 'targets': targets, 'admin_token': 'secret'}, '10.0.9.9', 64, 'secret', SOURCE_LIMIT, DEVICE_LIMIT)
+    assert status and bulk_request['is_admin']
+    assert bulk_request['buckets'] == []
+
+def test_asyncio_mode_refuses_the_memory_store():
+    check_async_backend('redis')
+    with pytest.raises(ValueError):
+        check_async_backend('memory')
@@ -0,0 +1,232 @@
+"""
+Conformance tests every DeviceStore must pass, so the stores in storage.py stay interchangeable.
+Each test runs against the memory store and against the Redis store on fakeredis.
+
+The expiry test waits for devices to time out, so a full run takes a few seconds.
+"""
+import hashlib
+import threading
+import time
+import pytest
+from helper_functions.storage import MemoryDeviceStore, RedisDeviceStore
+from helper_functions.time_helper import get_current_epoch_time
+
+DEVICE_TIMEOUT_SECONDS = 300
+SHORT_DEVICE_TIMEOUT_SECONDS = 1 # Used by the expiry test, which waits for devices to time out
+
+@pytest.fixture(params=['memory', 'redis'])
+def make_store(request):
+    # Function taking a device timeout in seconds and returning an empty store
+    if request.param == 'memory':
+        return MemoryDeviceStore
+    redis_client = request.getfixturevalue('redis_client')
+    return lambda device_timeout_seconds: RedisDeviceStore(redis_client, device_timeout_seconds)
+
+def rickroll():
+    return {'command': 'rickroll', 'params': {}}
+
+def led_color(color):
+    return {'command': 'change_led_color', 'params': {'color': color}}
+
+def test_insert_and_get(make_store):
+    store = make_store(DEVICE_TIMEOUT_SECONDS)
+    status, message, raw_password = store.insert_device('10.0.0.1')
+    assert status and raw_password, f"insert_device failed: {message}"
+    device_data = store.get_device_data('10.0.0.1')
+    assert device_data['raw_password'] == raw_password, "raw_password not stored"
+    assert device_data['password'] == hashlib.md5(raw_password.encode()).hexdigest(), "password is not the MD5 of raw_password"
+    assert abs(device_data['last_seen'] - get_current_epoch_time()) <= 1, "last_seen is not the current time"
+    assert store.get_device_data('10.0.0.2') is None, "unknown device found"
+    assert store.get_password_hash('10.0.0.1') == device_data['password'], "get_password_hash disagrees with get_device_data"
+    assert store.get_device_password_hashes(['10.0.0.1', '10.0.0.2']) == {'10.0.0.1': device_data['password'], '10.0.0.2': None}, "get_device_password_hashes is wrong"
+
+def test_insert_replaces_device(make_store):
+    store = make_store(DEVICE_TIMEOUT_SECONDS)
+    store.insert_device('10.0.0.1')
+    store.queue_device_command('10.0.0.1', rickroll())
+    store.poll_device('10.0.0.1')
+    assert store.get_device_data('10.0.0.1').get('last_hacked_time'), "poll delivering a command didn't set last_hacked_time"
+    store.invalidate_password_hash('10.0.0.1')
+    status, message, raw_password = store.insert_device('10.0.0.1')
+    device_data = store.get_device_data('10.0.0.1')
+    assert device_data['raw_password'] == raw_password, "reinserted device kept its old password"
+    assert device_data.get('last_hacked_time') is None, "reinserted device kept its last_hacked_time"
+    devices, total = store.list_devices(sort_by='last_hacked_time')
+    assert total == 0, "reinserted device still listed as hacked"
+
+def test_update_last_seen(make_store):
+    store = make_store(DEVICE_TIMEOUT_SECONDS)
+    store.insert_device('10.0.0.1')
+    status, message = store.update_last_seen('10.0.0.1')
+    assert status, f"update_last_seen failed: {message}"
+    status, message = store.update_last_seen('10.0.0.2')
+    assert not status, "update_last_seen created an unknown device"
+    assert store.get_device_data('10.0.0.2') is None, "update_last_seen created an unknown device"
+
+def test_update_password(make_store):
+    store = make_store(DEVICE_TIMEOUT_SECONDS)
+    store.insert_device('10.0.0.1')
+    store.insert_device('10.0.0.2')
+    status, message, hashed_password = store.update_password('10.0.0.1', 'hunter2')
+    assert status and hashed_password == hashlib.md5(b'hunter2').hexdigest(), f"update_password failed: {message}"
+    store.invalidate_password_hash('10.0.0.1')
+    assert store.get_password_hash('10.0.0.1') == hashed_password, "new password hash not stored"
+    assert store.get_device_data('10.0.0.1')['raw_password'] == 'hunter2', "new raw_password not stored"
+    status, message, hashed_password = store.update_password('10.0.0.9', 'hunter2')
+    assert not status and hashed_password is None, "update_password succeeded on an unknown device"
+    results = store.update_device_passwords(['10.0.0.1', '10.0.0.2', '10.0.0.9'], 'letmein')
+    assert results['10.0.0.1'][0] and results['10.0.0.2'][0] and not results['10.0.0.9'][0], f"update_device_passwords is wrong: {results}"
+    assert store.get_device_data('10.0.0.2')['raw_password'] == 'letmein', "bulk password not stored"
+
+def test_queue_and_poll(make_store):
+    store = make_store(DEVICE_TIMEOUT_SECONDS)
+    store.insert_device('10.0.0.1')
+    for color in ('#FF0000', '#00FF00', '#0000FF'):
+        status, message = store.queue_device_command('10.0.0.1', led_color(color))
+        assert status, f"queue_device_command failed: {message}"
+    status, message, commands = store.poll_device('10.0.0.1', 2)
+    assert status and commands == [led_color('#FF0000'), led_color('#00FF00')], f"first batch is wrong: {commands}"
+    status, message, commands = store.poll_device('10.0.0.1', 2)
+    assert commands == [led_color('#0000FF')], f"second batch is wrong: {commands}"
+    status, message, commands = store.poll_device('10.0.0.1')
+    assert status and commands == [], f"drained queue still has commands: {commands}"
+    status, message, commands = store.poll_device('10.0.0.9')
+    assert not status and message == "Device not found" and commands == [], "poll of an unknown device succeeded"
+
+def test_queue_limits(make_store):
+    store = make_store(DEVICE_TIMEOUT_SECONDS)
+    store.insert_device('10.0.0.1')
+    store.queue_device_command('10.0.0.1', rickroll(), max_queued_commands=2)
+    store.queue_device_command('10.0.0.1', rickroll(), max_queued_commands=2)
+    status, message = store.queue_device_command('10.0.0.1', rickroll(), max_queued_commands=2)
+    assert not status and message == "Command queue full", f"full queue accepted a command: {message}"
+    # Coalescing replaces the queued command of the same type, so a full queue of it has room again
+    status, message = store.queue_device_command('10.0.0.1', rickroll(), max_queued_commands=2, coalesce=True)
+    assert status, f"coalesced command rejected: {message}"
+    store.queue_device_command('10.0.0.1', led_color('#FF0000'), coalesce=True)
+    store.queue_device_command('10.0.0.1', led_color('#0000FF'), coalesce=True)
+    status, message, commands = store.poll_device('10.0.0.1', 10)
+    assert commands == [rickroll(), led_color('#0000FF')], f"coalesced queue is wrong: {commands}"
+
+def test_queue_password_hash(make_store):
+    store = make_store(DEVICE_TIMEOUT_SECONDS)
+    store.insert_device('10.0.0.1')
+    password_hash = store.get_password_hash('10.0.0.1')
+    status, message = store.queue_device_command('10.0.0.1', rickroll(), password_hash='0' * 32)
+    assert not status and message == "Invalid password", f"stale password hash accepted: {message}"
+    status, message = store.queue_device_command('10.0.0.9', rickroll(), password_hash='0' * 32)
+    assert not status and message == "Device not found", f"unknown device accepted: {message}"
+    status, message = store.queue_device_command('10.0.0.1', rickroll(), password_hash=password_hash)
+    assert status, f"current password hash rejected: {message}"
+    results = store.queue_device_commands(['10.0.0.1', '10.0.0.9'], rickroll(), password_hashes={'10.0.0.1': password_hash, '10.0.0.9': '0' * 32})
+    assert results == {'10.0.0.1': (True, "Good"), '10.0.0.9': (False, "Device not found")}, f"queue_device_commands is wrong: {results}"
+    status, message, commands = store.poll_device('10.0.0.1', 10)
+    assert len(commands) == 2, f"expected 2 queued commands, got {commands}"
+
+def test_wait_for_command(make_store):
+    store = make_store(DEVICE_TIMEOUT_SECONDS)
+    store.insert_device('10.0.0.1')
+    start = time.monotonic()
+    assert not store.wait_for_device_command('10.0.0.1', 1), "wait returned a command from an empty queue"
+    assert time.monotonic() - start >= 0.9, "wait returned before it timed out"
+    store.queue_device_command('10.0.0.1', rickroll())
+    start = time.monotonic()
+    assert store.wait_for_device_command('10.0.0.1', 1), "wait missed a command queued before it"
+    assert time.monotonic() - start < 0.5, "wait didn't return at once for a queued command"
+    store.poll_device('10.0.0.1')
+    timer = threading.Timer(0.2, store.queue_device_command, ('10.0.0.1', rickroll()))
+    timer.start()
+    start = time.monotonic()
+    assert store.wait_for_device_command('10.0.0.1', 5), "wait missed a command queued while waiting"
+    assert time.monotonic() - start < 2, "wait wasn't woken by the queued command"
+    timer.join()
+
+def test_list_devices(make_store):
+    store = make_store(DEVICE_TIMEOUT_SECONDS)
+    device_ips = [f"10.0.0.{i}" for i in range(1, 8)]
+    for device_ip in device_ips:
+        store.insert_device(device_ip)
+    # Devices inserted in the same second are ordered by IP address, most recent first like a sorted set
+    devices, total = store.list_devices(page=1, per_page=3)
+    assert total == 7, f"total is {total}"
+    assert [device['ip_address'] for device in devices] == ['10.0.0.7', '10.0.0.6', '10.0.0.5'], f"first page is wrong: {devices}"
+    devices, total = store.list_devices(page=3, per_page=3)
+    assert [device['ip_address'] for device in devices] == ['10.0.0.1'], f"last page is wrong: {devices}"
+    assert set(devices[0]) == {'ip_address', 'password_hash', 'last_seen', 'last_hacked_time'}, f"device fields are wrong: {devices[0]}"
+    assert devices[0]['password_hash'] == store.get_password_hash('10.0.0.1'), "listed password hash is wrong"
+    store.queue_device_command('10.0.0.3', rickroll())
+    store.poll_device('10.0.0.3')
+    devices, total = store.list_devices(sort_by='last_hacked_time')
+    assert total == 1 and devices[0]['ip_address'] == '10.0.0.3' and devices[0]['last_hacked_time'], f"hacked devices are wrong: {devices}"
+
+def test_remove_device(make_store):
+    store = make_store(DEVICE_TIMEOUT_SECONDS)
+    store.insert_device('10.0.0.1')
+    status, message = store.remove_device('10.0.0.1')
+    assert status, f"remove_device failed: {message}"
+    assert store.get_device_data('10.0.0.1') is None, "removed device still found"
+    assert store.list_devices()[1] == 0, "removed device still listed"
+    status, message = store.remove_device('10.0.0.1')
+    assert not status, "removing an unknown device succeeded"
+
+def test_fleet_stats(make_store):
+    store = make_store(DEVICE_TIMEOUT_SECONDS)
+    for i in range(1, 4):
+        store.insert_device(f"10.0.0.{i}")
+    store.queue_device_command('10.0.0.1', rickroll())
+    store.poll_device('10.0.0.1')
+    store.queue_device_command('10.0.0.2', rickroll())
+    store.queue_device_command('10.0.0.2', led_color('#FF0000'))
+    assert store.get_fleet_stats() == (3, 1, 2), f"fleet stats are {store.get_fleet_stats()}"
+
+def test_hack_events(make_store):
+    store = make_store(DEVICE_TIMEOUT_SECONDS)
+    for i in range(1, 4):
+        store.insert_device(f"10.0.0.{i}")
+    store.queue_device_command('10.0.0.1', {**rickroll(), 'source_ip': '192.0.2.1'})
+    store.queue_device_command('10.0.0.1', {**led_color('#FF0000'), 'source_ip': '192.0.2.2'})
+    store.queue_device_command('10.0.0.2', {**rickroll(), 'source_ip': '192.0.2.1'})
+    store.queue_device_command('10.0.0.3', rickroll())
+    for i in range(1, 4):
+        store.poll_device(f"10.0.0.{i}", 10)
+    assert store.read_hack_events('0', 10)[0][0]['source_ip'] == '192.0.2.1', "source_ip not recorded"
+    events, cursor = store.read_hack_events('0', 3)
+    assert [(event['ip_address'], event['command']) for event in events] == [('10.0.0.1', 'rickroll'), ('10.0.0.1', 'change_led_color'), ('10.0.0.2', 'rickroll')], f"first events are wrong: {events}"
+    assert cursor == events[-1]['id'] and set(events[0]) == {'id', 'ip_address', 'command', 'source_ip', 'time'}, f"event fields or cursor are wrong: {events[0]}, {cursor}"
+    events, cursor = store.read_hack_events(cursor, 3)
+    assert len(events) == 1 and events[0]['ip_address'] == '10.0.0.3' and events[0]['source_ip'] is None, f"events after the cursor are wrong: {events}"
+    assert store.read_hack_events(cursor, 3) == ([], cursor), "events read past the end of the stream"
+    leaderboards = store.get_leaderboards(2)
+    assert leaderboards['hacked_devices'] == [{'ip_address': '10.0.0.1', 'hacks': 2}, {'ip_address': '10.0.0.3', 'hacks': 1}], f"hacked devices leaderboard is wrong: {leaderboards}"
+    assert leaderboards['hackers'] == [{'ip_address': '192.0.2.1', 'hacks': 2}, {'ip_address': '192.0.2.2', 'hacks': 1}], f"hackers leaderboard is wrong: {leaderboards}"
+
+def test_rate_limit(make_store):
+    store = make_store(DEVICE_TIMEOUT_SECONDS)
+    assert store.check_rate_limit([]) == (True, 0), "no buckets was limited"
+    buckets = [('rate_limit:source:192.0.2.1', 2, 0.5, 1), ('rate_limit:device:10.0.0.1', 10, 10, 1)]
+    assert store.check_rate_limit(buckets) == (True, 0), "first request limited"
+    assert store.check_rate_limit(buckets) == (True, 0), "second request within the burst limited"
+    status, retry_after = store.check_rate_limit(buckets)
+    assert not status and retry_after == 2, f"request over the burst allowed, or wrong retry_after {retry_after}"
+    # A rejected request takes no tokens, so the device bucket still has room for another source
+    assert store.check_rate_limit([('rate_limit:source:192.0.2.2', 2, 0.5, 1), ('rate_limit:device:10.0.0.1', 10, 10, 1)])[0], "rejected request took tokens"
+    # A bulk request pays for each of its targets, and is turned away whole if the bucket is short
+    bulk_buckets = [('rate_limit:source:192.0.2.3', 5, 1, 3)]
+    assert store.check_rate_limit(bulk_buckets) == (True, 0), "bulk request within the burst limited"
+    status, retry_after = store.check_rate_limit(bulk_buckets)
+    assert not status and retry_after == 1, f"bulk request over the remaining tokens allowed, or wrong retry_after {retry_after}"
+    assert store.check_rate_limit([('rate_limit:source:192.0.2.3', 5, 1, 2)])[0], "rejected bulk request took tokens"
+
+def test_device_expiry(make_store):
+    store = make_store(SHORT_DEVICE_TIMEOUT_SECONDS)
+    store.insert_device('10.0.0.1')
+    store.insert_device('10.0.0.2')
+    store.queue_device_command('10.0.0.1', rickroll())
+    time.sleep(SHORT_DEVICE_TIMEOUT_SECONDS + 1.1)
+    store.insert_device('10.0.0.3')
+    assert store.get_device_data('10.0.0.1') is None, "expired device still found"
+    assert store.get_password_hash('10.0.0.2') is None, "expired device password still found"
+    assert not store.poll_device('10.0.0.2')[0], "expired device polled"
+    devices, total = store.list_devices()
+    assert total == 1 and devices[0]['ip_address'] == '10.0.0.3', f"expired devices still listed: {devices}"
+    assert store.get_fleet_stats() == (1, 0, 0), f"expired devices counted: {store.get_fleet_stats()}"
@@ -0,0 +1,33 @@
+import pytest
+from helper_functions.commands import MAX_STRING_FIELD_BYTES, build_command
+from helper_functions.wire_format import MAX_BINARY_BATCH_SIZE, MAX_MESSAGE_BYTES, encode_commands, encode_string
+
+def test_long_password_is_rejected(client, insert_devices):
+    device_ip, password = next(iter(insert_devices(['10.0.3.1']).items()))
+    response = client.post('/control_device', data={'ip_address': device_ip, 'password': password, 'control_type': 'change_password', 'new_password': 'x' * (MAX_STRING_FIELD_BYTES + 1)})
+    assert response.status_code == 400
+    # The device keeps its password
+    response = client.post('/control_device', data={'ip_address': device_ip, 'password': password, 'control_type': 'rickroll'})
+    assert response.status_code == 200
+
+def test_encode_string_does_not_truncate():
+    assert encode_string('a' * 255)[0] == 255
+    with pytest.raises(ValueError):
+        encode_string('a' * 256)
+
+def test_longest_binary_batch_fits_the_firmware_buffer():
+    status, message, command_data = build_command('change_password', {'new_password': 'é' * (MAX_STRING_FIELD_BYTES // 2)})
+    assert status, message
+    assert len(encode_commands([command_data] * MAX_BINARY_BATCH_SIZE)) <= MAX_MESSAGE_BYTES
+
+def test_binary_poll_pops_only_what_fits(client, app, insert_devices):
+    import app as app_module
+    device_ip = '10.0.3.2'
+    insert_devices([device_ip])
+    status, message, command_data = build_command('change_password', {'new_password': 'p' * MAX_STRING_FIELD_BYTES})
+    for i in range(MAX_BINARY_BATCH_SIZE + 1):
+        app_module.device_store.queue_device_command(device_ip, command_data, MAX_BINARY_BATCH_SIZE + 1)
+    response = client.get(f'/poll_commands?format=bin&batch={MAX_BINARY_BATCH_SIZE + 1}', environ_base={'REMOTE_ADDR': device_ip})
+    assert response.status_code == 200
+    assert len(response.data) <= MAX_MESSAGE_BYTES
+    assert response.data[1] == min(app_module.MAX_POLL_BATCH_SIZE, MAX_BINARY_BATCH_SIZE)
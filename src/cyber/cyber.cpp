@@ -9,8 +9,19 @@ boolean display_password = false;
 String ip_address = "";
 String app_password = "";
 // Following used for polling
-unsigned long previousMillis = 0;    // Store the last time the poll was done
-const long interval = 2000;          // Interval at which to poll (milliseconds)
+const int LONG_POLL_WAIT = 25;       // Seconds the server holds a poll open waiting for a command
+const int POLL_BATCH_SIZE = 5;       // Most commands the server sends in one poll response
+const long POLL_RETRY_DELAY = 2000;  // Time to wait before polling again after an error (milliseconds)
+QueueHandle_t commandQueue;          // Poll responses waiting to be handled by the main loop
+// Following used for the compact binary format of the server responses
+const size_t MAX_RESPONSE_SIZE = 1024;
+const uint8_t MESSAGE_COMMANDS = 1;
+const uint8_t MESSAGE_CREDENTIALS = 2;
+const uint8_t COMMAND_CHANGE_LED_COLOR = 1;
+const uint8_t COMMAND_CHANGE_PASSWORD = 2;
+const uint8_t COMMAND_DISPLAY_PASSWORD = 3;
+const uint8_t COMMAND_HIDE_PASSWORD = 4;
+const uint8_t COMMAND_RICKROLL = 5;
 
 
 void cyber_init() {
@@ -21,15 +32,15 @@ void cyber_init() {
     cyber_credentials_init(); // Get IP address from the server
     display_text("Starting LEDs...");
     cyber_color_init(); // Start up the LEDs
+    cyber_poll_init(); // Start polling for commands in the background
 }
 
 void cyber_loop() {
-    unsigned long currentMillis = millis();
-    // Wait for 1 second to poll for commands
-    if (currentMillis - previousMillis >= interval) {
-        // Save the last time the poll was done
-        previousMillis = currentMillis;
-    pollForCommands(); // Poll for commands from the server
+    // Handle any commands received by the poll task
+    PollResponse response;
+    while (xQueueReceive(commandQueue, &response, 0) == pdTRUE) {
+        handleResponse(response.data, response.length);
+        free(response.data);
     }
     // Loop the rest as normal
     screen_loop(ip_address, app_password, display_password); // Display the IP address and password
@@ -66,20 +77,23 @@ void cyber_color_init() {
     all_leds_set_color(255, 255, 255);
 }
 
+void cyber_poll_init() {
+    // Long polls block until a command arrives, so run them in their own task to keep the screen and speaker running
+    commandQueue = xQueueCreate(10, sizeof(PollResponse));
+    xTaskCreatePinnedToCore(pollTask, "pollTask", 8192, NULL, 1, NULL, 0);
+}
+
 void getCredentials() {
     printf("Getting credentials from the server\n");
     HTTPClient http;
-    http.begin(serverUrl + "/get_credentials");
+    http.begin(serverUrl + "/get_credentials?format=bin");
     int attempts = 0;
+    uint8_t response[MAX_RESPONSE_SIZE];
     while (true) {
         int httpResponseCode = http.GET();
         if (httpResponseCode > 0) {
-            String payload = http.getString();
-            DynamicJsonDocument doc(1024);
-            deserializeJson(doc, payload);
-            if (doc.containsKey("ip_address") && doc.containsKey("password")) {
-                ip_address = String(doc["ip_address"].as<const char*>());
-                app_password = String(doc["password"].as<const char*>());
+            size_t length = readResponse(http, response, sizeof(response));
+            if (length > 0 && response[0] == MESSAGE_CREDENTIALS && readCredentials(response, length)) {
                 printf("IP Address: %s\n", ip_address.c_str());
                 printf("App password: %s\n", app_password.c_str());
                 break; // Exit the loop if successful
@@ -102,57 +116,148 @@ void getCredentials() {
     http.end();
 }
 
-void pollForCommands() {
+void pollTask(void *parameter) {
+    while (true) {
+        // Hand each response over to the main loop, which owns the LEDs, screen and speaker
+        if (!pollForCommands()) {
+            delay(POLL_RETRY_DELAY); // Back off before retrying a failed poll
+        }
+    }
+}
+
+bool pollForCommands() {
     HTTPClient http;
-    http.begin(serverUrl + "/poll_commands");
+    // Ask the server to hold the request open until a command arrives
+    http.begin(serverUrl + "/poll_commands?format=bin&wait=" + String(LONG_POLL_WAIT) + "&batch=" + String(POLL_BATCH_SIZE));
+    http.setTimeout((LONG_POLL_WAIT + 5) * 1000);
 
+    bool success = false;
     int httpResponseCode = http.GET();
     if (httpResponseCode == 200) {
-        String response = http.getString();
-        // Process the received commands
-        DynamicJsonDocument doc(1024);
-        deserializeJson(doc, response);
-        String command = doc["command"].as<String>();
-        printf("Received command: %s\n", command.c_str());
-        // Check the command and respond accordingly
-        if (command == "change_led_color") {
-            int r = doc["r"].as<int>();
-            int g = doc["g"].as<int>();
-            int b = doc["b"].as<int>();
-            printf("Changing LED color to (%d, %d, %d)\n", r, g, b);
-            // Implement your LED color change logic here
-            all_leds_set_color(r, g, b);
-        }
-        else if (command == "change_password") {
-            String new_password = doc["new_password"].as<String>();
-            printf("Changing password to %s\n", new_password.c_str());
-            // Implement your password change logic here
-            app_password = new_password;
+        PollResponse response;
+        response.data = (uint8_t *)malloc(MAX_RESPONSE_SIZE);
+        response.length = response.data == NULL ? 0 : readResponse(http, response.data, MAX_RESPONSE_SIZE);
+        if (response.length == 0 || xQueueSend(commandQueue, &response, 0) != pdTRUE) {
+            printf("Could not queue poll response, dropping it\n");
+            free(response.data);
         }
-        else if (command == "display_password") {
-            display_password = true;
-            Serial.println("Display password set to true.");
+        success = true;
+    }
+    else {
+        printf("Error polling: HTTP request failed with error code %d\n", httpResponseCode);
+    }
+    // End http connection
+    http.end();
+    return success;
+}
+
+size_t readResponse(HTTPClient &http, uint8_t *buffer, size_t size) {
+    // Read the whole binary response body into the buffer
+    int length = http.getSize();
+    if (length <= 0 || (size_t)length > size) {
+        printf("Unexpected response size: %d\n", length);
+        return 0;
+    }
+    return http.getStreamPtr()->readBytes(buffer, length);
+}
+
+bool readString(const uint8_t *data, size_t length, size_t &position, String &value) {
+    // Strings are a length byte followed by that many bytes
+    if (position >= length) {
+        return false;
+    }
+    size_t stringLength = data[position++];
+    if (position + stringLength > length) {
+        return false;
+    }
+    value = "";
+    value.reserve(stringLength);
+    for (size_t i = 0; i < stringLength; i++) {
+        value += (char)data[position + i];
+    }
+    position += stringLength;
+    return true;
+}
+
+bool readCredentials(const uint8_t *data, size_t length) {
+    // Credentials are the IP address followed by the password
+    size_t position = 1;
+    String new_ip_address, new_password;
+    if (!readString(data, length, position, new_ip_address) || !readString(data, length, position, new_password)) {
+        return false;
+    }
+    ip_address = new_ip_address;
+    app_password = new_password;
+    return true;
+}
+
+void handleResponse(const uint8_t *data, size_t length) {
+    // The server reissues credentials if the device timed out
+    if (data[0] == MESSAGE_CREDENTIALS) {
+        if (readCredentials(data, length)) {
+            printf("Credentials reissued, new password: %s\n", app_password.c_str());
         }
-        else if (command == "hide_password") {
-            display_password = false;
-            Serial.println("Display password set to false.");
+        return;
+    }
+    if (data[0] != MESSAGE_COMMANDS || length < 2) {
+        printf("Unknown response type: %d\n", data[0]);
+        return;
+    }
+    // Process the received commands in the order they were sent
+    uint8_t count = data[1];
+    size_t position = 2;
+    for (uint8_t i = 0; i < count && position < length; i++) {
+        if (!applyCommand(data, length, position)) {
+            return; // The rest of the message can't be read without knowing this command's size
         }
-        else if (command == "rickroll") {
-            // Implement your rickroll logic here
-            printf("RickRolling...\n");
-            // Play sound
-            YAudio::stop_speaker();
-            YAudio::play_sound_file(RICKROLL_FILENAME);
+    }
+}
+
+bool applyCommand(const uint8_t *data, size_t length, size_t &position) {
+    uint8_t command = data[position++];
+    printf("Received command: %d\n", command);
+    // Check the command and respond accordingly
+    if (command == COMMAND_CHANGE_LED_COLOR) {
+        if (position + 3 > length) {
+            return false;
         }
-        else {
-            printf("Unknown command: %s\n", command.c_str());
+        int r = data[position];
+        int g = data[position + 1];
+        int b = data[position + 2];
+        position += 3;
+        printf("Changing LED color to (%d, %d, %d)\n", r, g, b);
+        // Implement your LED color change logic here
+        all_leds_set_color(r, g, b);
+    }
+    else if (command == COMMAND_CHANGE_PASSWORD) {
+        String new_password;
+        if (!readString(data, length, position, new_password)) {
+            return false;
         }
+        printf("Changing password to %s\n", new_password.c_str());
+        // Implement your password change logic here
+        app_password = new_password;
+    }
+    else if (command == COMMAND_DISPLAY_PASSWORD) {
+        display_password = true;
+        Serial.println("Display password set to true.");
+    }
+    else if (command == COMMAND_HIDE_PASSWORD) {
+        display_password = false;
+        Serial.println("Display password set to false.");
+    }
+    else if (command == COMMAND_RICKROLL) {
+        // Implement your rickroll logic here
+        printf("RickRolling...\n");
+        // Play sound
+        YAudio::stop_speaker();
+        YAudio::play_sound_file(RICKROLL_FILENAME);
     }
     else {
-        printf("Error polling: HTTP request failed with error code %d\n", httpResponseCode);
+        printf("Unknown command: %d\n", command);
+        return false;
     }
-    // End http connection
-    http.end();
+    return true;
 }
 
 // Tell the server that the command was executed
@@ -9,13 +9,26 @@
 #include "yaudio.h"
 #include "yboard.h"
 
+// Response from the server waiting to be handled by the main loop
+struct PollResponse {
+    uint8_t *data;
+    size_t length;
+};
+
 void cyber_init();
 void cyber_loop();
 void cyber_credentials_init();
 void cyber_wifi_init();
 void cyber_color_init();
+void cyber_poll_init();
 void getCredentials();
-void pollForCommands();
+void pollTask(void *parameter);
+bool pollForCommands();
+size_t readResponse(HTTPClient &http, uint8_t *buffer, size_t size);
+bool readString(const uint8_t *data, size_t length, size_t &position, String &value);
+bool readCredentials(const uint8_t *data, size_t length);
+void handleResponse(const uint8_t *data, size_t length);
+bool applyCommand(const uint8_t *data, size_t length, size_t &position);
 void confirmCommandExecuted(String command);
 
 
@@ -4,7 +4,41 @@
 const char* ssid = "";
 const char* password =  "";
 const char* serverUrl = "http://{{YOUR_URL_HERE}}/";
-int knobVal;
+// Readings are streamed over one Socket.IO connection to the wifi-server
+const char* serverHost = "{{YOUR_HOST_HERE}}";
+const uint16_t serverPort = 5000;
+const char* badgeNamespace = "/badge";
+// Shortest time between two frames, so a turning knob doesn't flood the connection
+const unsigned long sendIntervalMs = 20;
+
+SocketIOclient socketIO;
+bool namespaceConnected = false;
+// Last readings sent, or -1 to send them again
+int knobVal = -1;
+int buttonVal = -1;
+int switchVal = -1;
+unsigned long lastSendMs = 0;
+
+void socket_event(socketIOmessageType_t type, uint8_t* payload, size_t length) {
+    switch (type) {
+        case sIOtype_CONNECT:
+            if (length > 0 && strncmp((char*)payload, badgeNamespace, strlen(badgeNamespace)) == 0) {
+                // The server accepted the badge namespace, so send every reading again
+                namespaceConnected = true;
+                knobVal = buttonVal = switchVal = -1;
+            } else {
+                // The connection is up, join the badge namespace
+                socketIO.send(sIOtype_CONNECT, badgeNamespace);
+            }
+            break;
+        case sIOtype_DISCONNECT:
+            namespaceConnected = false;
+            break;
+        default:
+            break;
+    }
+}
+
 void wifi_init() {
     pinMode(BUTTON2_PIN, INPUT);
     pinMode(SWITCH1_PIN, INPUT);
@@ -17,10 +51,12 @@ void wifi_init() {
         printf("Connecting to WiFi..\n");
     }
     printf("Connected to the WiFi network\n");
-    knobVal = knob_get();
-    
+
+    socketIO.onEvent(socket_event);
+    socketIO.begin(serverHost, serverPort, "/socket.io/?EIO=4");
 }
 
+// Post one reading to the wifi-server's HTTP routes, for servers without the socket
 void send_data(String jsonData, String endpoint) {
     HTTPClient http;
     String fullUrl = serverUrl + endpoint;
@@ -30,58 +66,44 @@ void send_data(String jsonData, String endpoint) {
     http.end();
 }
 
+// Send the readings that changed as one frame, e.g. /badge,["r",{"k":42,"s":3,"b":0}] where b is the
+// pressed button (0 for none), s the switches as a bit mask and k the knob percentage
 void send_button_info() {
-    if (knobVal != knob_get()) {
-        String jsonData = "{\"data\":\"Knob at " + String(knob_get()) + "%\"}";
-        send_data(jsonData, "knob");
-        knobVal = knob_get();
+    socketIO.loop();
+    if (!namespaceConnected || millis() - lastSendMs < sendIntervalMs) {
+        return;
     }
 
-    bool pressed = false;
-    static int buttonState = 0;
+    int knob = knob_get();
+    int button = 0;
     for (int i = 1; i <= 3; i++) {
         if (buttons_get(i)) {
-            pressed = true;
-            String jsonData = "{\"data\":\"Button " + String(i) + " pressed\"}";
-            send_data(jsonData,"button");
-            buttonState = i;
-            while(buttons_get(i)) {}
+            button = i;
+            break;
         }
     }
-    if (!pressed && buttonState != 0) {
-        String jsonData = "{\"data\":\"Nothing pressed\"}";
-        send_data(jsonData,"button");
-        buttonState = 0;
-    }
-
-
-    static int switchState = 0;
+    int switches = (switches_get(1) ? 1 : 0) | (switches_get(2) ? 2 : 0);
 
-    if (switches_get(1) && switches_get(2)) {
-        if (switchState != 3) {
-            String jsonData = "{\"data\":\"Both switches on\"}";
-            send_data(jsonData, "switch");
-            switchState = 3;
-        }
-    } else if (switches_get(2)) {
-        if (switchState != 2) {
-            String jsonData = "{\"data\":\"Switch 2 on\"}";
-            send_data(jsonData, "switch");
-            switchState = 2;
-        }
-    } else if (switches_get(1)) {
-        if (switchState != 1) {
-            String jsonData = "{\"data\":\"Switch 1 on\"}";
-            send_data(jsonData, "switch");
-            switchState = 1;
-        }
-    } else {
-        if (switchState != 0) {
-            String jsonData = "{\"data\":\"Both switches off\"}";
-            send_data(jsonData, "switch");
-            switchState = 0;
-        }
+    String readings = "";
+    if (knob != knobVal) {
+        readings += ",\"k\":" + String(knob);
+    }
+    if (button != buttonVal) {
+        readings += ",\"b\":" + String(button);
+    }
+    if (switches != switchVal) {
+        readings += ",\"s\":" + String(switches);
+    }
+    if (readings.length() == 0) {
+        return;
     }
 
+    // Drop the leading comma
+    String frame = String(badgeNamespace) + ",[\"r\",{" + readings.substring(1) + "}]";
+    if (socketIO.sendEVENT(frame)) {
+        knobVal = knob;
+        buttonVal = button;
+        switchVal = switches;
+        lastSendMs = millis();
+    }
 }
-
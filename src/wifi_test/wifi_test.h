@@ -2,6 +2,7 @@
 #define WIFI_TEST_H
 #include "HTTPClient.h"
 #include <WiFi.h>
+#include <SocketIOclient.h>
 
 
 
@@ -12,4 +13,3 @@ void send_button_info();
 
 
 #endif 
-
@@ -1,11 +1,117 @@
-from flask import Flask, request, send_from_directory
-from flask_socketio import SocketIO
+from flask import Flask, jsonify, request, send_from_directory
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_cors import CORS
+from telemetry_history import CHANNELS, TelemetryHistory
+import collections
+import math
 import os
+import re
+import threading
+import time
 
 app = Flask(__name__)
 CORS(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Every badge and browser holds a socket open, so serve them from green threads. Flask-SocketIO picks
+# eventlet or gevent when installed (see requirements.txt), or SOCKETIO_ASYNC_MODE chooses one.
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=os.environ.get('SOCKETIO_ASYNC_MODE') or None)
+
+# Most batched updates sent to the browsers each second. Only the latest value of each channel is kept
+# between updates, so a knob turning sends at most this many updates however fast the badge posts.
+TELEMETRY_FLUSH_HZ = float(os.environ.get('TELEMETRY_FLUSH_HZ', 30))
+
+# Recent samples of every device, with memory bounded by the number of samples and devices kept
+TELEMETRY_HISTORY_SAMPLES = int(os.environ.get('TELEMETRY_HISTORY_SAMPLES', 8192)) # Samples kept for each channel of a device
+TELEMETRY_HISTORY_DEVICES = int(os.environ.get('TELEMETRY_HISTORY_DEVICES', 100)) # Devices kept, dropping the one updated longest ago
+MAX_HISTORY_SECONDS = 24 * 60 * 60 # Longest window /history returns
+MAX_HISTORY_BUCKETS = 1000 # Most buckets /history returns for each channel
+telemetry_history = TelemetryHistory(TELEMETRY_HISTORY_SAMPLES, TELEMETRY_HISTORY_DEVICES)
+
+# Browsers subscribe to the badges they show, each badge having its own room, so a reading is only
+# written to the sockets interested in it. Instructors can join one room getting every badge instead.
+INSTRUCTOR_ROOM = 'instructors'
+INSTRUCTOR_KEY = os.environ.get('INSTRUCTOR_KEY') # Needed to join the instructor room when set
+MAX_SUBSCRIPTIONS = int(os.environ.get('MAX_SUBSCRIPTIONS', 10)) # Most badges one browser subscribes to
+
+# Latest value of each channel of each badge not yet sent to the browsers, and of every channel so far,
+# e.g. {"10.0.0.5": {"knob": "Knob at 42%"}}
+pending_data = {}
+latest_data = {}
+# Badges each browser subscribed to, how many browsers subscribed to each badge, and the instructors
+subscriptions = {}
+device_watchers = collections.Counter()
+instructors = set()
+pending_lock = threading.Lock()
+flush_task = None
+
+def device_room(device):
+    # Room of the browsers subscribed to a badge
+    return f'device:{device}'
+
+def unwatch_devices(devices):
+    # Count one browser fewer watching each badge. Call with pending_lock held.
+    for device in devices:
+        device_watchers[device] -= 1
+        if device_watchers[device] <= 0:
+            del device_watchers[device]
+
+def flush_telemetry():
+    # Send the latest value of every channel that changed as one 'updateData' event to the room of each
+    # badge, e.g. {"10.0.0.5": {"knob": "Knob at 42%"}}, and all of them as one event to the instructors
+    while True:
+        socketio.sleep(1 / TELEMETRY_FLUSH_HZ)
+        with pending_lock:
+            if not pending_data:
+                continue
+            batch = dict(pending_data)
+            pending_data.clear()
+            watched = [device for device in batch if device_watchers[device]]
+            send_to_instructors = bool(instructors)
+        for device in watched:
+            socketio.emit('updateData', {device: batch[device]}, to=device_room(device))
+        if send_to_instructors:
+            socketio.emit('updateData', batch, to=INSTRUCTOR_ROOM)
+
+def queue_telemetry(device, channel, data):
+    global flush_task
+    with pending_lock:
+        latest_data.setdefault(device, {})[channel] = data
+        # Readings of a badge no one is watching are only kept as its latest values
+        if not device_watchers[device] and not instructors:
+            return
+        pending_data.setdefault(device, {})[channel] = data
+        if flush_task is None:
+            flush_task = socketio.start_background_task(flush_telemetry)
+
+# Readings sent by the badges over their socket, as one-letter keys mapped to a function formatting the
+# value for the browsers the same way the HTTP routes receive it, or returning None for an invalid value
+SWITCH_STATES = {0: "Both switches off", 1: "Switch 1 on", 2: "Switch 2 on", 3: "Both switches on"}
+SWITCH_VALUES = {state: value for value, state in SWITCH_STATES.items()}
+BADGE_READINGS = {
+    'b': ('button', lambda value: (f"Button {value} pressed" if value else "Nothing pressed") if 0 <= value <= 3 else None),
+    's': ('switch', SWITCH_STATES.get),
+    'k': ('knob', lambda value: f"Knob at {value}%" if 0 <= value <= 100 else None),
+}
+
+def parse_posted_reading(channel, data):
+    # Numeric value of a reading posted as text to the HTTP routes, or None if it isn't recognised
+    if channel == 'switch':
+        return SWITCH_VALUES.get(data)
+    if channel == 'button' and data == "Nothing pressed":
+        return 0
+    match = re.search(r'\d+', str(data))
+    return int(match.group()) if match else None
+
+def receive_telemetry(channel, received_message):
+    # Queue the data posted by the badge for the next batched update. Badges that can't hold a socket
+    # open still post each reading here.
+    if not request.is_json:
+        return 'Unsupported Media Type', 415
+    data = request.json.get('data', '')
+    value = parse_posted_reading(channel, data)
+    if value is not None:
+        telemetry_history.record(request.remote_addr, channel, value)
+    queue_telemetry(request.remote_addr, channel, data)
+    return received_message, 200
 
 # Serve your index.html file here
 @app.route('/')
@@ -15,43 +121,148 @@ def serve_index():
 # Endpoint to receive data from ESP32 for a button
 @app.route('/button', methods=['POST'])
 def button():
-    print("Request body:", request.form)
-    if request.is_json:
-        data = request.json.get('data', '')
-        print('Button data received:', data)
-        socketio.emit('updateButtonData', data)  # Emit button data to all connected clients
-        return 'Button Data Received', 200
-    else:
-        return 'Unsupported Media Type', 415
+    return receive_telemetry('button', 'Button Data Received')
 
 # Endpoint to receive data from ESP32 for a switch
 @app.route('/switch', methods=['POST'])
 def switch():
-    print("Request body:", request.data)
-    if request.is_json:
-        data = request.json.get('data', '')
-        print('Switch data received:', data)
-        socketio.emit('updateSwitchData', data)  # Emit switch data to all connected clients
-        return 'Switch Data Received', 200
-    else:
-        return 'Unsupported Media Type', 415
+    return receive_telemetry('switch', 'Switch Data Received')
 
 # Endpoint to receive data from ESP32 for a knob
 @app.route('/knob', methods=['POST'])
 def knob():
-    print("Request body:", request.data)
-    if request.is_json:
-        data = request.json.get('data', '')
-        print('Knob data received:', data)
-        socketio.emit('updateKnobData', data)  # Emit knob data to all connected clients
-        return 'Knob Data Received', 200
-    else:
-        return 'Unsupported Media Type', 415
+    return receive_telemetry('knob', 'Knob Data Received')
+
+@app.route('/history', methods=['GET'])
+def history():
+    """
+    Get the recent telemetry of a badge, e.g. /history?device=10.0.0.5&channel=knob&seconds=600&resolution=5
+    Parameters (query string):
+    - device: The IP address of the badge. Without it, the badges with a history are listed instead.
+    - channel: Comma separated channels to get (button, switch, knob), all of them by default.
+    - seconds: Length of the window ending now, 300 by default.
+    - resolution: Length of each bucket in seconds, or 0 for the raw samples. By default, and at least,
+      the window split into MAX_HISTORY_BUCKETS buckets.
+    Returns:
+        JSON: The channels with the start time t, min, max, mean and sample count of each bucket that has
+        samples, as one list per field. Raw samples have t and value lists instead.
+    """
+    device = request.args.get('device')
+    if not device:
+        return jsonify({'devices': telemetry_history.devices()})
+    channels = request.args.get('channel', ','.join(CHANNELS)).split(',')
+    if any(channel not in CHANNELS for channel in channels):
+        return jsonify({'error': 'Unknown channel'}), 400
+    try:
+        seconds = float(request.args.get('seconds', 300))
+        resolution = request.args.get('resolution')
+        resolution = float(resolution) if resolution is not None else None
+    except ValueError:
+        return jsonify({'error': 'Invalid seconds or resolution'}), 400
+    # nan and inf parse as floats, but can't bound a window
+    if not math.isfinite(seconds) or seconds <= 0 or (resolution is not None and (not math.isfinite(resolution) or resolution < 0)):
+        return jsonify({'error': 'Invalid seconds or resolution'}), 400
+    seconds = min(seconds, MAX_HISTORY_SECONDS)
+    if resolution != 0:
+        # The ring buffers already bound the raw samples, but buckets are limited to keep responses small
+        resolution = max(resolution or 0, seconds / MAX_HISTORY_BUCKETS)
+
+    end = time.time()
+    start = end - seconds
+    channel_history = telemetry_history.query(device, channels, start, end, resolution)
+    if channel_history is None:
+        return jsonify({'error': 'No history for this device'}), 404
+    return jsonify({'device': device, 'start': start, 'end': end, 'resolution': resolution, 'channels': channel_history})
+
+@socketio.on('r', namespace='/badge')
+def handle_badge_readings(frame):
+    # One frame carries every reading that changed, e.g. {"k": 42, "s": 3, "b": 0}:
+    # b is the pressed button (0 for none), s the switches as a bit mask and k the knob percentage
+    if not isinstance(frame, dict):
+        return
+    for key, value in frame.items():
+        reading = BADGE_READINGS.get(key)
+        if reading is None or not isinstance(value, int):
+            continue
+        channel, format_value = reading
+        data = format_value(value)
+        if data is not None:
+            telemetry_history.record(request.remote_addr, channel, value)
+            queue_telemetry(request.remote_addr, channel, data)
 
 @socketio.on('connect')
 def handle_connect():
     print('A user connected')
 
+@socketio.on('listDevices')
+def handle_list_devices():
+    # Acknowledge with the badges that have sent readings, to choose which ones to subscribe to
+    with pending_lock:
+        return {'devices': sorted(latest_data)}
+
+@socketio.on('subscribe')
+def handle_subscribe(message):
+    """
+    Start sending the readings of some badges to this browser, e.g. {"devices": ["10.0.0.5"]}
+    Their latest values are sent straight away, so the dashboard doesn't wait for the next change.
+    Returns:
+        The acknowledgement, with the badges subscribed to or an error.
+    """
+    devices = message.get('devices') if isinstance(message, dict) else None
+    if not isinstance(devices, list) or not all(isinstance(device, str) for device in devices):
+        return {'error': 'Expected a list of devices'}
+    with pending_lock:
+        subscribed = subscriptions.setdefault(request.sid, set())
+        new_devices = set(devices) - subscribed
+        if len(subscribed) + len(new_devices) > MAX_SUBSCRIPTIONS:
+            return {'error': f'At most {MAX_SUBSCRIPTIONS} devices can be subscribed to'}
+        subscribed.update(new_devices)
+        device_watchers.update(new_devices)
+        current_data = {device: dict(latest_data[device]) for device in devices if device in latest_data}
+        subscribed = sorted(subscribed)
+    for device in new_devices:
+        join_room(device_room(device))
+    if current_data:
+        emit('updateData', current_data)
+    return {'devices': subscribed}
+
+@socketio.on('unsubscribe')
+def handle_unsubscribe(message):
+    # Stop sending the readings of some badges to this browser, e.g. {"devices": ["10.0.0.5"]}
+    devices = message.get('devices') if isinstance(message, dict) else None
+    if not isinstance(devices, list):
+        return {'error': 'Expected a list of devices'}
+    with pending_lock:
+        subscribed = subscriptions.get(request.sid, set())
+        old_devices = subscribed.intersection(devices)
+        subscribed -= old_devices
+        unwatch_devices(old_devices)
+        subscribed = sorted(subscribed)
+    for device in old_devices:
+        leave_room(device_room(device))
+    return {'devices': subscribed}
+
+@socketio.on('subscribeAll')
+def handle_subscribe_all(message=None):
+    # Send the readings of every badge to this browser, e.g. {"key": "..."} when INSTRUCTOR_KEY is set
+    key = message.get('key') if isinstance(message, dict) else None
+    if INSTRUCTOR_KEY and key != INSTRUCTOR_KEY:
+        return {'error': 'Invalid instructor key'}
+    with pending_lock:
+        instructors.add(request.sid)
+        current_data = {device: dict(data) for device, data in latest_data.items()}
+    join_room(INSTRUCTOR_ROOM)
+    if current_data:
+        emit('updateData', current_data)
+    return {'devices': sorted(current_data)}
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    # Socket.IO leaves the rooms on its own, but the badges stop being watched by this browser
+    with pending_lock:
+        unwatch_devices(subscriptions.pop(request.sid, set()))
+        instructors.discard(request.sid)
+
 if __name__ == '__main__':
     port = 5000
     socketio.run(app, host='0.0.0.0', port=port)
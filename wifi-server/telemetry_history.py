@@ -0,0 +1,152 @@
+"""
+Recent telemetry of each badge, kept in fixed-size ring buffers and downsampled with NumPy.
+
+Every device gets one preallocated buffer per channel, and only the most recently updated devices are
+kept, so the history takes the same memory however long the server runs: about
+12 bytes x samples_per_channel x 3 channels x max_devices.
+"""
+import collections
+import threading
+import time
+import numpy as np
+
+CHANNELS = ('button', 'switch', 'knob')
+
+class RingBuffer:
+    """
+    The latest samples of one channel as (time, value) pairs, overwriting the oldest once full.
+    """
+    def __init__(self, capacity):
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.values = np.zeros(capacity, dtype=np.float32)
+        self.capacity = capacity
+        self.next_index = 0 # Where the next sample is written
+        self.count = 0
+
+    def clear(self):
+        self.next_index = 0
+        self.count = 0
+
+    def append(self, sample_time, value):
+        self.times[self.next_index] = sample_time
+        self.values[self.next_index] = value
+        self.next_index = (self.next_index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def window(self, start, end):
+        """
+        Get a copy of the samples taken between two times, oldest first.
+        Parameters:
+        - start: The earliest sample time to include.
+        - end: The latest sample time to include.
+        Returns:
+        - times: Array of the sample times.
+        - values: Array of the sample values.
+        """
+        if self.count < self.capacity:
+            times, values = self.times[:self.count], self.values[:self.count]
+        else:
+            # Unroll the buffer so the samples are in time order
+            times = np.concatenate((self.times[self.next_index:], self.times[:self.next_index]))
+            values = np.concatenate((self.values[self.next_index:], self.values[:self.next_index]))
+        first = np.searchsorted(times, start, side='left')
+        last = np.searchsorted(times, end, side='right')
+        return times[first:last].copy(), values[first:last].copy()
+
+def downsample(times, values, start, resolution):
+    """
+    Reduce samples to buckets of a fixed length with the min, max and mean of each, skipping empty buckets.
+    Parameters:
+    - times: Array of the sample times, oldest first.
+    - values: Array of the sample values.
+    - start: The time the first bucket starts at.
+    - resolution: The length of each bucket in seconds.
+    Returns:
+    - buckets: Dictionary of lists with the start time t, min, max, mean and count of each bucket.
+    """
+    if not len(times):
+        return {'t': [], 'min': [], 'max': [], 'mean': [], 'count': []}
+    bucket_numbers = ((times - start) // resolution).astype(np.int64)
+    # The samples are in time order, so each bucket is one run of equal bucket numbers
+    bucket_starts = np.concatenate(([0], np.flatnonzero(np.diff(bucket_numbers)) + 1))
+    counts = np.diff(np.append(bucket_starts, len(values)))
+    return {
+        't': (start + bucket_numbers[bucket_starts] * resolution).tolist(),
+        'min': np.minimum.reduceat(values, bucket_starts).tolist(),
+        'max': np.maximum.reduceat(values, bucket_starts).tolist(),
+        'mean': (np.add.reduceat(values.astype(np.float64), bucket_starts) / counts).tolist(),
+        'count': counts.tolist()
+    }
+
+class TelemetryHistory:
+    """
+    Ring buffers of every channel of the most recently updated devices.
+    """
+    def __init__(self, samples_per_channel, max_devices):
+        """
+        Parameters:
+        - samples_per_channel: Samples kept for each channel of a device.
+        - max_devices: Devices kept, dropping the one updated longest ago to make room for a new one.
+        """
+        self.samples_per_channel = samples_per_channel
+        self.max_devices = max_devices
+        # Maps each device to a dictionary of its ring buffers, least recently updated first
+        self._devices = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, device, channel, value, sample_time=None):
+        """
+        Add a sample to the history of a device.
+        Parameters:
+        - device: The IP address of the device.
+        - channel: One of CHANNELS.
+        - value: The numeric reading.
+        - sample_time: Epoch time of the sample, now by default.
+        """
+        sample_time = time.time() if sample_time is None else sample_time
+        with self._lock:
+            buffers = self._devices.get(device)
+            if buffers is None:
+                if len(self._devices) >= self.max_devices:
+                    # Reuse the buffers of the device updated longest ago, so nothing is allocated
+                    old_device, buffers = self._devices.popitem(last=False)
+                    for buffer in buffers.values():
+                        buffer.clear()
+                else:
+                    buffers = {name: RingBuffer(self.samples_per_channel) for name in CHANNELS}
+                self._devices[device] = buffers
+            else:
+                self._devices.move_to_end(device)
+            buffers[channel].append(sample_time, value)
+
+    def devices(self):
+        # Devices with a history, most recently updated first
+        with self._lock:
+            return list(reversed(self._devices))
+
+    def query(self, device, channels, start, end, resolution):
+        """
+        Get the history of a device over a window of time.
+        Parameters:
+        - device: The IP address of the device.
+        - channels: List of the channels to get.
+        - start: The start of the window as an epoch time.
+        - end: The end of the window as an epoch time.
+        - resolution: The length of each bucket in seconds, or 0 for the raw samples.
+        Returns:
+        - history: Dictionary mapping each channel to its buckets (see downsample), or to its raw samples
+          as lists t and value, or None if the device has no history.
+        """
+        with self._lock:
+            buffers = self._devices.get(device)
+            if buffers is None:
+                return None
+            windows = {channel: buffers[channel].window(start, end) for channel in channels}
+        # Downsample outside the lock, on the copies
+        history = {}
+        for channel, (times, values) in windows.items():
+            if resolution:
+                history[channel] = downsample(times, values, start, resolution)
+            else:
+                history[channel] = {'t': times.tolist(), 'value': values.tolist()}
+        return history